@@ -0,0 +1,26 @@
+-- Migration: Create SFTP ingest ledger
+-- Tracks every file loaded by server/sftp_cron_loader so that a crash or a failed
+-- remote delete never causes a file to be inserted twice. Chunk progress is
+-- updated in the same transaction as the chunk's rows.
+-- rows_committed counts source records, the offset an interrupted load resumes at.
+-- CONTENT_CHANGED marks a partly loaded file whose content changed; its committed
+-- rows are already in exposures, so the loader leaves the file on the server until
+-- an operator removes those rows and deletes the ledger row.
+
+CREATE TABLE IF NOT EXISTS sftp_ingest_ledger (
+  filename TEXT NOT NULL,
+  file_size BIGINT NOT NULL,
+  file_mtime BIGINT NOT NULL,
+  content_sha256 CHAR(64) NOT NULL,
+  detail_table VARCHAR(100) NOT NULL,
+  chunks_committed INTEGER NOT NULL DEFAULT 0,
+  rows_committed BIGINT NOT NULL DEFAULT 0,
+  status VARCHAR(20) NOT NULL DEFAULT 'IN_PROGRESS' CHECK (status IN ('IN_PROGRESS', 'COMPLETE', 'CONTENT_CHANGED')),
+  started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (filename, file_size, file_mtime)
+);
+
+CREATE INDEX IF NOT EXISTS idx_sftp_ingest_ledger_sha256
+  ON sftp_ingest_ledger (content_sha256)
+  WHERE status = 'COMPLETE';
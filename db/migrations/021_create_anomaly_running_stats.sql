@@ -0,0 +1,21 @@
+-- Migration: Create state tables for incremental anomaly detection
+-- Used by server/anomaly_detection_service when ANOMALY_MODE=incremental.
+-- Running statistics are stored as Welford/Chan moments (count, mean, M2) per
+-- (unit, device_id, location_code); NULL device/location are stored as ''.
+
+CREATE TABLE IF NOT EXISTS anomaly_running_stats (
+  unit VARCHAR(50) NOT NULL,
+  device_id VARCHAR(255) NOT NULL DEFAULT '',
+  location_code VARCHAR(255) NOT NULL DEFAULT '',
+  sample_count BIGINT NOT NULL,
+  mean_value DOUBLE PRECISION NOT NULL,
+  m2 DOUBLE PRECISION NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (unit, device_id, location_code)
+);
+
+CREATE TABLE IF NOT EXISTS anomaly_detector_state (
+  detector_name VARCHAR(100) PRIMARY KEY,
+  high_water_mark TIMESTAMPTZ NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,46 @@
+-- Migration: Create daily and monthly exposure rollups
+-- Written by server/data_retention_service before raw exposures are purged, so
+-- every unit keeps its history after RAW_DATA_RETENTION_YEARS. Days are UTC.
+-- NULL device/location are stored as ''. `sketch` is a mergeable log-bucket
+-- quantile sketch: {"alpha": a, "zero": n, "pos": {"i": n}, "neg": {"i": n}},
+-- where bucket i holds |value| in (gamma^(i-1), gamma^i], gamma = (1+a)/(1-a).
+
+CREATE TABLE IF NOT EXISTS exposure_daily_summary (
+  day DATE NOT NULL,
+  unit VARCHAR(50) NOT NULL,
+  device_id VARCHAR(255) NOT NULL DEFAULT '',
+  location_code VARCHAR(255) NOT NULL DEFAULT '',
+  sample_count BIGINT NOT NULL,
+  min_value DOUBLE PRECISION NOT NULL,
+  max_value DOUBLE PRECISION NOT NULL,
+  sum_value DOUBLE PRECISION NOT NULL,
+  mean_value DOUBLE PRECISION NOT NULL,
+  p50_value DOUBLE PRECISION,
+  p95_value DOUBLE PRECISION,
+  p99_value DOUBLE PRECISION,
+  sketch JSONB NOT NULL,
+  PRIMARY KEY (day, unit, device_id, location_code)
+);
+
+CREATE INDEX IF NOT EXISTS idx_exposure_daily_summary_unit_day
+  ON exposure_daily_summary (unit, day);
+
+CREATE TABLE IF NOT EXISTS exposure_monthly_summary (
+  month DATE NOT NULL,
+  unit VARCHAR(50) NOT NULL,
+  device_id VARCHAR(255) NOT NULL DEFAULT '',
+  location_code VARCHAR(255) NOT NULL DEFAULT '',
+  sample_count BIGINT NOT NULL,
+  min_value DOUBLE PRECISION NOT NULL,
+  max_value DOUBLE PRECISION NOT NULL,
+  sum_value DOUBLE PRECISION NOT NULL,
+  mean_value DOUBLE PRECISION NOT NULL,
+  p50_value DOUBLE PRECISION,
+  p95_value DOUBLE PRECISION,
+  p99_value DOUBLE PRECISION,
+  sketch JSONB NOT NULL,
+  PRIMARY KEY (month, unit, device_id, location_code)
+);
+
+CREATE INDEX IF NOT EXISTS idx_exposure_monthly_summary_unit_month
+  ON exposure_monthly_summary (unit, month);
@@ -0,0 +1,25 @@
+-- Migration: Create state tables for the alert evaluator
+-- Used by server/alert_evaluator_service, which calls check_for_alerts()
+-- (migration 010) incrementally. exposure_alerts is keyed by the alert's bucket
+-- so the same alert is never reported twice; notified_at is set once the alert
+-- has been fanned out, so unsent alerts are retried after a restart.
+
+CREATE TABLE IF NOT EXISTS alert_evaluator_state (
+  evaluator_name VARCHAR(100) PRIMARY KEY,
+  high_water_mark TIMESTAMPTZ NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS exposure_alerts (
+  alert_type VARCHAR(50) NOT NULL,
+  location_code VARCHAR(255) NOT NULL DEFAULT '',
+  alert_time TIMESTAMPTZ NOT NULL,
+  trigger_value NUMERIC NOT NULL,
+  detected_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  notified_at TIMESTAMPTZ,
+  PRIMARY KEY (alert_type, location_code, alert_time)
+);
+
+CREATE INDEX IF NOT EXISTS idx_exposure_alerts_unnotified
+  ON exposure_alerts (detected_at)
+  WHERE notified_at IS NULL;
@@ -0,0 +1,12 @@
+-- Migration: Index exposures by wearer, device and location over time
+-- Used by StreamNoiseDose in server/grpc_service, which reads one device's,
+-- wearer's (captured_by) or location's noise intervals for a time range.
+
+CREATE INDEX IF NOT EXISTS idx_exposures_device_time
+  ON exposures (device_id, timestamp_utc);
+
+CREATE INDEX IF NOT EXISTS idx_exposures_captured_by_time
+  ON exposures (captured_by, timestamp_utc);
+
+CREATE INDEX IF NOT EXISTS idx_exposures_location_time
+  ON exposures (location_code, timestamp_utc);
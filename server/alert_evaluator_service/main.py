@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from collections import OrderedDict, deque
+from datetime import timedelta
+import psycopg2
+import requests
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from metrics_http import start_metrics_server
+
+# --- Load Configuration ---
+load_dotenv()
+
+# DB Config
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_NAME = os.getenv("DB_NAME")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+
+# Evaluation Config
+EVALUATOR_NAME = os.getenv("EVALUATOR_NAME", "check_for_alerts")
+EVAL_INTERVAL_SECONDS = float(os.getenv("EVAL_INTERVAL_SECONDS", 15))
+# An hourly bucket of the continuous aggregates in migration 010 is first
+# materialized by a refresh that runs at least end_offset (1 hour) after the
+# bucket closes, and refreshes run every schedule_interval (1 hour), so a bucket
+# can appear up to bucket width + end_offset + schedule_interval after it starts.
+AGGREGATE_LAG_MINUTES = 60 + 60 + 60
+# Each window starts this far before the high-water mark, so late readings and
+# late-materialized buckets are evaluated again (the default adds 15 minutes
+# for the refresh job itself).
+ALERT_OVERLAP_MINUTES = float(os.getenv("ALERT_OVERLAP_MINUTES", AGGREGATE_LAG_MINUTES + 15))
+ALERT_INITIAL_LOOKBACK_MINUTES = float(os.getenv("ALERT_INITIAL_LOOKBACK_MINUTES", AGGREGATE_LAG_MINUTES + 15))
+ALERT_CACHE_SIZE = int(os.getenv("ALERT_CACHE_SIZE", 10000))
+
+# Fan-out Config
+ALERT_BATCH_SIZE = int(os.getenv("ALERT_BATCH_SIZE", 100))
+ALERT_NOTIFY_CHANNEL = os.getenv("ALERT_NOTIFY_CHANNEL", "exposure_alert_changes")
+ALERT_WEBHOOK_URL = os.getenv("ALERT_WEBHOOK_URL", "")
+ALERT_WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("ALERT_WEBHOOK_TIMEOUT_SECONDS", 5))
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# Logging Config
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# --- Logging Setup ---
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def get_db_connection():
+    """Establishes and returns a connection to the PostgreSQL database."""
+    try:
+        conn = psycopg2.connect(
+            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
+        )
+        return conn
+    except psycopg2.OperationalError as e:
+        logger.error(f"Could not connect to the database: {e}")
+        return None
+
+
+def alert_key(alert_type, location_code, alert_time):
+    return (alert_type, location_code or '', alert_time)
+
+
+class AlertCache:
+    """Bounded LRU of alert keys already persisted, so repeated overlap hits skip the database."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+
+class AlertMetrics:
+    """Thread-safe evaluation counters and notification latency percentiles."""
+
+    def __init__(self, window=1000):
+        self._notify_latency = deque(maxlen=window)
+        self._end_to_end_latency = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.evaluations = 0
+        self.alerts_detected = 0
+        self.alerts_notified = 0
+        self.errors = 0
+        self.last_eval_seconds = 0.0
+        self.last_window = None
+
+    def record_evaluation(self, seconds, detected, window):
+        with self._lock:
+            self.evaluations += 1
+            self.alerts_detected += detected
+            self.last_eval_seconds = seconds
+            self.last_window = window
+
+    def record_notified(self, latencies):
+        """latencies: (notified - detected, notified - alert_time) pairs in seconds."""
+        with self._lock:
+            self.alerts_notified += len(latencies)
+            for notify, end_to_end in latencies:
+                self._notify_latency.append(notify)
+                self._end_to_end_latency.append(end_to_end)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return {'p50': None, 'p95': None, 'max': None}
+        ordered = sorted(values)
+        pick = lambda q: round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 3)
+        return {'p50': pick(0.5), 'p95': pick(0.95), 'max': round(ordered[-1], 3)}
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'evaluations': self.evaluations,
+                'alerts_detected': self.alerts_detected,
+                'alerts_notified': self.alerts_notified,
+                'errors': self.errors,
+                'last_eval_seconds': round(self.last_eval_seconds, 3),
+                'last_window': [t.isoformat() for t in self.last_window] if self.last_window else None,
+                'notify_latency_seconds': self._percentiles(self._notify_latency),
+                'alert_to_notify_latency_seconds': self._percentiles(self._end_to_end_latency),
+            }
+
+
+def evaluate_alerts(conn, cache):
+    """
+    Runs check_for_alerts() over [high-water mark - overlap, NOW()), persists
+    alerts not seen before and advances the high-water mark, in one transaction.
+    Returns (new_alert_count, (window_start, window_end)).
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT high_water_mark FROM alert_evaluator_state WHERE evaluator_name = %s FOR UPDATE",
+            (EVALUATOR_NAME,)
+        )
+        row = cur.fetchone()
+        cur.execute("SELECT NOW()")
+        window_end = cur.fetchone()[0]
+        if row:
+            window_start = row[0] - timedelta(minutes=ALERT_OVERLAP_MINUTES)
+        else:
+            window_start = window_end - timedelta(minutes=ALERT_INITIAL_LOOKBACK_MINUTES)
+
+        cur.execute(
+            "SELECT alert_type, location_code, trigger_value, alert_time FROM check_for_alerts(%s, %s)",
+            (window_start, window_end)
+        )
+        candidates = {}
+        for alert_type, location_code, trigger_value, alert_time in cur.fetchall():
+            key = alert_key(alert_type, location_code, alert_time)
+            if key not in cache:
+                # Several raw readings can share a key; keep the highest trigger value.
+                if key not in candidates or trigger_value > candidates[key]:
+                    candidates[key] = trigger_value
+
+        inserted = []
+        if candidates:
+            inserted = execute_values(
+                cur,
+                """
+                INSERT INTO exposure_alerts (alert_type, location_code, alert_time, trigger_value)
+                VALUES %s
+                ON CONFLICT (alert_type, location_code, alert_time) DO NOTHING
+                RETURNING alert_type
+                """,
+                [(*key, value) for key, value in candidates.items()],
+                page_size=1000,
+                fetch=True
+            )
+        cur.execute(
+            """
+            INSERT INTO alert_evaluator_state (evaluator_name, high_water_mark)
+            VALUES (%s, %s)
+            ON CONFLICT (evaluator_name) DO UPDATE
+            SET high_water_mark = EXCLUDED.high_water_mark, updated_at = NOW()
+            """,
+            (EVALUATOR_NAME, window_end)
+        )
+    conn.commit()
+    for key in candidates:
+        cache.add(key)
+    return len(inserted), (window_start, window_end)
+
+
+def deliver_batch(conn, session, alerts):
+    """Publishes one batch via pg_notify (and the webhook, if configured)."""
+    payloads = [
+        json.dumps({
+            'alert_type': alert_type,
+            'location_code': location_code,
+            'alert_time': alert_time.isoformat(),
+            'trigger_value': float(trigger_value),
+            'detected_at': detected_at.isoformat(),
+        })
+        for alert_type, location_code, alert_time, trigger_value, detected_at in alerts
+    ]
+    if ALERT_WEBHOOK_URL:
+        response = session.post(
+            ALERT_WEBHOOK_URL,
+            data='[' + ','.join(payloads) + ']',
+            headers={'Content-Type': 'application/json'},
+            timeout=ALERT_WEBHOOK_TIMEOUT_SECONDS
+        )
+        response.raise_for_status()
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload", (ALERT_NOTIFY_CHANNEL, payloads))
+
+
+def notify_pending(conn, session, metrics):
+    """
+    Fans out every persisted alert that has not been notified yet, in batches of
+    ALERT_BATCH_SIZE, and marks each batch notified in the same transaction as
+    its pg_notify. Returns the number of alerts notified.
+    """
+    notified = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT alert_type, location_code, alert_time, trigger_value, detected_at
+                FROM exposure_alerts
+                WHERE notified_at IS NULL
+                ORDER BY detected_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+                """,
+                (ALERT_BATCH_SIZE,)
+            )
+            alerts = cur.fetchall()
+            if not alerts:
+                conn.commit()
+                return notified
+            deliver_batch(conn, session, alerts)
+            latencies = execute_values(
+                cur,
+                """
+                UPDATE exposure_alerts a SET notified_at = clock_timestamp()
+                FROM (VALUES %s) AS v (alert_type, location_code, alert_time)
+                WHERE a.alert_type = v.alert_type AND a.location_code = v.location_code AND a.alert_time = v.alert_time
+                RETURNING EXTRACT(EPOCH FROM a.notified_at - a.detected_at)::float8,
+                          EXTRACT(EPOCH FROM a.notified_at - a.alert_time)::float8
+                """,
+                [(a[0], a[1], a[2]) for a in alerts],
+                template="(%s, %s, %s::timestamptz)",
+                fetch=True
+            )
+        conn.commit()
+        metrics.record_notified(latencies)
+        notified += len(alerts)
+        logger.info(f"Notified {len(alerts)} alerts on '{ALERT_NOTIFY_CHANNEL}'.")
+
+
+def run_evaluator(stop_event=None):
+    """Evaluates alerts every EVAL_INTERVAL_SECONDS until stop_event is set."""
+    stop_event = stop_event or threading.Event()
+    metrics = AlertMetrics()
+    if METRICS_PORT:
+        start_metrics_server(metrics, METRICS_PORT, 'alert')
+    cache = AlertCache(ALERT_CACHE_SIZE)
+    session = requests.Session()
+    conn = None
+    logger.info(f"Evaluating alerts every {EVAL_INTERVAL_SECONDS}s with {ALERT_OVERLAP_MINUTES} minutes of overlap.")
+    if ALERT_OVERLAP_MINUTES < AGGREGATE_LAG_MINUTES:
+        logger.warning(
+            f"ALERT_OVERLAP_MINUTES={ALERT_OVERLAP_MINUTES} is shorter than the {AGGREGATE_LAG_MINUTES} minutes an "
+            f"hourly aggregate bucket can take to materialize; alerts from late buckets will be missed."
+        )
+
+    try:
+        while not stop_event.is_set():
+            started = time.monotonic()
+            try:
+                if conn is None or conn.closed:
+                    conn = get_db_connection()
+                if conn is not None:
+                    detected, window = evaluate_alerts(conn, cache)
+                    metrics.record_evaluation(time.monotonic() - started, detected, window)
+                    if detected:
+                        logger.warning(f"Detected {detected} new alerts between {window[0]} and {window[1]}.")
+                    notify_pending(conn, session, metrics)
+            except (psycopg2.Error, requests.RequestException) as e:
+                logger.error(f"Alert evaluation failed: {e}")
+                metrics.record_error()
+                if conn is not None and not conn.closed:
+                    conn.rollback()
+            # A little jitter keeps several evaluators from hitting the database in lockstep.
+            delay = EVAL_INTERVAL_SECONDS - (time.monotonic() - started) + random.uniform(0, EVAL_INTERVAL_SECONDS * 0.1)
+            stop_event.wait(max(delay, 0))
+    finally:
+        session.close()
+        if conn:
+            conn.close()
+            logger.info("Database connection closed.")
+
+
+def run_once():
+    """Evaluates and notifies a single window (for cron or manual runs)."""
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        detected, window = evaluate_alerts(conn, AlertCache(ALERT_CACHE_SIZE))
+        logger.info(f"Detected {detected} new alerts between {window[0]} and {window[1]}.")
+        with requests.Session() as session:
+            notify_pending(conn, session, AlertMetrics())
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluates check_for_alerts() incrementally.")
+    parser.add_argument('--once', action='store_true', help="Evaluate one window and exit.")
+    args = parser.parse_args()
+    if args.once:
+        run_once()
+    else:
+        try:
+            run_evaluator()
+        except KeyboardInterrupt:
+            logger.info("Shutting down alert evaluator...")
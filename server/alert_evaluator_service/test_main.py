@@ -0,0 +1,132 @@
+import json
+import pytest
+from unittest.mock import MagicMock
+from datetime import datetime, timedelta, timezone
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import main
+from main import AlertCache, AlertMetrics, evaluate_alerts, notify_pending
+
+NOW = datetime(2024, 6, 1, 12, 0, 30, tzinfo=timezone.utc)
+BUCKET = datetime(2024, 6, 1, 11, tzinfo=timezone.utc)
+
+@pytest.fixture
+def mock_db_connection():
+    """Fixture to mock the database connection and cursor."""
+    mock_conn = MagicMock()
+    mock_cur = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+    return mock_conn, mock_cur
+
+def test_alert_cache_evicts_least_recently_used():
+    cache = AlertCache(max_size=2)
+    cache.add('a')
+    cache.add('b')
+    assert 'a' in cache  # touches 'a'
+    cache.add('c')
+
+    assert 'a' in cache and 'c' in cache
+    assert 'b' not in cache
+
+def test_evaluate_alerts_scans_from_high_water_mark_minus_overlap(mock_db_connection, mocker):
+    mock_conn, mock_cur = mock_db_connection
+    mocker.patch('main.ALERT_OVERLAP_MINUTES', 65)
+    mock_insert = mocker.patch('main.execute_values', return_value=[('HIGH_RADIATION',), ('HIGH_PM2.5',)])
+    high_water_mark = NOW - timedelta(seconds=15)
+    mock_cur.fetchone.side_effect = [(high_water_mark,), (NOW,)]
+    mock_cur.fetchall.return_value = [
+        ('HIGH_PM2.5', 'DDG-51-ER', 40.2, BUCKET),
+        ('HIGH_RADIATION', 'CVN-78-RX', 2.5, BUCKET),
+        ('HIGH_RADIATION', 'CVN-78-RX', 3.1, BUCKET),  # same key, higher reading
+        ('HIGH_HEAT_STRESS', None, 33.0, BUCKET),      # already reported
+    ]
+    cache = AlertCache(100)
+    cache.add(('HIGH_HEAT_STRESS', '', BUCKET))
+
+    detected, window = evaluate_alerts(mock_conn, cache)
+
+    assert detected == 2
+    assert window == (high_water_mark - timedelta(minutes=65), NOW)
+    check = [c for c in mock_cur.execute.call_args_list if 'check_for_alerts(' in c[0][0]][0]
+    assert check[0][1] == window
+    rows = sorted(mock_insert.call_args[0][2])
+    assert rows == [('HIGH_PM2.5', 'DDG-51-ER', BUCKET, 40.2), ('HIGH_RADIATION', 'CVN-78-RX', BUCKET, 3.1)]
+    # The high-water mark moves to the end of the window in the same transaction.
+    state = [c for c in mock_cur.execute.call_args_list if 'alert_evaluator_state (' in c[0][0]][0]
+    assert state[0][1][1] == NOW
+    mock_conn.commit.assert_called_once()
+    assert ('HIGH_RADIATION', 'CVN-78-RX', BUCKET) in cache
+
+def test_a_bucket_materialized_hours_late_is_still_evaluated(mock_db_connection, mocker):
+    """
+    The 11:00 bucket closes at 12:00; the refresh policy skips it until 13:00
+    (end_offset) and, running hourly, may first materialize it just before
+    14:00. Evaluations up to then see nothing; the next one must still reach back to 11:00.
+    """
+    mock_conn, mock_cur = mock_db_connection
+    mock_insert = mocker.patch('main.execute_values', return_value=[('HIGH_PM2.5',)])
+    materialized_at = BUCKET + timedelta(hours=3) - timedelta(seconds=1)
+    clock = {'now': BUCKET + timedelta(hours=1)}
+    state = {'high_water_mark': None}
+
+    def fetchone():
+        if mock_cur.execute.call_args[0][0].startswith('SELECT high_water_mark'):
+            return (state['high_water_mark'],) if state['high_water_mark'] else None
+        return (clock['now'],)
+
+    def fetchall():
+        window_start, window_end = mock_cur.execute.call_args[0][1]
+        if clock['now'] >= materialized_at and window_start <= BUCKET < window_end:
+            return [('HIGH_PM2.5', 'DDG-51-ER', 40.2, BUCKET)]
+        return []
+
+    mock_cur.fetchone.side_effect = fetchone
+    mock_cur.fetchall.side_effect = fetchall
+    cache = AlertCache(100)
+    detected = 0
+    while clock['now'] <= materialized_at + timedelta(minutes=1):
+        found, window = evaluate_alerts(mock_conn, cache)
+        detected += found
+        state['high_water_mark'] = window[1]
+        clock['now'] += timedelta(seconds=main.EVAL_INTERVAL_SECONDS)
+
+    assert main.ALERT_OVERLAP_MINUTES >= main.AGGREGATE_LAG_MINUTES
+    assert detected == 1
+    assert mock_insert.call_args[0][2] == [('HIGH_PM2.5', 'DDG-51-ER', BUCKET, 40.2)]
+
+def test_evaluate_alerts_skips_the_insert_when_everything_is_cached(mock_db_connection, mocker):
+    mock_conn, mock_cur = mock_db_connection
+    mock_insert = mocker.patch('main.execute_values')
+    mock_cur.fetchone.side_effect = [None, (NOW,)]
+    mock_cur.fetchall.return_value = [('HIGH_PM2.5', 'DDG-51-ER', 40.2, BUCKET)]
+    cache = AlertCache(100)
+    cache.add(('HIGH_PM2.5', 'DDG-51-ER', BUCKET))
+
+    detected, _ = evaluate_alerts(mock_conn, cache)
+
+    assert detected == 0
+    mock_insert.assert_not_called()
+
+def test_notify_pending_fans_out_in_batches_and_records_latency(mock_db_connection, mocker):
+    mock_conn, mock_cur = mock_db_connection
+    mocker.patch('main.ALERT_BATCH_SIZE', 2)
+    mocker.patch('main.ALERT_WEBHOOK_URL', 'http://alerts.local/hook')
+    pending = [('HIGH_PM2.5', f'LOC-{i}', BUCKET, 40.0 + i, NOW) for i in range(3)]
+    mock_cur.fetchall.side_effect = [pending[:2], pending[2:], []]
+    mocker.patch('main.execute_values', side_effect=lambda cur, sql, rows, **kw: [(0.2, 3630.0)] * len(rows))
+    session = MagicMock()
+    metrics = AlertMetrics()
+
+    assert notify_pending(mock_conn, session, metrics) == 3
+
+    assert session.post.call_count == 2
+    assert len(json.loads(session.post.call_args_list[0][1]['data'])) == 2
+    notifies = [c for c in mock_cur.execute.call_args_list if 'pg_notify' in c[0][0]]
+    assert [len(c[0][1][1]) for c in notifies] == [2, 1]
+    snapshot = metrics.snapshot()
+    assert snapshot['alerts_notified'] == 3
+    assert snapshot['notify_latency_seconds']['p95'] == 0.2
+    assert mock_conn.commit.call_count == 3
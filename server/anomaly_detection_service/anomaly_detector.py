@@ -1,10 +1,21 @@
 import os
+import sys
+import time
 import logging
+import argparse
+import multiprocessing
+from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import psycopg2
+import psycopg2.errors
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from db_pool import connect
+
 # --- Load Configuration ---
 load_dotenv()
 
@@ -18,6 +29,40 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 # Anomaly Detection Config
 LOOKBACK_HOURS = int(os.getenv("LOOKBACK_HOURS", 24))
 Z_SCORE_THRESHOLD = float(os.getenv("Z_SCORE_THRESHOLD", 3.0))
+# Columns that define a population of comparable readings
+ANOMALY_GROUP_COLUMNS = [c.strip() for c in os.getenv("ANOMALY_GROUP_COLUMNS", "unit,device_id,location_code").split(',') if c.strip()]
+# 'dataframe' pulls rows into pandas; 'database' computes statistics and flags outliers in SQL
+ANOMALY_MODE = os.getenv("ANOMALY_MODE", "dataframe").lower()
+
+# Comma-separated detection engines run over each fetched batch (see DETECTORS)
+ANOMALY_DETECTORS = [d.strip() for d in os.getenv("ANOMALY_DETECTORS", "zscore").split(',') if d.strip()]
+MAD_THRESHOLD = float(os.getenv("MAD_THRESHOLD", 3.5))
+ROLLING_WINDOW = int(os.getenv("ROLLING_WINDOW", 30))
+ROLLING_MIN_PERIODS = int(os.getenv("ROLLING_MIN_PERIODS", 10))
+SEASONAL_MIN_SAMPLES = int(os.getenv("SEASONAL_MIN_SAMPLES", 5))
+
+# Parallel mode (dataframe mode only): number of worker processes (<= 1 disables it),
+# partitioning scheme ('unit' or 'device' hash) and number of device-hash partitions
+PARALLEL_WORKERS = int(os.getenv("PARALLEL_WORKERS", 0))
+PARALLEL_PARTITION_BY = os.getenv("PARALLEL_PARTITION_BY", "unit").lower()
+PARALLEL_PARTITIONS = int(os.getenv("PARALLEL_PARTITIONS", 0))
+# Rows fetched per round trip from a worker's server-side cursor
+FETCH_BATCH_ROWS = int(os.getenv("FETCH_BATCH_ROWS", 50000))
+
+# Name under which the incremental mode stores its high-water mark
+INCREMENTAL_DETECTOR_NAME = os.getenv("INCREMENTAL_DETECTOR_NAME", "zscore_incremental")
+
+# Flagging is applied in short transactions so it does not block concurrent ingest.
+FLAG_CHUNK_ROWS = int(os.getenv("FLAG_CHUNK_ROWS", 5000))
+FLAG_LOCK_TIMEOUT_MS = int(os.getenv("FLAG_LOCK_TIMEOUT_MS", 2000))
+FLAG_CHUNK_PAUSE_SECONDS = float(os.getenv("FLAG_CHUNK_PAUSE_SECONDS", 0.05))
+FLAG_MAX_RETRIES = int(os.getenv("FLAG_MAX_RETRIES", 5))
+
+# Group key of the persisted running statistics (see migration 021)
+STATS_KEY_COLUMNS = ['unit', 'device_id', 'location_code']
+
+# exposures columns that may be used to group readings in SQL
+GROUPABLE_COLUMNS = {'unit', 'device_id', 'location_code', 'captured_by', 'method_code'}
 
 # Logging Config
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -28,21 +73,14 @@ logger = logging.getLogger(__name__)
 
 def get_db_connection():
     """Establishes and returns a connection to the PostgreSQL database."""
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
-        )
-        return conn
-    except psycopg2.OperationalError as e:
-        logger.error(f"Could not connect to the database: {e}")
-        return None
+    return connect(dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD))
 
 def fetch_recent_exposures(conn):
     """Fetches recent exposure data that has not been flagged yet."""
     query = """
-        SELECT sample_id, value, unit
+        SELECT sample_id, device_id, location_code, timestamp_utc, value, unit
         FROM exposures
-        WHERE timestamp_utc >= NOW() - INTERVAL '%s hours'
+        WHERE timestamp_utc >= NOW() - make_interval(hours => %s)
         AND qualifier = 'OK'
     """
     try:
@@ -53,73 +91,621 @@ def fetch_recent_exposures(conn):
         logger.error(f"Failed to fetch data from database: {e}")
         return pd.DataFrame()
 
-def flag_anomalies(conn, anomaly_ids):
-    """Updates the qualifier for a list of sample_ids to 'PENDING'."""
+def _stage_anomalies(cur, anomaly_ids, timestamps):
+    """COPYs the ids (and timestamps, if known) into a session temp table, ordered by time. Returns the staged frame."""
+    staged = pd.DataFrame({'sample_id': [str(i) for i in anomaly_ids]})
+    staged['timestamp_utc'] = pd.to_datetime(pd.Series(list(timestamps)), utc=True) if timestamps is not None else pd.NaT
+    staged = staged.sort_values('timestamp_utc', kind='stable').reset_index(drop=True)
+    staged['seq'] = np.arange(len(staged))
+
+    cur.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS anomaly_flag_stage (
+            seq BIGINT PRIMARY KEY,
+            sample_id UUID NOT NULL,
+            timestamp_utc TIMESTAMPTZ
+        )
+        """
+    )
+    cur.execute("TRUNCATE anomaly_flag_stage")
+    buffer = StringIO()
+    staged.to_csv(buffer, columns=['seq', 'sample_id', 'timestamp_utc'], header=False, index=False)
+    buffer.seek(0)
+    cur.copy_expert("COPY anomaly_flag_stage (seq, sample_id, timestamp_utc) FROM STDIN WITH (FORMAT csv)", buffer)
+    return staged
+
+def _flag_chunk(conn, chunk):
+    """Applies one staged chunk in its own short transaction. Returns the number of rows updated."""
+    query = """
+        UPDATE exposures e SET qualifier = 'PENDING'
+        FROM anomaly_flag_stage s
+        WHERE s.seq >= %s AND s.seq <= %s
+        AND e.sample_id = s.sample_id
+        AND e.qualifier = 'OK'
+    """
+    params = [int(chunk['seq'].iloc[0]), int(chunk['seq'].iloc[-1])]
+    if chunk['timestamp_utc'].notna().all():
+        # Constant bounds let TimescaleDB exclude every hypertable chunk outside this slice.
+        query += " AND e.timestamp_utc >= %s AND e.timestamp_utc <= %s"
+        params += [chunk['timestamp_utc'].iloc[0].to_pydatetime(), chunk['timestamp_utc'].iloc[-1].to_pydatetime()]
+
+    attempts = max(FLAG_MAX_RETRIES, 1)
+    for attempt in range(1, attempts + 1):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL lock_timeout = %s", (f"{FLAG_LOCK_TIMEOUT_MS}ms",))
+                cur.execute(query, params)
+                updated = cur.rowcount
+            conn.commit()
+            return updated
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            if attempt == attempts:
+                raise
+            logger.warning(f"Rows in flag chunk are locked by another writer; retry {attempt}/{attempts}.")
+            time.sleep(FLAG_CHUNK_PAUSE_SECONDS * 2 ** attempt)
+
+def flag_anomalies(conn, anomaly_ids, timestamps=None):
+    """
+    Updates the qualifier for a list of sample_ids to 'PENDING'.
+
+    The ids are staged in a temp table with COPY and applied in chunks of
+    FLAG_CHUNK_ROWS, each committed on its own with a lock_timeout, so a large
+    backfill never holds row locks long enough to stall ingest. Passing the
+    rows' timestamps (in the same order) bounds each chunk by time.
+    """
     if not anomaly_ids:
         return 0
-    
-    query = "UPDATE exposures SET qualifier = 'PENDING' WHERE sample_id = ANY(%s)"
+
+    try:
+        return _apply_flags(conn, anomaly_ids, timestamps)
+    except Exception as e:
+        logger.error(f"Failed to flag anomalies in the database: {e}")
+        conn.rollback()
+        return 0
+
+def _apply_flags(conn, anomaly_ids, timestamps):
+    """Stages the ids and applies them chunk by chunk. Returns the number of rows updated; raises on failure."""
+    with conn.cursor() as cur:
+        staged = _stage_anomalies(cur, anomaly_ids, timestamps)
+    conn.commit()
+
+    flagged = 0
+    total = len(staged)
+    for start in range(0, total, FLAG_CHUNK_ROWS):
+        flagged += _flag_chunk(conn, staged.iloc[start:start + FLAG_CHUNK_ROWS])
+        done = min(start + FLAG_CHUNK_ROWS, total)
+        if done < total:
+            logger.info(f"Flagging progress: {done}/{total} staged ids applied ({flagged} rows updated).")
+            time.sleep(FLAG_CHUNK_PAUSE_SECONDS)
+    logger.info(f"Successfully flagged {flagged} records as 'PENDING'.")
+    return flagged
+
+def flag_anomalies_in_database(conn, group_columns=None, threshold=None):
+    """
+    Computes per-group mean and standard deviation over the lookback window in
+    the database and marks outliers as 'PENDING' with one set-based UPDATE, so
+    no raw rows are transferred. (The hourly continuous aggregates only keep
+    avg/min/max, which is not enough to derive a standard deviation.)
+    Returns the number of rows flagged.
+    """
+    group_columns = group_columns or ANOMALY_GROUP_COLUMNS
+    threshold = Z_SCORE_THRESHOLD if threshold is None else threshold
+    unknown = set(group_columns) - GROUPABLE_COLUMNS
+    if unknown:
+        raise ValueError(f"Cannot group by unknown column(s): {', '.join(sorted(unknown))}")
+
+    # Missing keys group as '' (as in anomaly_running_stats), so the join is a plain equality.
+    group_keys = [f"COALESCE({c}, '')" for c in group_columns]
+    group_list = ", ".join(f"{key} AS {c}" for key, c in zip(group_keys, group_columns))
+    group_by = ", ".join(group_keys)
+    join_condition = " AND ".join(f"COALESCE(e.{c}, '') = s.{c}" for c in group_columns)
+    # NOW() is fixed for the transaction, so both scans cover the same window.
+    query = f"""
+        WITH stats AS (
+            SELECT {group_list}, AVG(value) AS mean_value, STDDEV_SAMP(value) AS std_value
+            FROM exposures
+            WHERE timestamp_utc >= NOW() - make_interval(hours => %(hours)s)
+            AND qualifier = 'OK'
+            GROUP BY {group_by}
+            HAVING COUNT(*) >= 2 AND STDDEV_SAMP(value) > 0
+        )
+        UPDATE exposures e
+        SET qualifier = 'PENDING'
+        FROM stats s
+        WHERE {join_condition}
+        AND e.timestamp_utc >= NOW() - make_interval(hours => %(hours)s)
+        AND e.qualifier = 'OK'
+        AND ABS(e.value - s.mean_value) / s.std_value > %(threshold)s
+    """
     try:
         with conn.cursor() as cur:
-            cur.execute(query, (anomaly_ids,))
-            conn.commit()
-            logger.info(f"Successfully flagged {len(anomaly_ids)} records as 'PENDING'.")
-            return len(anomaly_ids)
+            cur.execute(query, {'hours': LOOKBACK_HOURS, 'threshold': threshold})
+            flagged = cur.rowcount
+        conn.commit()
+        logger.info(f"Flagged {flagged} records as 'PENDING' in the database.")
+        return flagged
     except Exception as e:
         logger.error(f"Failed to flag anomalies in the database: {e}")
         conn.rollback()
         return 0
 
-def run_anomaly_detection():
-    """Main function to run the anomaly detection process."""
-    logger.info("Starting anomaly detection process...")
+def _group_by(series, df, columns):
+    return series.groupby([df[c] for c in columns], sort=False, dropna=False, observed=True)
+
+
+class Detector:
+    """
+    Base class for detection engines. detect() receives the fetched batch and
+    returns a boolean numpy mask of anomalous rows; implementations must be
+    vectorized across all groups. group_columns are the columns that define the
+    population a row is compared with.
+    """
+
+    name = None
+    group_columns = ()
+    required_columns = ('value',)
+
+    def detect(self, df):
+        raise NotImplementedError
+
+
+class ZScoreDetector(Detector):
+    """Global z-score within each group."""
+
+    name = 'zscore'
+
+    def __init__(self, group_columns=None, threshold=None):
+        self.group_columns = tuple(group_columns or ANOMALY_GROUP_COLUMNS)
+        self.threshold = Z_SCORE_THRESHOLD if threshold is None else threshold
+
+    def detect(self, df):
+        # NUMERIC columns arrive as Decimal objects; convert once to a float array.
+        values = df['value'].astype('float64')
+        grouped = _group_by(values, df, self.group_columns)
+        mean = grouped.transform('mean')
+        std = grouped.transform('std')  # Sample std (ddof=1); NaN for single-row groups
+        z_scores = (values - mean).abs() / std
+        return ((std > 0) & (z_scores > self.threshold)).to_numpy()
+
+
+class MedianMADDetector(Detector):
+    """
+    Robust z-score (0.6745 * |x - median| / MAD) within each group. Unlike the
+    standard deviation, the median absolute deviation is not inflated by the
+    outliers themselves, so a cluster of extreme readings cannot mask itself.
+    """
+
+    name = 'mad'
+
+    def __init__(self, group_columns=None, threshold=None):
+        self.group_columns = tuple(group_columns or ANOMALY_GROUP_COLUMNS)
+        self.threshold = MAD_THRESHOLD if threshold is None else threshold
+
+    def detect(self, df):
+        values = df['value'].astype('float64')
+        median = _group_by(values, df, self.group_columns).transform('median')
+        deviation = (values - median).abs()
+        mad = _group_by(deviation, df, self.group_columns).transform('median')
+        robust_z = 0.6745 * deviation / mad
+        return ((mad > 0) & (robust_z > self.threshold)).to_numpy()
+
+
+class RollingZScoreDetector(Detector):
+    """
+    Z-score of each reading against the preceding `window` readings of the same
+    device and unit, ordered by time. Follows slow drifts that a global
+    baseline would treat as outliers, and catches spikes a global baseline misses.
+    """
+
+    name = 'rolling'
+    required_columns = ('value', 'timestamp_utc')
+
+    def __init__(self, window=None, min_periods=None, threshold=None):
+        self.group_columns = ('unit', 'device_id')
+        self.window = window or ROLLING_WINDOW
+        self.min_periods = min_periods or ROLLING_MIN_PERIODS
+        self.threshold = Z_SCORE_THRESHOLD if threshold is None else threshold
+
+    def detect(self, df):
+        keys = list(self.group_columns)
+        ordered = df[keys + ['timestamp_utc']].assign(value=df['value'].astype('float64'))
+        ordered = ordered.reset_index(drop=True).sort_values(keys + ['timestamp_utc'], kind='stable')
+
+        # Shift first so the baseline only contains earlier readings.
+        previous = _group_by(ordered['value'], ordered, keys).shift(1)
+        rolling = _group_by(previous, ordered, keys).rolling(self.window, min_periods=self.min_periods)
+        mean = rolling.mean().reset_index(level=list(range(len(keys))), drop=True)
+        std = rolling.std().reset_index(level=list(range(len(keys))), drop=True)
+
+        z_scores = (ordered['value'] - mean).abs() / std
+        mask = ((std > 0) & (z_scores > self.threshold)).sort_index()
+        return mask.to_numpy()
+
+
+class SeasonalHourDetector(Detector):
+    """
+    Z-score against the baseline for the same unit, location and hour of day
+    (UTC), so readings that are normal during the working day but abnormal at
+    night (and vice versa) are judged against the right baseline.
+    """
+
+    name = 'seasonal'
+    required_columns = ('value', 'timestamp_utc')
+
+    def __init__(self, min_samples=None, threshold=None):
+        self.group_columns = ('unit', 'location_code', 'hour_of_day')
+        self.min_samples = min_samples or SEASONAL_MIN_SAMPLES
+        self.threshold = Z_SCORE_THRESHOLD if threshold is None else threshold
+
+    def detect(self, df):
+        values = df['value'].astype('float64')
+        keyed = pd.DataFrame({
+            'unit': df['unit'],
+            'location_code': df['location_code'],
+            'hour_of_day': pd.to_datetime(df['timestamp_utc'], utc=True).dt.hour,
+        })
+        grouped = _group_by(values, keyed, self.group_columns)
+        count = grouped.transform('count')
+        mean = grouped.transform('mean')
+        std = grouped.transform('std')
+        z_scores = (values - mean).abs() / std
+        return ((count >= self.min_samples) & (std > 0) & (z_scores > self.threshold)).to_numpy()
+
+
+DETECTORS = {cls.name: cls for cls in (ZScoreDetector, MedianMADDetector, RollingZScoreDetector, SeasonalHourDetector)}
+
+def build_detectors(names=None):
+    """Instantiates the configured detection engines."""
+    names = names or ANOMALY_DETECTORS
+    unknown = [n for n in names if n not in DETECTORS]
+    if unknown:
+        raise ValueError(f"Unknown anomaly detector(s): {', '.join(unknown)}. Available: {', '.join(DETECTORS)}")
+    return [DETECTORS[n]() for n in names]
+
+def run_detectors(df, detectors):
+    """
+    Runs every detector over the same batch. Returns the union mask and a
+    {detector name: number of rows flagged} dict.
+    """
+    combined = np.zeros(len(df), dtype=bool)
+    counts = {}
+    for detector in detectors:
+        mask = detector.detect(df)
+        counts[detector.name] = int(mask.sum())
+        combined |= mask
+    return combined, counts
+
+def find_anomalies(df, group_columns=None, threshold=None):
+    """
+    Returns the rows of df whose absolute z-score within their group exceeds the
+    threshold. Mean and standard deviation are computed for all groups at once
+    with groupby transforms, so there is no per-group or per-row Python work.
+    Groups with fewer than two rows or zero variance never produce anomalies.
+    """
+    return df[ZScoreDetector(group_columns, threshold).detect(df)]
+
+def summarize_batch(df):
+    """Returns per-group count, mean and M2 (sum of squared deviations) for a batch."""
+    values = df['value'].astype('float64')
+    grouped = values.groupby([df[c] for c in STATS_KEY_COLUMNS], sort=False)
+    stats = grouped.agg(['count', 'mean', 'var'])
+    stats['m2'] = stats['var'].fillna(0.0) * (stats['count'] - 1)
+    stats = stats.rename(columns={'count': 'sample_count', 'mean': 'mean_value'})
+    return stats[['sample_count', 'mean_value', 'm2']].reset_index()
+
+def merge_running_stats(prior, batch):
+    """
+    Combines two sets of per-group moments with Chan's parallel update of the
+    Welford algorithm. Both frames have STATS_KEY_COLUMNS plus sample_count,
+    mean_value and m2; groups present in only one frame are carried over.
+    """
+    merged = prior.merge(batch, on=STATS_KEY_COLUMNS, how='outer', suffixes=('_a', '_b'))
+    n_a = merged['sample_count_a'].fillna(0).astype('float64')
+    n_b = merged['sample_count_b'].fillna(0).astype('float64')
+    mean_a = merged['mean_value_a'].fillna(0.0)
+    mean_b = merged['mean_value_b'].fillna(0.0)
+    n = n_a + n_b
+    delta = mean_b - mean_a
+
+    merged['sample_count'] = n.astype('int64')
+    merged['mean_value'] = mean_a + delta * (n_b / n)
+    merged['m2'] = merged['m2_a'].fillna(0.0) + merged['m2_b'].fillna(0.0) + delta ** 2 * n_a * n_b / n
+    return merged[STATS_KEY_COLUMNS + ['sample_count', 'mean_value', 'm2']]
+
+def score_against_stats(df, stats, threshold=None):
+    """Returns the rows of df whose z-score against the per-group running stats exceeds the threshold."""
+    threshold = Z_SCORE_THRESHOLD if threshold is None else threshold
+    joined = df.merge(stats, on=STATS_KEY_COLUMNS, how='left')
+    std = np.sqrt(joined['m2'] / (joined['sample_count'] - 1))
+    z_scores = (joined['value'].astype('float64') - joined['mean_value']).abs() / std
+    mask = ((joined['sample_count'] >= 2) & (std > 0) & (z_scores > threshold)).to_numpy()
+    return df[mask]
+
+def load_high_water_mark(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT high_water_mark FROM anomaly_detector_state WHERE detector_name = %s",
+            (INCREMENTAL_DETECTOR_NAME,)
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def fetch_exposures_since(conn, high_water_mark):
+    """
+    Fetches OK rows newer than the high-water mark (or the lookback window on
+    the first run). Rows that arrive later with an older timestamp are not seen.
+    """
+    if high_water_mark is None:
+        condition, params = "timestamp_utc >= NOW() - make_interval(hours => %s)", (LOOKBACK_HOURS,)
+    else:
+        condition, params = "timestamp_utc > %s", (high_water_mark,)
+    query = f"""
+        SELECT sample_id, device_id, location_code, timestamp_utc, value, unit
+        FROM exposures
+        WHERE {condition}
+        AND timestamp_utc <= NOW()
+        AND qualifier = 'OK'
+    """
+    df = pd.read_sql_query(query, conn, params=params)
+    df['device_id'] = df['device_id'].fillna('')
+    df['location_code'] = df['location_code'].fillna('')
+    return df
+
+def load_running_stats(conn, keys):
+    """Loads the persisted running statistics for the groups in keys."""
+    query = """
+        SELECT s.unit, s.device_id, s.location_code, s.sample_count, s.mean_value, s.m2
+        FROM anomaly_running_stats s
+        JOIN unnest(%s::text[], %s::text[], %s::text[]) AS k(unit, device_id, location_code)
+        USING (unit, device_id, location_code)
+    """
+    params = tuple(keys[c].astype(str).tolist() for c in STATS_KEY_COLUMNS)
+    return pd.read_sql_query(query, conn, params=params)
+
+def save_incremental_state(cur, stats, high_water_mark):
+    """Writes the running statistics and the high-water mark with one cursor (one transaction)."""
+    execute_values(
+        cur,
+        """
+        INSERT INTO anomaly_running_stats (unit, device_id, location_code, sample_count, mean_value, m2)
+        VALUES %s
+        ON CONFLICT (unit, device_id, location_code) DO UPDATE
+        SET sample_count = EXCLUDED.sample_count,
+            mean_value = EXCLUDED.mean_value,
+            m2 = EXCLUDED.m2,
+            updated_at = NOW()
+        """,
+        list(stats[STATS_KEY_COLUMNS + ['sample_count', 'mean_value', 'm2']].itertuples(index=False, name=None)),
+        page_size=1000
+    )
+    cur.execute(
+        """
+        INSERT INTO anomaly_detector_state (detector_name, high_water_mark)
+        VALUES (%s, %s)
+        ON CONFLICT (detector_name) DO UPDATE
+        SET high_water_mark = EXCLUDED.high_water_mark, updated_at = NOW()
+        """,
+        (INCREMENTAL_DETECTOR_NAME, high_water_mark)
+    )
+
+def run_incremental_detection(conn):
+    """
+    Scores only the rows that arrived since the last run against persisted
+    per-group running statistics, then folds the batch's non-anomalous rows
+    into those statistics. Flags are applied first through the chunked
+    flag_anomalies path; the statistics and the high-water mark are committed
+    together once every chunk is in. Flagged rows are no longer 'OK', so a
+    rerun after a failure does not score or fold them again. Returns the
+    number of rows flagged.
+    """
+    high_water_mark = load_high_water_mark(conn)
+    batch = fetch_exposures_since(conn, high_water_mark)
+    if batch.empty:
+        conn.rollback()
+        logger.info("No new records since the last run.")
+        return 0
+
+    prior = load_running_stats(conn, batch[STATS_KEY_COLUMNS].drop_duplicates())
+    # Score against the statistics including this batch, so new groups can be scored...
+    anomalies = score_against_stats(batch, merge_running_stats(prior, summarize_batch(batch)))
+    # ...but only fold inliers into the persisted statistics so outliers do not mask later ones.
+    inliers = batch[~batch['sample_id'].isin(anomalies['sample_id'])]
+    updated = merge_running_stats(prior, summarize_batch(inliers)) if not inliers.empty else prior
+
+    anomaly_ids = [str(i) for i in anomalies['sample_id']]
+    try:
+        if anomaly_ids:
+            _apply_flags(conn, anomaly_ids, anomalies['timestamp_utc'])
+        with conn.cursor() as cur:
+            save_incremental_state(cur, updated, batch['timestamp_utc'].max())
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Failed to save incremental detection state: {e}")
+        conn.rollback()
+        return 0
+
+    logger.info(f"Scored {len(batch)} new records; flagged {len(anomaly_ids)} as 'PENDING'.")
+    return len(anomaly_ids)
+
+PARTITION_COLUMNS = {'unit': 'unit', 'device': 'device_id'}
+
+def plan_partitions(conn, window_start, window_end, partition_by, detectors, workers):
+    """
+    Returns the list of partitions to scan. A partition is ('unit', value) or
+    ('device', (bucket, bucket_count)). Every detector must group by the
+    partition column, otherwise its groups would be split across workers.
+    """
+    if partition_by not in PARTITION_COLUMNS:
+        raise ValueError(f"PARALLEL_PARTITION_BY must be one of: {', '.join(PARTITION_COLUMNS)}")
+    column = PARTITION_COLUMNS[partition_by]
+    incompatible = [d.name for d in detectors if column not in d.group_columns]
+    if incompatible:
+        raise ValueError(f"Detector(s) {', '.join(incompatible)} do not group by {column}; partition by another key.")
+
+    if partition_by == 'device':
+        bucket_count = PARALLEL_PARTITIONS or workers * 4
+        return [('device', (bucket, bucket_count)) for bucket in range(bucket_count)]
+
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT DISTINCT unit FROM exposures WHERE timestamp_utc >= %s AND timestamp_utc < %s AND qualifier = 'OK'",
+            (window_start, window_end)
+        )
+        units = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    return [('unit', unit) for unit in units]
+
+def detect_partition(partition, window_start, window_end, detector_names):
+    """
+    Worker entry point: streams one partition through a server-side cursor, runs
+    the detectors over it and returns only the flagged (sample_id, timestamp_utc) pairs.
+    """
+    kind, key = partition
+    if kind == 'unit':
+        condition, params = "unit = %s", (key,)
+    else:
+        bucket, bucket_count = key
+        # hashtext() is a signed int4; shift it to non-negative before taking the modulus.
+        condition = "mod(hashtext(coalesce(device_id, ''))::bigint + 2147483648, %s) = %s"
+        params = (bucket_count, bucket)
+
     conn = get_db_connection()
+    if not conn:
+        raise RuntimeError(f"Worker could not connect to the database for partition {partition}.")
+    try:
+        frames = []
+        with conn.cursor(name=f"anomaly_partition_{os.getpid()}") as cur:
+            cur.itersize = FETCH_BATCH_ROWS
+            cur.execute(
+                f"""
+                SELECT sample_id, device_id, location_code, timestamp_utc, value, unit
+                FROM exposures
+                WHERE timestamp_utc >= %s AND timestamp_utc < %s
+                AND qualifier = 'OK'
+                AND {condition}
+                """,
+                (window_start, window_end, *params)
+            )
+            columns = None
+            while True:
+                rows = cur.fetchmany(FETCH_BATCH_ROWS)
+                if not rows:
+                    break
+                columns = columns or [c[0] for c in cur.description]
+                frames.append(pd.DataFrame.from_records(rows, columns=columns))
+        if not frames:
+            return []
+        df = pd.concat(frames, ignore_index=True)
+        mask, _ = run_detectors(df, build_detectors(detector_names))
+        flagged = df.loc[mask]
+        return list(zip(flagged['sample_id'].astype(str), flagged['timestamp_utc']))
+    finally:
+        conn.close()
+
+def run_parallel_detection(conn, window_start, window_end, workers, partition_by=None, detector_names=None):
+    """
+    Partitions the window by unit or device hash across a process pool. Each
+    worker reads its own partition; the flagged ids are merged and flagged with
+    one call to flag_anomalies. Returns the number of anomalies found.
+
+    Workers are spawned rather than forked: the job scheduler calls this from
+    one of its threads, and a forked child can inherit a lock (logging, the
+    connection pool) held by another thread and deadlock.
+    """
+    partition_by = partition_by or PARALLEL_PARTITION_BY
+    detector_names = detector_names or ANOMALY_DETECTORS
+    partitions = plan_partitions(conn, window_start, window_end, partition_by, build_detectors(detector_names), workers)
+    logger.info(f"Scanning {len(partitions)} partitions by {partition_by} with {workers} worker processes.")
+
+    flagged = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {
+            pool.submit(detect_partition, partition, window_start, window_end, detector_names): partition
+            for partition in partitions
+        }
+        for future, partition in futures.items():
+            pairs = future.result()
+            if pairs:
+                logger.warning(f"Found {len(pairs)} anomalies in partition {partition}.")
+            flagged.extend(pairs)
+
+    if flagged:
+        anomaly_ids, timestamps = zip(*flagged)
+        flag_anomalies(conn, list(anomaly_ids), list(timestamps))
+    else:
+        logger.info("No anomalies found in this run.")
+    return len(flagged)
+
+def resolve_window(conn, start=None, end=None):
+    """Returns (start, end) of the detection window; defaults to the last LOOKBACK_HOURS."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT COALESCE(%s::timestamptz, NOW() - make_interval(hours => %s)), COALESCE(%s::timestamptz, NOW())",
+            (start, LOOKBACK_HOURS, end)
+        )
+        window = cur.fetchone()
+    conn.rollback()
+    return window
+
+def run_anomaly_detection(start=None, end=None, workers=None, conn=None):
+    """
+    Main function to run the anomaly detection process. start/end select an
+    explicit (e.g. backfill) window, which is scanned with the partitioned mode.
+    A caller-supplied conn (e.g. from the job scheduler's pool) is left open.
+    """
+    logger.info("Starting anomaly detection process...")
+    workers = PARALLEL_WORKERS if workers is None else workers
+    owns_conn = conn is None
+    conn = conn or get_db_connection()
     if not conn:
         return
 
     try:
+        if ANOMALY_MODE == 'dataframe' and (workers > 1 or start or end):
+            window_start, window_end = resolve_window(conn, start, end)
+            run_parallel_detection(conn, window_start, window_end, max(workers, 1))
+            return
+
+        if ANOMALY_MODE == 'database':
+            flagged = flag_anomalies_in_database(conn)
+            if not flagged:
+                logger.info("No anomalies found in this run.")
+            return
+        if ANOMALY_MODE == 'incremental':
+            run_incremental_detection(conn)
+            return
+
         df = fetch_recent_exposures(conn)
         if df.empty:
             logger.info("No new records to process.")
             return
 
-        # Group by metric unit to analyze similar measurements together
-        grouped = df.groupby('unit')
-        all_anomaly_ids = []
-
-        for unit, group in grouped:
-            if len(group) < 2:
-                # Need at least 2 data points to calculate standard deviation
-                continue
-
-            mean_val = group['value'].mean()
-            std_dev = group['value'].std()
-
-            # Avoid division by zero if all values in the group are the same
-            if std_dev == 0:
-                continue
-
-            # Calculate Z-score for each record in the group
-            z_scores = group['value'].apply(lambda x: abs((x - mean_val) / std_dev))
-            
-            # Identify anomalies
-            anomalies = group[z_scores > Z_SCORE_THRESHOLD]
-            
-            if not anomalies.empty:
-                logger.warning(f"Found {len(anomalies)} anomalies for unit '{unit}'.")
-                all_anomaly_ids.extend(anomalies['sample_id'].tolist())
+        mask, counts = run_detectors(df, build_detectors())
+        for name, count in counts.items():
+            logger.info(f"Detector '{name}' flagged {count} records.")
+        anomalies = df[mask]
+        for unit, count in anomalies['unit'].value_counts().items():
+            logger.warning(f"Found {count} anomalies for unit '{unit}'.")
+        all_anomaly_ids = anomalies['sample_id'].tolist()
 
         if all_anomaly_ids:
-            flag_anomalies(conn, all_anomaly_ids)
+            timestamps = anomalies['timestamp_utc'].tolist() if 'timestamp_utc' in anomalies else None
+            flag_anomalies(conn, all_anomaly_ids, timestamps)
         else:
             logger.info("No anomalies found in this run.")
 
     finally:
-        if conn:
+        if conn and owns_conn:
             conn.close()
             logger.info("Database connection closed.")
     
     logger.info("Anomaly detection process finished.")
 
 if __name__ == "__main__":
-    run_anomaly_detection()
+    arg_parser = argparse.ArgumentParser(description="Flag anomalous exposure readings.")
+    arg_parser.add_argument('--start', help="Window start (ISO timestamp) for a parallel backfill; defaults to now - LOOKBACK_HOURS.")
+    arg_parser.add_argument('--end', help="Window end (ISO timestamp) for a parallel backfill; defaults to now.")
+    arg_parser.add_argument('--workers', type=int, help="Worker processes; overrides PARALLEL_WORKERS.")
+    args = arg_parser.parse_args()
+    run_anomaly_detection(start=args.start, end=args.end, workers=args.workers)
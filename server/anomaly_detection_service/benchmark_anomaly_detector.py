@@ -0,0 +1,105 @@
+"""
+Benchmarks the anomaly detection pass on synthetic exposure data.
+
+    python benchmark_anomaly_detector.py --rows 100000 1000000 10000000 30000000
+    python benchmark_anomaly_detector.py --rows 1000000 --detectors zscore mad rolling seasonal
+
+The legacy per-row implementation is only timed up to --legacy-max-rows.
+No database connection is needed.
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from anomaly_detector import find_anomalies, build_detectors
+
+UNITS = np.array(['dBA', 'mrem', 'µg/m³', '°C', 'mg/L'], dtype=object)
+
+
+def make_exposures(rows, devices, locations, anomaly_rate=0.0005, seed=42):
+    """Builds a synthetic exposures frame with a known set of injected outliers."""
+    rng = np.random.default_rng(seed)
+    device_codes = rng.integers(0, devices, rows)
+    location_codes = rng.integers(0, locations, rows)
+    unit_codes = device_codes % len(UNITS)
+    baseline = 20.0 + (device_codes % 50) * 2.0
+    values = rng.normal(baseline, 1.0 + (location_codes % 3))
+    outliers = rng.random(rows) < anomaly_rate
+    values[outliers] += 40.0
+    return pd.DataFrame({
+        'sample_id': np.arange(rows),
+        'timestamp_utc': pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(np.sort(rng.integers(0, 86400 * 30, rows)), unit='s'),
+        'device_id': pd.Categorical.from_codes(device_codes, [f'dev-{i}' for i in range(devices)]),
+        'location_code': pd.Categorical.from_codes(location_codes, [f'loc-{i}' for i in range(locations)]),
+        'unit': pd.Categorical(UNITS[unit_codes]),
+        'value': values,
+    }), outliers
+
+
+def legacy_detection(df, threshold=3.0):
+    """The original implementation: a Python loop over units and a per-row lambda."""
+    ids = []
+    for _, group in df.groupby('unit', observed=True):
+        if len(group) < 2:
+            continue
+        mean_val = group['value'].mean()
+        std_dev = group['value'].std()
+        if std_dev == 0:
+            continue
+        z_scores = group['value'].apply(lambda x: abs((x - mean_val) / std_dev))
+        ids.extend(group[z_scores > threshold]['sample_id'].tolist())
+    return ids
+
+
+def benchmark_detectors(args):
+    """Times each detection engine on the same batch and reports precision/recall against the injected outliers."""
+    detectors = build_detectors(args.detectors)
+    print(f"{'rows':>12} {'detector':>10} {'seconds':>9} {'rows/s':>14} {'flagged':>9} {'precision':>10} {'recall':>8}")
+    for rows in args.rows:
+        df, truth = make_exposures(rows, args.devices, args.locations)
+        for detector in detectors:
+            start = time.perf_counter()
+            mask = detector.detect(df)
+            elapsed = time.perf_counter() - start
+            flagged = int(mask.sum())
+            hits = int((mask & truth).sum())
+            precision = hits / flagged if flagged else 1.0
+            recall = hits / truth.sum() if truth.sum() else 1.0
+            print(f"{rows:>12,} {detector.name:>10} {elapsed:>9.2f} {rows / elapsed:>14,.0f} {flagged:>9,} {precision:>10.3f} {recall:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000, 1_000_000, 10_000_000])
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--locations', type=int, default=20)
+    parser.add_argument('--legacy-max-rows', type=int, default=1_000_000)
+    parser.add_argument('--detectors', nargs='+', help="Time these detection engines instead of the z-score comparison.")
+    args = parser.parse_args()
+
+    if args.detectors:
+        benchmark_detectors(args)
+        return
+
+    print(f"{'rows':>12} {'groups':>8} {'vectorized s':>13} {'rows/s':>14} {'legacy s':>10} {'flagged':>9}")
+    for rows in args.rows:
+        df, _ = make_exposures(rows, args.devices, args.locations)
+        groups = df.groupby(['unit', 'device_id', 'location_code'], observed=True).ngroups
+
+        start = time.perf_counter()
+        anomalies = find_anomalies(df, group_columns=['unit', 'device_id', 'location_code'], threshold=3.0)
+        vectorized = time.perf_counter() - start
+
+        legacy = '-'
+        if rows <= args.legacy_max_rows:
+            start = time.perf_counter()
+            legacy_detection(df)
+            legacy = f"{time.perf_counter() - start:.2f}"
+
+        print(f"{rows:>12,} {groups:>8,} {vectorized:>13.2f} {rows / vectorized:>14,.0f} {legacy:>10} {len(anomalies):>9,}")
+
+
+if __name__ == '__main__':
+    main()
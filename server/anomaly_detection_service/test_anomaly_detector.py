@@ -1,7 +1,15 @@
 import pytest
+import numpy as np
 import pandas as pd
 from unittest.mock import MagicMock, patch
-from anomaly_detector import run_anomaly_detection, flag_anomalies, fetch_recent_exposures
+from anomaly_detector import (
+    run_anomaly_detection, flag_anomalies, fetch_recent_exposures, find_anomalies, flag_anomalies_in_database,
+    summarize_batch, merge_running_stats, run_incremental_detection,
+    ZScoreDetector, MedianMADDetector, RollingZScoreDetector, SeasonalHourDetector, build_detectors, run_detectors,
+    plan_partitions, detect_partition, run_parallel_detection
+)
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2.errors
 
 @pytest.fixture
 def mock_db_connection(mocker):
@@ -16,7 +24,9 @@ def sample_data():
     data = {
         'sample_id': [f'id_{i}' for i in range(11)],
         'value': [10, 11, 10, 9, 12, 10, 11, 9, 10, 11, 100], # 100 is the anomaly
-        'unit': ['dBA'] * 11
+        'unit': ['dBA'] * 11,
+        'device_id': ['dev-1'] * 11,
+        'location_code': ['loc-1'] * 11
     }
     return pd.DataFrame(data)
 
@@ -47,7 +57,9 @@ def test_anomaly_detection_no_outliers(mock_db_connection, mocker):
     no_outlier_data = pd.DataFrame({
         'sample_id': [f'id_{i}' for i in range(10)],
         'value': [10, 11, 10, 9, 12, 10, 11, 9, 10, 11],
-        'unit': ['dBA'] * 10
+        'unit': ['dBA'] * 10,
+        'device_id': ['dev-1'] * 10,
+        'location_code': ['loc-1'] * 10
     })
     mocker.patch('anomaly_detector.fetch_recent_exposures', return_value=no_outlier_data)
     mock_flag_anomalies = mocker.patch('anomaly_detector.flag_anomalies')
@@ -56,3 +68,354 @@ def test_anomaly_detection_no_outliers(mock_db_connection, mocker):
 
     # Verify that flag_anomalies was not called
     mock_flag_anomalies.assert_not_called()
+
+def test_find_anomalies_groups_by_device_and_location():
+    """Readings are only compared with readings from the same unit, device and location."""
+    quiet = [10, 11, 10, 9, 12, 10, 11, 9, 10, 11]
+    loud = [90, 91, 90, 89, 92, 90, 91, 89, 90, 91]
+    df = pd.DataFrame({
+        'sample_id': [f'id_{i}' for i in range(21)],
+        'value': quiet + loud + [100],
+        'unit': ['dBA'] * 21,
+        'device_id': ['dev-1'] * 10 + ['dev-2'] * 10 + ['dev-1'],
+        'location_code': ['loc-1'] * 21,
+    })
+
+    anomalies = find_anomalies(df, threshold=2.5)
+
+    # 100 is normal for dev-2 but an outlier for dev-1; dev-2's readings are not flagged.
+    assert anomalies['sample_id'].tolist() == ['id_20']
+
+def test_find_anomalies_matches_per_group_reference():
+    """The vectorized pass gives the same result as computing each group separately."""
+    rng = np.random.default_rng(7)
+    n = 5000
+    df = pd.DataFrame({
+        'sample_id': np.arange(n),
+        'value': rng.normal(50, 5, n),
+        'unit': rng.choice(['dBA', 'mrem', 'µg/m³'], n),
+        'device_id': rng.choice(['d1', 'd2', 'd3', None], n),
+        'location_code': rng.choice(['l1', 'l2'], n),
+    })
+    df.loc[rng.choice(n, 20, replace=False), 'value'] = 500.0
+
+    expected = []
+    for _, group in df.groupby(['unit', 'device_id', 'location_code'], dropna=False):
+        std = group['value'].std()
+        if len(group) < 2 or std == 0:
+            continue
+        z = ((group['value'] - group['value'].mean()) / std).abs()
+        expected.extend(group.loc[z > 3.0, 'sample_id'])
+
+    result = find_anomalies(df, threshold=3.0)
+
+    assert sorted(result['sample_id']) == sorted(expected)
+    assert len(expected) >= 20
+
+def test_find_anomalies_skips_single_row_and_constant_groups():
+    """Groups without variance cannot produce z-scores."""
+    df = pd.DataFrame({
+        'sample_id': ['a', 'b', 'c', 'd'],
+        'value': [5, 5, 5, 1000],
+        'unit': ['dBA', 'dBA', 'dBA', 'mrem'],
+        'device_id': ['d1'] * 4,
+        'location_code': ['l1'] * 4,
+    })
+
+    assert find_anomalies(df).empty
+
+def test_database_mode_flags_without_fetching_rows(mock_db_connection, mocker):
+    """In database mode the statistics and the UPDATE run server-side."""
+    mocker.patch('anomaly_detector.ANOMALY_MODE', 'database')
+    mock_fetch = mocker.patch('anomaly_detector.fetch_recent_exposures')
+    mock_cur = mock_db_connection.cursor.return_value.__enter__.return_value
+    mock_cur.rowcount = 3
+
+    run_anomaly_detection()
+
+    mock_fetch.assert_not_called()
+    mock_cur.execute.assert_called_once()
+    query, params = mock_cur.execute.call_args[0]
+    assert "STDDEV_SAMP(value)" in query
+    assert "UPDATE exposures e" in query
+    assert "COALESCE(e.device_id, '') = s.device_id" in query
+    assert "IS NOT DISTINCT FROM" not in query
+    assert params['threshold'] == 3.0
+    mock_db_connection.commit.assert_called_once()
+
+def test_database_mode_rejects_unknown_group_column():
+    """Group columns are interpolated into SQL, so only known columns are accepted."""
+    with pytest.raises(ValueError):
+        flag_anomalies_in_database(MagicMock(), group_columns=['unit; DROP TABLE exposures'])
+
+def test_merge_running_stats_matches_single_pass():
+    """Merging the moments of two batches equals computing them over both at once."""
+    rng = np.random.default_rng(3)
+    df = pd.DataFrame({
+        'value': rng.normal(60, 8, 400),
+        'unit': rng.choice(['dBA', 'mrem'], 400),
+        'device_id': rng.choice(['d1', 'd2', 'd3'], 400),
+        'location_code': 'l1',
+    })
+    first, second = df.iloc[:150], df.iloc[150:]
+
+    merged = merge_running_stats(summarize_batch(first), summarize_batch(second))
+    expected = summarize_batch(df)
+
+    merged = merged.sort_values(['unit', 'device_id']).reset_index(drop=True)
+    expected = expected.sort_values(['unit', 'device_id']).reset_index(drop=True)
+    assert merged['sample_count'].tolist() == expected['sample_count'].tolist()
+    assert np.allclose(merged['mean_value'], expected['mean_value'])
+    assert np.allclose(merged['m2'], expected['m2'])
+
+def test_incremental_detection_scores_new_rows_against_running_stats(mocker):
+    """Only new rows are scored, and the outlier is excluded from the persisted statistics."""
+    history = pd.DataFrame({
+        'value': [10, 11, 10, 9, 12, 10, 11, 9, 10, 11] * 10,
+        'unit': 'dBA', 'device_id': 'dev-1', 'location_code': 'loc-1',
+    })
+    prior = summarize_batch(history)
+    batch = pd.DataFrame({
+        'sample_id': ['new_0', 'new_1', 'new_2'],
+        'value': [10.0, 11.0, 40.0],
+        'unit': 'dBA', 'device_id': 'dev-1', 'location_code': 'loc-1',
+        'timestamp_utc': pd.to_datetime(['2024-01-01 00:00', '2024-01-01 00:01', '2024-01-01 00:02'], utc=True),
+    })
+    mocker.patch('anomaly_detector.load_high_water_mark', return_value=pd.Timestamp('2023-12-31', tz='UTC'))
+    mocker.patch('anomaly_detector.fetch_exposures_since', return_value=batch)
+    mocker.patch('anomaly_detector.load_running_stats', return_value=prior)
+    mock_flags = mocker.patch('anomaly_detector._apply_flags', return_value=1)
+    mock_save = mocker.patch('anomaly_detector.save_incremental_state')
+    conn = MagicMock()
+
+    flagged = run_incremental_detection(conn)
+
+    assert flagged == 1
+    _, anomaly_ids, timestamps = mock_flags.call_args[0]
+    assert anomaly_ids == ['new_2']
+    assert list(timestamps) == [batch['timestamp_utc'].iloc[2]]
+    _, saved_stats, high_water_mark = mock_save.call_args[0]
+    assert saved_stats['sample_count'].tolist() == [102]
+    assert high_water_mark == batch['timestamp_utc'].max()
+    conn.commit.assert_called_once()
+
+def test_incremental_detection_flags_in_chunks_before_saving_state(mocker):
+    """Flags go through the COPY-staged, chunked path; the state is not saved if a chunk fails."""
+    batch = pd.DataFrame({
+        'sample_id': [f'00000000-0000-0000-0000-00000000000{i}' for i in range(4)],
+        'value': [10.0, 11.0, 10.0, 40.0],
+        'unit': 'dBA', 'device_id': 'dev-1', 'location_code': 'loc-1',
+        'timestamp_utc': pd.date_range('2024-01-01', periods=4, freq='min', tz='UTC'),
+    })
+    history = pd.DataFrame({'value': [10, 11, 10, 9, 12] * 20, 'unit': 'dBA', 'device_id': 'dev-1', 'location_code': 'loc-1'})
+    mocker.patch('anomaly_detector.load_high_water_mark', return_value=None)
+    mocker.patch('anomaly_detector.fetch_exposures_since', return_value=batch)
+    mocker.patch('anomaly_detector.load_running_stats', return_value=summarize_batch(history))
+    mocker.patch('anomaly_detector.FLAG_MAX_RETRIES', 0)
+    mock_save = mocker.patch('anomaly_detector.save_incremental_state')
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.rowcount = 1
+
+    assert run_incremental_detection(conn) == 1
+    cur.copy_expert.assert_called_once()
+    assert not any('ANY(' in c[0][0] for c in cur.execute.call_args_list)
+    mock_save.assert_called_once()
+
+    mock_save.reset_mock()
+    def execute(query, params=None):
+        if 'UPDATE exposures' in query:
+            raise psycopg2.errors.LockNotAvailable()
+    cur.execute.side_effect = execute
+
+    assert run_incremental_detection(conn) == 0
+    mock_save.assert_not_called()
+
+# --- Detector precision fixtures ---
+
+def precision_recall(mask, truth):
+    flagged = mask.sum()
+    hits = (mask & truth).sum()
+    return (hits / flagged if flagged else 1.0), hits / truth.sum()
+
+@pytest.fixture
+def masking_cluster():
+    """A group where several extreme readings inflate the standard deviation enough to hide each other."""
+    rng = np.random.default_rng(11)
+    values = np.concatenate([rng.normal(50, 1, 60), np.linspace(400, 450, 10)])
+    truth = np.zeros(len(values), dtype=bool)
+    truth[60:] = True
+    df = pd.DataFrame({
+        'sample_id': [f'id_{i}' for i in range(len(values))],
+        'value': values, 'unit': 'dBA', 'device_id': 'dev-1', 'location_code': 'loc-1',
+    })
+    return df, truth
+
+@pytest.fixture
+def day_night_pattern():
+    """Readings around 85 dBA during the working day and 55 dBA at night, with two out-of-pattern readings."""
+    rng = np.random.default_rng(5)
+    timestamps = pd.date_range('2024-01-01', periods=24 * 14, freq='h', tz='UTC')
+    daytime = (timestamps.hour >= 8) & (timestamps.hour < 18)
+    values = np.where(daytime, 85.0, 55.0) + rng.normal(0, 1, len(timestamps))
+    truth = np.zeros(len(values), dtype=bool)
+    for i in (3 + 24 * 5, 2 + 24 * 9):  # 03:00 and 02:00, daytime levels at night
+        values[i] = 85.0
+        truth[i] = True
+    df = pd.DataFrame({
+        'sample_id': [f'id_{i}' for i in range(len(values))],
+        'timestamp_utc': timestamps, 'value': values,
+        'unit': 'dBA', 'device_id': 'dev-1', 'location_code': 'engine-room',
+    })
+    return df, truth
+
+@pytest.fixture
+def drifting_sensor():
+    """A slowly rising series with local spikes that stay inside the overall range."""
+    rng = np.random.default_rng(9)
+    n = 500
+    values = np.linspace(20, 50, n) + rng.normal(0, 0.2, n)
+    truth = np.zeros(n, dtype=bool)
+    for i in (100, 250, 400):
+        values[i] += 10
+        truth[i] = True
+    df = pd.DataFrame({
+        'sample_id': [f'id_{i}' for i in range(n)],
+        'timestamp_utc': pd.date_range('2024-01-01', periods=n, freq='min', tz='UTC'),
+        'value': values, 'unit': '°C', 'device_id': 'dev-7', 'location_code': 'deck-2',
+    })
+    # Detectors must not depend on the input order.
+    shuffled = df.sample(frac=1, random_state=1)
+    return shuffled.reset_index(drop=True), truth[shuffled.index.to_numpy()]
+
+def test_mad_detector_is_not_masked_by_outlier_cluster(masking_cluster):
+    df, truth = masking_cluster
+
+    zscore_precision, zscore_recall = precision_recall(ZScoreDetector().detect(df), truth)
+    mad_precision, mad_recall = precision_recall(MedianMADDetector().detect(df), truth)
+
+    assert zscore_recall < 0.5  # The cluster hides itself from the plain z-score
+    assert mad_precision == 1.0 and mad_recall == 1.0
+
+def test_seasonal_detector_uses_hour_of_day_baseline(day_night_pattern):
+    df, truth = day_night_pattern
+
+    _, zscore_recall = precision_recall(ZScoreDetector().detect(df), truth)
+    precision, recall = precision_recall(SeasonalHourDetector().detect(df), truth)
+
+    assert zscore_recall == 0.0  # 85 dBA is normal for this device overall
+    assert precision == 1.0 and recall == 1.0
+
+def test_rolling_detector_follows_drift(drifting_sensor):
+    df, truth = drifting_sensor
+
+    _, zscore_recall = precision_recall(ZScoreDetector().detect(df), truth)
+    precision, recall = precision_recall(RollingZScoreDetector().detect(df), truth)
+
+    assert zscore_recall == 0.0
+    assert precision >= 0.75 and recall == 1.0
+
+def test_run_detectors_unions_engines_in_one_pass(day_night_pattern):
+    df, truth = day_night_pattern
+
+    mask, counts = run_detectors(df, build_detectors(['zscore', 'mad', 'rolling', 'seasonal']))
+
+    assert set(counts) == {'zscore', 'mad', 'rolling', 'seasonal'}
+    assert mask.dtype == bool and len(mask) == len(df)
+    assert mask[truth].all()
+
+def test_build_detectors_rejects_unknown_engine():
+    with pytest.raises(ValueError):
+        build_detectors(['zscore', 'bogus'])
+
+# --- Parallel partitioned detection ---
+
+def test_plan_partitions_rejects_device_split_for_seasonal_detector():
+    """The seasonal baseline spans devices, so device-hash partitions would split its groups."""
+    with pytest.raises(ValueError):
+        plan_partitions(MagicMock(), 's', 'e', 'device', build_detectors(['zscore', 'seasonal']), workers=2)
+
+def test_plan_partitions_by_device_hash():
+    partitions = plan_partitions(MagicMock(), 's', 'e', 'device', build_detectors(['zscore', 'rolling']), workers=2)
+
+    assert partitions == [('device', (i, 8)) for i in range(8)]
+
+def test_detect_partition_streams_rows_and_returns_flagged_ids(mocker, sample_data):
+    """A worker reads its partition through a named cursor in batches and returns only flagged ids."""
+    conn = MagicMock()
+    mocker.patch('anomaly_detector.get_db_connection', return_value=conn)
+    cur = conn.cursor.return_value.__enter__.return_value
+    sample_data['timestamp_utc'] = pd.date_range('2024-01-01', periods=11, freq='h', tz='UTC')
+    columns = ['sample_id', 'device_id', 'location_code', 'timestamp_utc', 'value', 'unit']
+    rows = list(sample_data[columns].itertuples(index=False, name=None))
+    cur.fetchmany.side_effect = [rows[:6], rows[6:], []]
+    cur.description = [(c,) for c in columns]
+
+    flagged = detect_partition(('unit', 'dBA'), 's', 'e', ['zscore'])
+
+    assert flagged == [('id_10', sample_data['timestamp_utc'].iloc[10])]
+    assert 'name' in conn.cursor.call_args.kwargs  # server-side cursor
+    assert cur.execute.call_args[0][1] == ('s', 'e', 'dBA')
+    conn.close.assert_called_once()
+
+def test_run_parallel_detection_merges_partitions_into_one_flag_call(mocker):
+    pool = mocker.patch('anomaly_detector.ProcessPoolExecutor', side_effect=lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+    mocker.patch('anomaly_detector.plan_partitions', return_value=[('unit', 'dBA'), ('unit', 'mrem')])
+    mocker.patch('anomaly_detector.detect_partition', side_effect=lambda p, *a: [(f"{p[1]}-1", 't1'), (f"{p[1]}-2", 't2')])
+    mock_flag = mocker.patch('anomaly_detector.flag_anomalies')
+    conn = MagicMock()
+
+    found = run_parallel_detection(conn, 's', 'e', workers=2, partition_by='unit', detector_names=['zscore'])
+
+    assert found == 4
+    mock_flag.assert_called_once()
+    assert sorted(mock_flag.call_args[0][1]) == ['dBA-1', 'dBA-2', 'mrem-1', 'mrem-2']
+    assert len(mock_flag.call_args[0][2]) == 4  # timestamps travel with the ids
+    # Spawned, not forked: the scheduler runs this from a worker thread.
+    assert pool.call_args.kwargs['mp_context'].get_start_method() == 'spawn'
+
+# --- Chunked flagging ---
+
+def test_flag_anomalies_applies_staged_ids_in_time_bounded_chunks(mocker):
+    """Ids are COPY-staged once and applied in small, separately committed, time-bounded chunks."""
+    mocker.patch('anomaly_detector.FLAG_CHUNK_ROWS', 2)
+    mocker.patch('anomaly_detector.time.sleep')
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.rowcount = 2
+    ids = [f'00000000-0000-0000-0000-00000000000{i}' for i in range(5)]
+    timestamps = pd.date_range('2024-01-01', periods=5, freq='D', tz='UTC')[::-1]
+
+    flagged = flag_anomalies(conn, ids, list(timestamps))
+
+    assert flagged == 6
+    cur.copy_expert.assert_called_once()
+    updates = [c for c in cur.execute.call_args_list if 'UPDATE exposures' in c[0][0]]
+    assert len(updates) == 3
+    # Staged rows are sorted by time, so the first chunk covers the two oldest readings.
+    lo, hi, start, end = updates[0][0][1]
+    assert (lo, hi) == (0, 1)
+    assert start == timestamps[4].to_pydatetime() and end == timestamps[3].to_pydatetime()
+    assert conn.commit.call_count == 4  # staging + one per chunk
+
+def test_flag_anomalies_retries_a_chunk_on_lock_timeout(mocker):
+    mocker.patch('anomaly_detector.time.sleep')
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.rowcount = 1
+    locked = iter([True])
+    def execute(query, params=None):
+        if 'UPDATE exposures' in query and next(locked, False):
+            raise psycopg2.errors.LockNotAvailable()
+    cur.execute.side_effect = execute
+
+    assert flag_anomalies(conn, ['00000000-0000-0000-0000-000000000001']) == 1
+    conn.rollback.assert_called_once()
+
+def test_flag_anomalies_makes_one_attempt_when_retries_are_disabled(mocker):
+    mocker.patch('anomaly_detector.FLAG_MAX_RETRIES', 0)
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.rowcount = 1
+
+    assert flag_anomalies(conn, ['00000000-0000-0000-0000-000000000001']) == 1
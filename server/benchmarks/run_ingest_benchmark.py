@@ -0,0 +1,376 @@
+"""
+End-to-end ingest benchmark. Loads deterministic synthetic readings through
+each ingest entry point into a local Postgres, then runs anomaly detection
+and retention over the loaded data, and prints rows/s and latency per stage.
+
+    python run_ingest_benchmark.py --rows 20000
+    python run_ingest_benchmark.py --rows 200000 --devices 500 --stages sftp csv kafka --json 10x.json
+
+Stages, in order:
+    grpc       UploadNoiseData calls against an in-process gRPC server (latency per call)
+    sftp       SFTP loader over a local-directory stand-in for the SFTP server (latency per file)
+    csv        CSV poller database sink (latency per file)
+    mqtt       MQTT bridge on_message with an in-memory Kafka producer (latency per message)
+    kafka      Kafka sink load_batch over the messages the bridge produced (latency per batch)
+    anomaly    run_anomaly_detection over the LOOKBACK_HOURS window (one run)
+    retention  run_retention_manager; --expired-fraction of the readings are old enough to purge (one run)
+
+Use a disposable database with the exposure migrations applied, configured
+through DB_* in this directory's .env. Every stage writes to it, the anomaly
+stage rewrites qualifiers and the retention stage deletes data, so those two
+only run when DB_NAME ends in "-bench" or --i-know-this-deletes-data is given.
+Each service still reads its other settings from the .env file in its own
+directory.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+from dotenv import load_dotenv
+
+import synthetic_exposures
+from synthetic_exposures import DOMAINS
+
+load_dotenv()
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVER_DIR, 'shared'))
+from db_pool import ConnectionManager, connect
+
+DB_SETTINGS = dict(
+    host=os.getenv("DB_HOST"), port=os.getenv("DB_PORT"), dbname=os.getenv("DB_NAME"),
+    user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD")
+)
+
+STAGES = ['grpc', 'sftp', 'csv', 'mqtt', 'kafka', 'anomaly', 'retention']
+# Stages that change or delete rows that were already in the database.
+DESTRUCTIVE_STAGES = ['anomaly', 'retention']
+BENCH_DB_SUFFIX = '-bench'
+
+
+def load_service(directory, module, alias):
+    """Imports server/<directory>/<module>.py under alias; several services name their entry point main.py."""
+    path = os.path.join(SERVER_DIR, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(alias, os.path.join(path, f"{module}.py"))
+    service = importlib.util.module_from_spec(spec)
+    sys.modules[alias] = service
+    spec.loader.exec_module(service)
+    return service
+
+
+class StageResult:
+    """Rows, wall time and per-operation latencies for one stage."""
+
+    def __init__(self, stage, rows, seconds, latencies=(), unit='run'):
+        self.stage = stage
+        self.rows = rows
+        self.seconds = seconds
+        self.latencies = np.asarray(latencies if len(latencies) else [seconds]) * 1000
+        self.unit = unit
+
+    def as_dict(self):
+        return {
+            'stage': self.stage, 'rows': self.rows, 'seconds': round(self.seconds, 3),
+            'rows_per_second': round(self.rows / self.seconds, 1) if self.seconds else None,
+            'latency_unit': self.unit,
+            'p50_ms': round(float(np.percentile(self.latencies, 50)), 2),
+            'p95_ms': round(float(np.percentile(self.latencies, 95)), 2),
+            'max_ms': round(float(self.latencies.max()), 2),
+        }
+
+
+def refused_stages(stages, db_name, confirmed=False):
+    """Returns the destructive stages that must not run against db_name."""
+    if confirmed or (db_name or '').endswith(BENCH_DB_SUFFIX):
+        return []
+    return [stage for stage in stages if stage in DESTRUCTIVE_STAGES]
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def count_exposures(conn, where="TRUE", params=None):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM exposures WHERE {where}", params)
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def bench_grpc(args, data):
+    """Drives UploadNoiseData from args.clients concurrent clients against an in-process server."""
+    import grpc
+    service = load_service('grpc_service', 'main', 'grpc_main')
+    service.db_pool = ConnectionManager(DB_SETTINGS, max_connections=args.clients)
+    server = grpc.server(ThreadPoolExecutor(max_workers=args.clients))
+    service.noise_dosimeter_pb2_grpc.add_NoiseDosimeterServicer_to_server(service.NoiseDosimeterServicer(), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+
+    pb2 = service.noise_dosimeter_pb2
+    calibrated = datetime.utcnow() - timedelta(days=30)
+    requests = []
+    for row in data['noise'].to_dict('records'):
+        request = pb2.NoiseDataRequest(
+            device_id=row['device_id'], location_code=row['location_code'], captured_by=row['captured_by'],
+            laeq=row['laeq'], peak_db=row['peak_db'], dosimeter_interval_min=int(row['dosimeter_interval_min'])
+        )
+        request.timestamp_utc.FromDatetime(row['timestamp_utc'].tz_convert(None).to_pydatetime())
+        request.calibration_date.FromDatetime(calibrated)
+        requests.append(request)
+
+    channel = grpc.insecure_channel(f'127.0.0.1:{port}')
+    stub = service.noise_dosimeter_pb2_grpc.NoiseDosimeterStub(channel)
+
+    def call(request):
+        started = time.perf_counter()
+        try:
+            success = stub.UploadNoiseData(request).success
+        except grpc.RpcError:
+            success = False
+        return time.perf_counter() - started, success
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.clients) as clients:
+            results, elapsed = timed(lambda: list(clients.map(call, requests)))
+    finally:
+        channel.close()
+        server.stop(0)
+        service.db_pool.close()
+    return StageResult('grpc', sum(ok for _, ok in results), elapsed, [s for s, _ in results], 'call')
+
+
+class LocalSftp:
+    """Stand-in for a pysftp.Connection over a local directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def listdir_attr(self, path):
+        return [
+            SimpleNamespace(filename=entry.name, st_size=entry.stat().st_size, st_mtime=entry.stat().st_mtime)
+            for entry in sorted(os.scandir(path), key=lambda e: e.name)
+        ]
+
+    def getfo(self, remote_path, buffer):
+        with open(remote_path, 'rb') as f:
+            buffer.write(f.read())
+
+    def remove(self, remote_path):
+        os.remove(remote_path)
+
+
+def bench_sftp(args, data, workdir):
+    """Runs one SFTP loader pass over CSV files staged in a local directory."""
+    loader = load_service('sftp_cron_loader', 'process_sftp_files', 'process_sftp_files')
+    remote_dir = os.path.join(workdir, 'sftp')
+    os.makedirs(remote_dir)
+    for domain, df in data.items():
+        synthetic_exposures.write_csv_files(df, domain, remote_dir, args.rows_per_file)
+    loader.SFTP_REMOTE_DIR = remote_dir
+
+    latencies = []
+    process_file = loader.process_file
+
+    def timed_process_file(*file_args):
+        inserted, elapsed = timed(process_file, *file_args)
+        latencies.append(elapsed)
+        return inserted
+
+    loader.process_file = timed_process_file
+    conn = connect(DB_SETTINGS)
+    try:
+        (_, rows), elapsed = timed(loader.process_pending_files, LocalSftp(remote_dir), conn)
+    finally:
+        loader.process_file = process_file
+        conn.close()
+    return StageResult('sftp', rows, elapsed, latencies, 'file')
+
+
+def bench_csv(args, data, workdir):
+    """Delivers CSV files through the CSV poller's database sink."""
+    db_sink = load_service('csv_polling_service', 'db_sink', 'db_sink')
+    watch_dir = os.path.join(workdir, 'csv')
+    os.makedirs(watch_dir)
+    paths = []
+    for domain, df in data.items():
+        paths += synthetic_exposures.write_csv_files(df, domain, watch_dir, args.rows_per_file)
+
+    sink = db_sink.create_database_sink(DB_SETTINGS, max_connections=1, chunk_rows=args.rows_per_file)
+    latencies = []
+    try:
+        started = time.perf_counter()
+        for path in paths:
+            ok, elapsed = timed(sink.deliver, path)
+            if not ok:
+                raise RuntimeError(f"CSV sink failed to load {path}")
+            latencies.append(elapsed)
+        elapsed = time.perf_counter() - started
+    finally:
+        sink.pool.close()
+    return StageResult('csv', sum(len(df) for df in data.values()), elapsed, latencies, 'file')
+
+
+class InMemoryProducer:
+    """Stand-in for the bridge's KafkaProducer; keeps serialized messages in order."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, topic, value, headers=None):
+        self.messages.append(json.dumps(value).encode('utf-8'))
+
+    def flush(self):
+        pass
+
+
+def bench_mqtt(args, data, producer):
+    """Feeds every reading through the MQTT bridge's on_message callback."""
+    bridge = load_service('mqtt_bridge', 'main', 'mqtt_main')
+    bridge.get_kafka_producer = lambda: producer
+    payloads = [payload for domain, df in data.items() for payload in synthetic_exposures.to_mqtt_payloads(df, domain)]
+
+    latencies = []
+    started = time.perf_counter()
+    for payload in payloads:
+        _, elapsed = timed(bridge.on_message, None, None, SimpleNamespace(topic=bridge.MQTT_TOPIC, payload=payload))
+        latencies.append(elapsed)
+    return StageResult('mqtt', len(producer.messages), time.perf_counter() - started, latencies, 'message')
+
+
+def bench_kafka(args, producer):
+    """Loads the bridge's messages with the Kafka sink in consumer-sized batches."""
+    sink = load_service('kafka_sink_service', 'main', 'kafka_sink_main')
+    conn = connect(DB_SETTINGS)
+    latencies = []
+    rows = 0
+    try:
+        started = time.perf_counter()
+        for start in range(0, len(producer.messages), args.kafka_batch):
+            batch = producer.messages[start:start + args.kafka_batch]
+            inserted, elapsed = timed(lambda: sink.load_batch(conn, [sink.parse_message(m) for m in batch]))
+            rows += inserted
+            latencies.append(elapsed)
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+    return StageResult('kafka', rows, elapsed, latencies, 'batch')
+
+
+def bench_anomaly(args):
+    detector = load_service('anomaly_detection_service', 'anomaly_detector', 'anomaly_detector')
+    conn = connect(DB_SETTINGS)
+    try:
+        rows = count_exposures(conn, "timestamp_utc >= NOW() - make_interval(hours => %s)", (detector.LOOKBACK_HOURS,))
+        _, elapsed = timed(lambda: detector.run_anomaly_detection(conn=conn))
+    finally:
+        conn.close()
+    return StageResult('anomaly', rows, elapsed)
+
+
+def bench_retention(args):
+    manager = load_service('data_retention_service', 'retention_policy_manager', 'retention_policy_manager')
+    conn = connect(DB_SETTINGS)
+    try:
+        before = count_exposures(conn)
+        _, elapsed = timed(lambda: manager.run_retention_manager(conn=conn))
+        purged = before - count_exposures(conn)
+    finally:
+        conn.close()
+    return StageResult('retention', purged, elapsed)
+
+
+def format_report(results):
+    lines = [f"{'stage':<10} {'rows':>10} {'seconds':>9} {'rows/s':>11} {'per':>8} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"]
+    for result in results:
+        r = result.as_dict()
+        rate = f"{r['rows_per_second']:,.0f}" if r['rows_per_second'] is not None else '-'
+        lines.append(
+            f"{r['stage']:<10} {r['rows']:>10,} {r['seconds']:>9.2f} {rate:>11} {r['latency_unit']:>8} "
+            f"{r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['max_ms']:>9.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20_000, help="Readings per domain for each file/message stage.")
+    parser.add_argument('--grpc-rows', type=int, default=2_000, help="Noise readings sent over gRPC.")
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--locations', type=int, default=10)
+    parser.add_argument('--rows-per-file', type=int, default=5_000)
+    parser.add_argument('--clients', type=int, default=8, help="Concurrent gRPC clients.")
+    parser.add_argument('--kafka-batch', type=int, default=5_000)
+    parser.add_argument('--expired-fraction', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--json', help="Also write the results (and parameters) to this JSON file.")
+    parser.add_argument('--i-know-this-deletes-data', dest='confirm_destructive', action='store_true',
+                        help=f"Run the anomaly and retention stages on a database whose name does not end in '{BENCH_DB_SUFFIX}'.")
+    args = parser.parse_args()
+
+    refused = refused_stages(args.stages, DB_SETTINGS['dbname'], args.confirm_destructive)
+    if refused:
+        parser.error(
+            f"the {' and '.join(refused)} stage(s) modify or delete existing data, and DB_NAME "
+            f"'{DB_SETTINGS['dbname']}' does not end in '{BENCH_DB_SUFFIX}'. Point DB_NAME at a disposable "
+            f"database, drop those stages with --stages, or pass --i-know-this-deletes-data."
+        )
+
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+    def readings(rows, seed_offset):
+        return {
+            domain: synthetic_exposures.generate_readings(
+                domain, rows, end=end, devices=args.devices, locations=args.locations,
+                expired_fraction=args.expired_fraction, seed=args.seed + seed_offset
+            )
+            for domain in DOMAINS
+        }
+
+    results = []
+    producer = InMemoryProducer()
+    print(format_report([]), flush=True)
+    with tempfile.TemporaryDirectory() as workdir:
+        # Each stage gets its own readings so sample_ids never collide across stages.
+        for index, stage in enumerate(args.stages):
+            if stage == 'grpc':
+                results.append(bench_grpc(args, {'noise': readings(args.grpc_rows, index)['noise']}))
+            elif stage == 'sftp':
+                results.append(bench_sftp(args, readings(args.rows, index), workdir))
+            elif stage == 'csv':
+                results.append(bench_csv(args, readings(args.rows, index), workdir))
+            elif stage == 'mqtt':
+                results.append(bench_mqtt(args, readings(args.rows, index), producer))
+            elif stage == 'kafka':
+                if not producer.messages:
+                    bench_mqtt(args, readings(args.rows, index), producer)
+                results.append(bench_kafka(args, producer))
+            elif stage == 'anomaly':
+                results.append(bench_anomaly(args))
+            elif stage == 'retention':
+                results.append(bench_retention(args))
+            print(format_report(results[-1:]).splitlines()[-1], flush=True)
+
+    print()
+    print(format_report(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': [r.as_dict() for r in results]}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
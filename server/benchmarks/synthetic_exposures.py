@@ -0,0 +1,157 @@
+"""
+Deterministic synthetic exposure readings for every domain, in the shapes the
+ingest entry points accept: DataFrames, CSV files (SFTP loader and CSV
+poller), MQTT JSON payloads (MQTT bridge and Kafka sink) and ExposureRecords.
+
+The same seed, row count and fleet size always produce the same readings;
+timestamps are offsets from the `end` time passed in.
+"""
+import json
+import os
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from exposure_writer import DETAIL_COLUMNS, ExposureRecord
+
+# domain -> detail table, unit, CSV filename prefix (as routed by the loaders) and MQTT "type"
+DOMAINS = {
+    'noise': {'table': 'noise_details', 'unit': 'dBA', 'prefix': 'noise', 'type': 'noise'},
+    'water': {'table': 'water_details', 'unit': 'mg/L', 'prefix': 'water', 'type': 'water'},
+    'radiation': {'table': 'radiation_details', 'unit': 'mrem', 'prefix': 'rad', 'type': 'radiation'},
+    'air': {'table': 'air_quality_details', 'unit': 'µg/m³', 'prefix': 'air', 'type': 'air'},
+    'heat_stress': {'table': 'heat_stress_details', 'unit': '°C', 'prefix': 'heat', 'type': 'heat_stress'},
+}
+
+CSV_EXPOSURE_COLUMNS = ['device_id', 'location_code', 'timestamp_utc', 'captured_by', 'value', 'unit', 'qualifier']
+
+
+def _details(domain, rng, values, rows):
+    """Detail columns for one domain, consistent with the primary values."""
+    if domain == 'noise':
+        return {
+            'dosimeter_interval_min': np.full(rows, 15),
+            'laeq': values,
+            'peak_db': np.round(values + rng.uniform(10, 30, rows), 1),
+        }
+    if domain == 'water':
+        return {
+            'sample_type': np.where(rng.random(rows) < 0.8, 'POTABLE', 'BALLAST'),
+            'temp_c': np.round(rng.normal(18, 3, rows), 1),
+            'residual_chlorine_mg_l': values,
+        }
+    if domain == 'radiation':
+        calibrated = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 150, rows), unit='D')
+        return {
+            'detector_type': np.where(rng.random(rows) < 0.5, 'TLD', 'EPD'),
+            'shielding_cm': np.round(rng.uniform(0, 10, rows), 1),
+            'calibration_date': calibrated.strftime('%Y-%m-%d').to_numpy(),
+        }
+    if domain == 'air':
+        return {
+            'duration_sec': np.full(rows, 3600),
+            'flow_rate_lpm': np.round(rng.normal(2.0, 0.1, rows), 2),
+            'filter_type': np.full(rows, 'PM2.5'),
+        }
+    dry_bulb = np.round(values + rng.uniform(2, 6, rows), 1)
+    return {
+        'db_c': dry_bulb,
+        'wb_c': np.round(values - rng.uniform(0, 2, rows), 1),
+        'globe_c': np.round(dry_bulb + rng.uniform(0, 4, rows), 1),
+        'flag_color': np.select([values >= 32, values >= 30, values >= 28], ['BLACK', 'RED', 'YELLOW'], 'GREEN'),
+    }
+
+
+_BASELINES = {
+    'noise': (82.0, 4.0), 'water': (1.2, 0.3), 'radiation': (0.4, 0.2), 'air': (12.0, 4.0), 'heat_stress': (26.0, 2.0),
+}
+
+
+def generate_readings(domain, rows, end=None, span_hours=12, devices=50, locations=10,
+                      anomaly_rate=0.001, expired_fraction=0.0, expired_years=6, seed=0):
+    """
+    Returns a DataFrame of `rows` readings for domain with sample_id, the
+    exposure columns and the domain's detail columns. A share of
+    anomaly_rate readings are pushed far from their device's baseline, and
+    expired_fraction of them are dated expired_years back for retention runs.
+    """
+    spec = DOMAINS[domain]
+    rng = np.random.default_rng([seed, list(DOMAINS).index(domain)])
+    end = end or datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+    device_codes = rng.integers(0, devices, rows)
+    mean, spread = _BASELINES[domain]
+    values = rng.normal(mean + (device_codes % 5) * spread * 0.5, spread)
+    outliers = rng.random(rows) < anomaly_rate
+    values[outliers] += spread * 10
+    values = np.round(np.abs(values), 3)
+
+    offsets = np.sort(rng.integers(0, int(span_hours * 3600), rows))[::-1]
+    timestamps = pd.Timestamp(end) - pd.to_timedelta(offsets, unit='s')
+    expired = rng.random(rows) < expired_fraction
+    timestamps = timestamps.where(~expired, timestamps - pd.Timedelta(days=round(365.25 * expired_years)))
+
+    df = pd.DataFrame({
+        'sample_id': [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(rows)],
+        'device_id': [f"{domain}-dev-{code}" for code in device_codes],
+        'location_code': [f"SHIP-{code % locations}" for code in device_codes],
+        'timestamp_utc': timestamps,
+        'captured_by': 'benchmark',
+        'value': values,
+        'unit': spec['unit'],
+        'qualifier': 'OK',
+    })
+    for column, data in _details(domain, rng, values, rows).items():
+        df[column] = data
+    return df[['sample_id'] + CSV_EXPOSURE_COLUMNS + DETAIL_COLUMNS[spec['table']]]
+
+
+def write_csv_files(df, domain, directory, rows_per_file):
+    """Writes df as CSV files named by the loaders' filename conventions. Returns the file paths."""
+    columns = CSV_EXPOSURE_COLUMNS + DETAIL_COLUMNS[DOMAINS[domain]['table']]
+    paths = []
+    for index, start in enumerate(range(0, len(df), rows_per_file)):
+        path = os.path.join(directory, f"{DOMAINS[domain]['prefix']}_bench_{index:05d}.csv")
+        chunk = df.iloc[start:start + rows_per_file]
+        chunk.to_csv(path, columns=columns, index=False, date_format='%Y-%m-%dT%H:%M:%S%z')
+        paths.append(path)
+    return paths
+
+
+def to_mqtt_payloads(df, domain):
+    """Returns one JSON payload (bytes) per reading, in the format the Kafka sink parses."""
+    detail_columns = DETAIL_COLUMNS[DOMAINS[domain]['table']]
+    payloads = []
+    for row in df.to_dict('records'):
+        message = {column: row[column] for column in ['sample_id'] + CSV_EXPOSURE_COLUMNS}
+        message['timestamp_utc'] = row['timestamp_utc'].isoformat()
+        message['type'] = DOMAINS[domain]['type']
+        message['details'] = {column: _json_value(row[column]) for column in detail_columns}
+        payloads.append(json.dumps({k: _json_value(v) for k, v in message.items()}).encode('utf-8'))
+    return payloads
+
+
+def to_records(df, domain):
+    """Returns ExposureRecords for df, with detail values in the detail table's column order."""
+    detail_columns = DETAIL_COLUMNS[DOMAINS[domain]['table']]
+    return [
+        ExposureRecord(
+            device_id=row['device_id'], timestamp_utc=row['timestamp_utc'].to_pydatetime(), value=row['value'],
+            unit=row['unit'], location_code=row['location_code'], captured_by=row['captured_by'],
+            qualifier=row['qualifier'], sample_id=row['sample_id'],
+            detail=[_json_value(row[column]) for column in detail_columns],
+        )
+        for row in df.to_dict('records')
+    ]
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (pd.Timestamp, datetime)):
+        return value.isoformat()
+    return value
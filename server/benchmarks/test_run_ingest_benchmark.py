@@ -0,0 +1,28 @@
+import pytest
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import run_ingest_benchmark
+from run_ingest_benchmark import refused_stages
+
+def test_destructive_stages_need_a_bench_database_or_confirmation():
+    stages = ['csv', 'anomaly', 'retention']
+
+    assert refused_stages(stages, 'ehr-eng2') == ['anomaly', 'retention']
+    assert refused_stages(stages, None) == ['anomaly', 'retention']
+    assert refused_stages(stages, 'ehr-eng2-bench') == []
+    assert refused_stages(stages, 'ehr-eng2', confirmed=True) == []
+    assert refused_stages(['grpc', 'csv'], 'ehr-eng2') == []
+
+def test_main_refuses_before_touching_the_database(monkeypatch, mocker):
+    monkeypatch.setitem(run_ingest_benchmark.DB_SETTINGS, 'dbname', 'ehr-eng2')
+    monkeypatch.setattr(sys, 'argv', ['run_ingest_benchmark.py', '--stages', 'retention'])
+    bench_retention = mocker.patch('run_ingest_benchmark.bench_retention')
+
+    with pytest.raises(SystemExit) as exited:
+        run_ingest_benchmark.main()
+
+    assert exited.value.code == 2
+    bench_retention.assert_not_called()
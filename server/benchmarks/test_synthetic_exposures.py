@@ -0,0 +1,38 @@
+import json
+import pytest
+from datetime import datetime, timezone
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from synthetic_exposures import DOMAINS, generate_readings, to_mqtt_payloads, to_records, write_csv_files
+
+END = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+@pytest.mark.parametrize('domain', list(DOMAINS))
+def test_generate_readings_is_deterministic(domain):
+    first = generate_readings(domain, 500, end=END, seed=7)
+    second = generate_readings(domain, 500, end=END, seed=7)
+
+    assert first.equals(second)
+    assert not first.equals(generate_readings(domain, 500, end=END, seed=8))
+    assert first['sample_id'].is_unique
+    assert (first['unit'] == DOMAINS[domain]['unit']).all()
+    assert first['timestamp_utc'].between(datetime(2024, 5, 31, 12, tzinfo=timezone.utc), END).all()
+
+def test_expired_fraction_backdates_readings():
+    df = generate_readings('radiation', 2000, end=END, expired_fraction=0.25, expired_years=6)
+
+    expired = df['timestamp_utc'] < datetime(2019, 1, 1, tzinfo=timezone.utc)
+    assert 0.2 < expired.mean() < 0.3
+
+def test_output_shapes_match_the_ingest_formats(tmp_path):
+    df = generate_readings('noise', 12, end=END)
+
+    paths = write_csv_files(df, 'noise', str(tmp_path), rows_per_file=5)
+    assert [os.path.basename(p) for p in paths] == ['noise_bench_00000.csv', 'noise_bench_00001.csv', 'noise_bench_00002.csv']
+    message = json.loads(to_mqtt_payloads(df, 'noise')[0])
+    assert message['type'] == 'noise' and set(message['details']) == {'dosimeter_interval_min', 'laeq', 'peak_db'}
+    record = to_records(df, 'noise')[0]
+    assert record.detail_row() == (df['sample_id'][0], 15, df['laeq'][0], df['peak_db'][0])
@@ -0,0 +1,89 @@
+import os
+import sys
+import fnmatch
+import logging
+
+import pandas as pd
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from db_pool import ConnectionManager
+from exposure_writer import ExposureWriter, DETAIL_COLUMNS, DEFAULT_ROUTES
+
+logger = logging.getLogger(__name__)
+
+# Delivery result for a file that can never be loaded as it is (empty, unparseable,
+# missing columns, values the database rejects). It is quarantined, not retried.
+REJECTED = 'rejected'
+
+# Errors that a retry of the same file cannot fix.
+PERMANENT_ERRORS = (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError, KeyError,
+                    psycopg2.DataError, psycopg2.IntegrityError)
+
+EXPOSURE_COLUMNS = ['device_id', 'location_code', 'timestamp_utc', 'captured_by', 'value', 'unit', 'qualifier']
+
+
+class DatabaseSink:
+    """
+    Loads recognized CSV files straight into exposures and the matching detail
+    table with the shared ExposureWriter over a pooled connection. Each file is
+    one transaction, so a file is either fully loaded or not at all.
+    """
+
+    def __init__(self, pool, routes=DEFAULT_ROUTES, chunk_rows=10000, writer=None):
+        self.pool = pool
+        self.writer = writer or ExposureWriter()
+        self.routes = [(pattern.lower(), table) for pattern, table in routes]
+        self.chunk_rows = chunk_rows
+
+    def route(self, file_path):
+        """Returns the detail table for a file, or None if the file is not recognized."""
+        filename = os.path.basename(file_path).lower()
+        for pattern, table in self.routes:
+            if fnmatch.fnmatchcase(filename, pattern):
+                return table
+        return None
+
+    def deliver(self, file_path, detail_table=None):
+        """Loads one file atomically. Returns True on success, REJECTED if the file can never load, else False."""
+        detail_table = detail_table or self.route(file_path)
+        if detail_table is None:
+            logger.warning(f"No detail table matches {os.path.basename(file_path)}.")
+            return REJECTED
+
+        detail_columns = DETAIL_COLUMNS[detail_table]
+        wanted = set(EXPOSURE_COLUMNS + detail_columns)
+        conn = self.pool.getconn()
+        if conn is None:
+            logger.error(f"Cannot load {os.path.basename(file_path)}: no database connection.")
+            return False
+        total = 0
+        try:
+            with conn.cursor() as cur:
+                # Values are passed through as text; Postgres parses them on load.
+                for chunk in pd.read_csv(file_path, usecols=lambda c: c in wanted, dtype=str, chunksize=self.chunk_rows):
+                    if 'qualifier' not in chunk.columns:
+                        chunk['qualifier'] = 'OK'
+                    missing = [c for c in EXPOSURE_COLUMNS + detail_columns if c not in chunk.columns]
+                    if missing:
+                        raise KeyError(f"Missing columns for {detail_table}: {', '.join(missing)}")
+                    total += self.writer.write_frame(cur, detail_table, chunk, EXPOSURE_COLUMNS, detail_columns)
+            conn.commit()
+            logger.info(f"Loaded {total} records from {os.path.basename(file_path)} into exposures/{detail_table}.")
+            return True
+        except PERMANENT_ERRORS as e:
+            logger.error(f"Rejected {file_path}: {e}")
+            conn.rollback()
+            return REJECTED
+        except Exception as e:
+            logger.error(f"Failed to load {file_path} into the database: {e}")
+            conn.rollback()
+            return False
+        finally:
+            self.pool.putconn(conn)
+
+
+def create_database_sink(db_config, max_connections, chunk_rows):
+    """Creates a DatabaseSink backed by a thread-safe connection pool."""
+    pool = ConnectionManager(db_config, max_connections=max_connections)
+    return DatabaseSink(pool, chunk_rows=chunk_rows)
@@ -1,96 +1,473 @@
 import os
+import sys
+import gzip
 import time
+import queue
+import shutil
 import logging
+import threading
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from sent_index import SentIndex
+from db_sink import REJECTED, create_database_sink
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from checksums import file_sha256
+from tracing import inject_headers, tracer_from_env
+
 # --- Load Configuration ---
 load_dotenv()
 
 WATCH_DIRECTORY = os.getenv("WATCH_DIRECTORY")
 NIFI_ENDPOINT_URL = os.getenv("NIFI_ENDPOINT_URL")
 POLLING_INTERVAL_SECONDS = int(os.getenv("POLLING_INTERVAL_SECONDS", 10))
+PROCESSED_DIRECTORY = os.getenv("PROCESSED_DIRECTORY") or os.path.join(WATCH_DIRECTORY or "", "processed")
+FAILED_DIRECTORY = os.getenv("FAILED_DIRECTORY") or os.path.join(WATCH_DIRECTORY or "", "failed")
+SENT_INDEX_PATH = os.getenv("SENT_INDEX_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "sent_files.sqlite3")
+
+# Upload Configuration
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", 10000))
+NIFI_BATCH_MAX_BYTES = int(os.getenv("NIFI_BATCH_MAX_BYTES", 4 * 1024 * 1024))
+NIFI_GZIP_LEVEL = int(os.getenv("NIFI_GZIP_LEVEL", 5))
+NIFI_MAX_RETRIES = int(os.getenv("NIFI_MAX_RETRIES", 5))
+NIFI_RETRY_BACKOFF_SECONDS = float(os.getenv("NIFI_RETRY_BACKOFF_SECONDS", 0.5))
+NIFI_TIMEOUT_SECONDS = float(os.getenv("NIFI_TIMEOUT_SECONDS", 30))
+NIFI_POOL_SIZE = int(os.getenv("NIFI_POOL_SIZE", 4))
+
+# Worker Configuration
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 4))
+WORK_QUEUE_SIZE = int(os.getenv("WORK_QUEUE_SIZE", 1000))
+FILE_SETTLE_SECONDS = float(os.getenv("FILE_SETTLE_SECONDS", 2))
+SETTLE_CHECK_INTERVAL_SECONDS = float(os.getenv("SETTLE_CHECK_INTERVAL_SECONDS", 0.5))
+# A file whose delivery failed is retried after this delay, doubling per failure up to the maximum.
+RETRY_BACKOFF_SECONDS = float(os.getenv("RETRY_BACKOFF_SECONDS", 5))
+RETRY_MAX_BACKOFF_SECONDS = float(os.getenv("RETRY_MAX_BACKOFF_SECONDS", 300))
+
+# Sink Configuration: 'nifi', 'database' (direct COPY), or 'auto' (database for
+# recognized files, NiFi for everything else)
+INGEST_SINK = os.getenv("INGEST_SINK", "nifi").lower()
+
+# Database Config (used by the 'database' and 'auto' sinks)
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_NAME = os.getenv("DB_NAME")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 # --- Logging Setup ---
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Tracing (TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH); one trace per file ---
+tracer = tracer_from_env('csv_poller')
+
 # --- Input Validation ---
 if not WATCH_DIRECTORY or not os.path.isdir(WATCH_DIRECTORY):
     logger.critical(f"Watch directory '{WATCH_DIRECTORY}' is not valid or does not exist. Please check your .env file.")
     exit(1)
-if not NIFI_ENDPOINT_URL:
+if INGEST_SINK not in ('nifi', 'database', 'auto'):
+    logger.critical(f"INGEST_SINK must be 'nifi', 'database' or 'auto', not '{INGEST_SINK}'.")
+    exit(1)
+if not NIFI_ENDPOINT_URL and INGEST_SINK != 'database':
     logger.critical("NIFI_ENDPOINT_URL is not set. Please check your .env file.")
     exit(1)
 
+def create_nifi_session():
+    """
+    Returns a requests.Session with pooled keep-alive connections to NiFi.
+    Each POST is retried with exponential backoff on connection errors and
+    retryable status codes.
+    """
+    retry = Retry(
+        total=NIFI_MAX_RETRIES,
+        backoff_factor=NIFI_RETRY_BACKOFF_SECONDS,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['POST']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=NIFI_POOL_SIZE)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def iter_ndjson_batches(file_path, max_bytes=NIFI_BATCH_MAX_BYTES, chunk_rows=CSV_CHUNK_ROWS, skip_records=0):
+    """
+    Reads a CSV file in chunks and yields (payload, record_count) NDJSON batches
+    whose uncompressed size stays within max_bytes (a single oversized record
+    is sent on its own). The first skip_records records are left out.
+    """
+    batch = []
+    batch_bytes = 0
+    for chunk in pd.read_csv(file_path, chunksize=chunk_rows):
+        if skip_records >= len(chunk):
+            skip_records -= len(chunk)
+            continue
+        chunk = chunk.iloc[skip_records:]
+        skip_records = 0
+        # One vectorized serialization per chunk; each line is one record.
+        for line in chunk.to_json(orient='records', lines=True).encode('utf-8').splitlines():
+            if batch and batch_bytes + len(line) + 1 > max_bytes:
+                yield b'\n'.join(batch) + b'\n', len(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(line)
+            batch_bytes += len(line) + 1
+    if batch:
+        yield b'\n'.join(batch) + b'\n', len(batch)
+
+
+class FileDispatcher:
+    """
+    Debounces file events and hands complete files to a bounded pool of worker
+    threads, so the watchdog observer thread never blocks on an upload.
+
+    A watched file counts as complete once its size and mtime have not changed
+    for settle_seconds, or immediately when submit() is called (close/move events).
+    When process returns False or raises, the file is queued again after an
+    exponential backoff for as long as it stays in the watch directory. Any
+    other result (True, or REJECTED for a file that can never be delivered)
+    is final.
+    """
+
+    def __init__(self, process, workers=WORKER_COUNT, queue_size=WORK_QUEUE_SIZE,
+                 settle_seconds=FILE_SETTLE_SECONDS, check_interval=SETTLE_CHECK_INTERVAL_SECONDS,
+                 retry_backoff=RETRY_BACKOFF_SECONDS, retry_max_backoff=RETRY_MAX_BACKOFF_SECONDS,
+                 clock=time.monotonic):
+        self._process = process
+        self._settle_seconds = settle_seconds
+        self._check_interval = check_interval
+        self._retry_backoff = retry_backoff
+        self._retry_max_backoff = retry_max_backoff
+        self._clock = clock
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = {}  # path -> (size, mtime_ns, last change time, ready)
+        self._active = set()  # paths queued or being processed
+        self._retries = {}  # path -> (consecutive failures, time of the next attempt)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = [threading.Thread(target=self._monitor, name='settle-monitor', daemon=True)]
+        self._threads.extend(
+            threading.Thread(target=self._work, name=f'csv-worker-{i}', daemon=True) for i in range(workers)
+        )
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stops accepting files, lets workers finish queued files, and joins all threads."""
+        self._stopping.set()
+        self._wakeup.set()
+        self._threads[0].join()
+        for _ in self._threads[1:]:
+            self._queue.put(None)
+        for thread in self._threads[1:]:
+            thread.join()
+
+    def watch(self, path):
+        """Tracks a file that may still be being written."""
+        with self._lock:
+            if path not in self._active and path not in self._pending:
+                self._pending[path] = (None, None, self._clock(), False)
+
+    def submit(self, path):
+        """Marks a file as complete so it is queued without waiting for it to settle."""
+        with self._lock:
+            if path in self._active:
+                return
+            size, mtime_ns, changed_at, _ = self._pending.get(path, (None, None, self._clock(), False))
+            self._pending[path] = (size, mtime_ns, changed_at, True)
+        self._wakeup.set()
+
+    def _monitor(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self._check_interval)
+            self._wakeup.clear()
+            for path in self._settled_paths():
+                self._queue.put(path)  # Blocks when the queue is full, applying backpressure.
+
+    def _settled_paths(self):
+        now = self._clock()
+        settled = []
+        with self._lock:
+            for path, (size, mtime_ns, changed_at, ready) in list(self._pending.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self._pending[path]
+                    self._retries.pop(path, None)
+                    continue
+                if path in self._retries and now < self._retries[path][1]:
+                    continue
+                if ready or (
+                    (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns)
+                    and now - changed_at >= self._settle_seconds
+                ):
+                    del self._pending[path]
+                    self._active.add(path)
+                    settled.append(path)
+                elif (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    self._pending[path] = (stat.st_size, stat.st_mtime_ns, now, False)
+        return settled
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                break
+            delivered = False
+            try:
+                delivered = self._process(path)
+            except Exception as e:
+                logger.error(f"Worker failed on {path}: {e}")
+            finally:
+                with self._lock:
+                    self._active.discard(path)
+                    if delivered is False:
+                        self._schedule_retry(path)
+                    else:
+                        self._retries.pop(path, None)
+
+    def _schedule_retry(self, path):
+        """Queues a failed file again after a backoff. Called with the lock held."""
+        failures = self._retries.get(path, (0, None))[0] + 1
+        delay = min(self._retry_backoff * 2 ** (failures - 1), self._retry_max_backoff)
+        self._retries[path] = (failures, self._clock() + delay)
+        self._pending[path] = (None, None, self._clock(), True)
+        logger.warning(f"Delivery of {os.path.basename(path)} failed {failures} time(s). Retrying in {delay:.0f}s.")
+
+
 class CSVHandler(FileSystemEventHandler):
     """Handles file system events for new CSV files."""
 
+    def __init__(self, session=None, sent_index=None, processed_directory=PROCESSED_DIRECTORY, db_sink=None,
+                 failed_directory=FAILED_DIRECTORY):
+        super().__init__()
+        if session is None and INGEST_SINK != 'database':
+            session = create_nifi_session()
+        self.session = session  # None in 'database' mode, which never posts to NiFi
+        self.db_sink = db_sink
+        self.sent_index = sent_index or SentIndex(SENT_INDEX_PATH)
+        self.processed_directory = processed_directory
+        self.failed_directory = failed_directory
+        self.dispatcher = FileDispatcher(self.deliver_file)
+        os.makedirs(self.processed_directory, exist_ok=True)
+        os.makedirs(self.failed_directory, exist_ok=True)
+
+    @staticmethod
+    def _is_csv(path):
+        return path.endswith('.csv') and os.path.dirname(os.path.abspath(path)) == os.path.abspath(WATCH_DIRECTORY)
+
     def on_created(self, event):
         """
-        Called when a file or directory is created.
+        Called when a file or directory is created. The file is processed once
+        it has settled or has been closed.
         """
-        if not event.is_directory and event.src_path.endswith('.csv'):
+        if not event.is_directory and self._is_csv(event.src_path):
             logger.info(f"New CSV file detected: {event.src_path}")
-            self.process_csv(event.src_path)
+            self.dispatcher.watch(event.src_path)
+
+    def on_closed(self, event):
+        """Called when a file opened for writing is closed (inotify only)."""
+        if not event.is_directory and self._is_csv(event.src_path):
+            self.dispatcher.submit(event.src_path)
+
+    def on_moved(self, event):
+        """Called when a file is renamed into place, which is atomic."""
+        if not event.is_directory and self._is_csv(event.dest_path):
+            logger.info(f"CSV file moved into place: {event.dest_path}")
+            self.dispatcher.submit(event.dest_path)
+
+    def reconcile_backlog(self, directory=None):
+        """
+        Scans the watch directory once and queues every CSV file that is not in
+        the sent index. Files that were sent but not moved (e.g. after a crash)
+        are moved to the processed directory. Returns the number of files queued.
+        """
+        directory = directory or WATCH_DIRECTORY
+        sent = self.sent_index.load()
+        queued = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.csv') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if sent.get(os.path.abspath(entry.path)) == (stat.st_size, stat.st_mtime_ns):
+                    self.move_to_processed(entry.path)
+                    continue
+                self.dispatcher.submit(entry.path)
+                queued += 1
+        logger.info(f"Startup scan queued {queued} unsent CSV files from {directory}.")
+        return queued
+
+    def deliver_file(self, file_path):
+        """
+        Delivers one settled file, records it in the sent index, and moves it to
+        the processed directory. Files whose content was already sent are only moved.
+        A rejected file is moved to the failed directory and REJECTED returned,
+        so it is not retried.
+        """
+        try:
+            stat = os.stat(file_path)
+            content_sha256 = file_sha256(file_path)
+        except FileNotFoundError:
+            logger.warning(f"File disappeared before it could be sent: {file_path}")
+            return False
 
-    def process_csv(self, file_path):
+        if self.sent_index.contains_hash(content_sha256):
+            logger.info(f"Content of {os.path.basename(file_path)} was already sent. Skipping upload.")
+        else:
+            with tracer.start_span('send_file', attributes={'file': os.path.basename(file_path), 'bytes': stat.st_size}) as span:
+                sent = self.send_file(file_path, content_sha256)
+                span.set_attribute('sent', sent)
+            if sent == REJECTED:
+                logger.warning(f"{os.path.basename(file_path)} cannot be delivered. Moving it to {self.failed_directory}.")
+                self.move_file(file_path, self.failed_directory)
+                return REJECTED
+            if not sent:
+                return False
+
+        self.sent_index.record(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, content_sha256)
+        self.move_to_processed(file_path)
+        return True
+
+    def send_file(self, file_path, content_sha256):
+        """
+        Sends a file to the configured sink: recognized files go straight to the
+        database when a database sink is configured, everything else to NiFi.
+        In 'database' mode an unrecognized file is REJECTED.
+        """
+        if self.db_sink is not None:
+            detail_table = self.db_sink.route(file_path)
+            if detail_table is not None:
+                return self.db_sink.deliver(file_path, detail_table)
+            if INGEST_SINK == 'database':
+                logger.warning(f"{os.path.basename(file_path)} matches no detail table.")
+                return REJECTED
+        return self.process_csv(file_path, content_sha256)
+
+    def move_to_processed(self, file_path):
+        """Moves a sent file into the processed directory without overwriting earlier files."""
+        self.move_file(file_path, self.processed_directory)
+
+    def move_file(self, file_path, directory):
+        """Moves a file into directory without overwriting earlier files."""
+        target = os.path.join(directory, os.path.basename(file_path))
+        if os.path.exists(target):
+            root, ext = os.path.splitext(target)
+            target = f"{root}.{time.strftime('%Y%m%dT%H%M%S')}.{os.getpid()}{ext}"
+        try:
+            shutil.move(file_path, target)
+            logger.debug(f"Moved {file_path} to {target}")
+        except OSError as e:
+            logger.error(f"Failed to move {file_path} to {directory}: {e}")
+
+    def process_csv(self, file_path, content_sha256):
         """
-        Reads a CSV file and sends its content to the NiFi endpoint.
+        Streams a CSV file to the NiFi endpoint as gzip-compressed NDJSON batches.
+        Progress is recorded after every acknowledged batch, so a retry resumes
+        after the last one. Returns True if every batch was delivered, REJECTED
+        if the file is empty or cannot be parsed, and False otherwise.
         """
+        filename = os.path.basename(file_path)
         try:
-            # Wait a moment to ensure the file is fully written
-            time.sleep(1)
-            
-            df = pd.read_csv(file_path)
-            
-            # Convert dataframe to JSON records
-            data_json = df.to_json(orient='records')
-            
-            logger.info(f"Successfully parsed {len(df)} records from {os.path.basename(file_path)}.")
-            
-            self.send_to_nifi(data_json, os.path.basename(file_path))
+            records_sent, sequence = self.sent_index.progress(content_sha256)
+            if records_sent:
+                logger.info(f"Resuming {filename} after {records_sent} records in {sequence} batches.")
+            total_records = records_sent
+            pending = None
+            # Hold one batch back so the final batch can be marked as such.
+            for batch in iter_ndjson_batches(file_path, skip_records=records_sent):
+                if pending is not None:
+                    batch_id = f"{content_sha256}-{total_records}"
+                    if not self.send_to_nifi(pending[0], filename, sequence, pending[1], is_last=False, batch_id=batch_id):
+                        return False
+                    sequence += 1
+                    total_records += pending[1]
+                    self.sent_index.record_progress(content_sha256, total_records, sequence)
+                pending = batch
+
+            if pending is None:
+                logger.warning(f"CSV file has no records: {file_path}")
+                return REJECTED
+            batch_id = f"{content_sha256}-{total_records}"
+            if not self.send_to_nifi(pending[0], filename, sequence, pending[1], is_last=True, batch_id=batch_id):
+                return False
+            total_records += pending[1]
+
+            logger.info(f"Successfully sent {total_records} records from {filename} in {sequence + 1} batches.")
+            return True
 
         except pd.errors.EmptyDataError:
             logger.warning(f"CSV file is empty: {file_path}")
+            return REJECTED
+        except (pd.errors.ParserError, UnicodeDecodeError) as e:
+            logger.error(f"Cannot parse {file_path}: {e}")
+            return REJECTED
         except Exception as e:
             logger.error(f"Failed to process file {file_path}: {e}")
+        return False
 
-    def send_to_nifi(self, data, filename):
+    def send_to_nifi(self, payload, filename, sequence, record_count, is_last, batch_id):
         """
-        Sends data as a POST request to the NiFi endpoint.
+        Sends one NDJSON batch as a gzip-compressed POST request to the NiFi endpoint.
+        batch_id (content hash and first record offset) is the same whenever the
+        batch is resent, so the receiver can drop a batch it has already stored.
+        Returns True on success.
         """
         headers = {
-            'Content-Type': 'application/json',
-            'X-Filename': filename  # Custom header to pass original filename
+            'Content-Type': 'application/x-ndjson',
+            'Content-Encoding': 'gzip',
+            'X-Filename': filename,  # Custom header to pass original filename
+            'X-Batch-Sequence': str(sequence),
+            'X-Batch-Records': str(record_count),
+            'X-Batch-Last': 'true' if is_last else 'false',
+            'X-Batch-Id': batch_id,
         }
+        inject_headers(headers)
         try:
-            response = requests.post(NIFI_ENDPOINT_URL, data=data, headers=headers, timeout=30)
+            body = gzip.compress(payload, compresslevel=NIFI_GZIP_LEVEL)
+            response = self.session.post(NIFI_ENDPOINT_URL, data=body, headers=headers, timeout=NIFI_TIMEOUT_SECONDS)
             response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-            
-            logger.info(f"Successfully sent data from {filename} to NiFi. Status: {response.status_code}")
-            
-            # Optional: Move or delete the file after successful processing
-            # os.remove(file_path)
+
+            logger.debug(f"Sent batch {sequence} ({record_count} records) from {filename} to NiFi. Status: {response.status_code}")
+            return True
 
         except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to send data to NiFi: {e}")
+            logger.error(f"Failed to send batch {sequence} of {filename} to NiFi: {e}")
+            return False
 
 
 def start_polling():
     """Starts the file system observer."""
-    event_handler = CSVHandler()
+    db_sink = None
+    if INGEST_SINK in ('database', 'auto'):
+        db_config = dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+        db_sink = create_database_sink(db_config, max_connections=WORKER_COUNT, chunk_rows=CSV_CHUNK_ROWS)
+
+    event_handler = CSVHandler(db_sink=db_sink)
     observer = Observer()
     observer.schedule(event_handler, WATCH_DIRECTORY, recursive=False)
     
     logger.info(f"Starting CSV polling service. Watching directory: {WATCH_DIRECTORY}")
-    logger.info(f"NiFi Endpoint: {NIFI_ENDPOINT_URL}")
+    logger.info(f"Ingest sink: {INGEST_SINK}")
+    if INGEST_SINK != 'database':
+        logger.info(f"NiFi Endpoint: {NIFI_ENDPOINT_URL}")
     
+    event_handler.dispatcher.start()
     observer.start()
+    # Scan after the observer starts so files arriving during the scan are not missed.
+    event_handler.reconcile_backlog()
     
     try:
         while True:
@@ -100,6 +477,10 @@ def start_polling():
         logger.info("Polling service stopped by user.")
     
     observer.join()
+    event_handler.dispatcher.stop()
+    event_handler.sent_index.close()
+    if db_sink is not None:
+        db_sink.pool.close()
 
 
 if __name__ == "__main__":
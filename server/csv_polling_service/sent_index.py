@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+import time
+
+
+class SentIndex:
+    """
+    Persistent SQLite record of files that were delivered successfully, keyed
+    by their path in the watch directory, and of how far the upload of an
+    unfinished file got, keyed by its content hash. Safe to share between
+    worker threads.
+    """
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sent_files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    sent_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_files_sha256 ON sent_files (sha256)")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS send_progress (
+                    sha256 TEXT PRIMARY KEY,
+                    records_sent INTEGER NOT NULL,
+                    batches_sent INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def load(self):
+        """Returns {path: (size, mtime_ns)} for every sent file, in one query."""
+        with self._lock:
+            rows = self._conn.execute("SELECT path, size, mtime_ns FROM sent_files").fetchall()
+        return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def contains_hash(self, sha256):
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM sent_files WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+        return row is not None
+
+    def record(self, path, size, mtime_ns, sha256):
+        """Records a delivered file and forgets the progress of its upload."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sent_files (path, size, mtime_ns, sha256, sent_at) VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, sha256, time.time())
+            )
+            self._conn.execute("DELETE FROM send_progress WHERE sha256 = ?", (sha256,))
+
+    def progress(self, sha256):
+        """Returns (records_sent, batches_sent) for an unfinished upload, or (0, 0)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT records_sent, batches_sent FROM send_progress WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def record_progress(self, sha256, records_sent, batches_sent):
+        """Records that the first records_sent records of a file were acknowledged."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO send_progress (sha256, records_sent, batches_sent, updated_at) VALUES (?, ?, ?, ?)",
+                (sha256, records_sent, batches_sent, time.time())
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,94 @@
+import pytest
+from unittest.mock import MagicMock
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import psycopg2
+from db_sink import DatabaseSink, REJECTED
+
+NOISE_CSV = (
+    "device_id,location_code,timestamp_utc,captured_by,value,unit,dosimeter_interval_min,laeq,peak_db,extra\n"
+    "aerps-7,DDG-51-ER,2024-06-01T12:00:00Z,jdoe,85.5,dBA,15,85.5,110\n"
+    "aerps-7,DDG-51-ER,2024-06-01T12:15:00Z,jdoe,86.0,dBA,15,86.0,112\n"
+)
+
+@pytest.fixture
+def mock_pool():
+    """Fixture for a connection pool handing out one mocked connection."""
+    pool = MagicMock()
+    mock_conn = MagicMock()
+    mock_cur = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+    pool.getconn.return_value = mock_conn
+    return pool, mock_conn, mock_cur
+
+@pytest.fixture
+def noise_file(tmp_path):
+    path = tmp_path / 'NOISE_2024.csv'
+    path.write_text(NOISE_CSV)
+    return str(path)
+
+def test_route_uses_the_shared_filename_conventions(mock_pool):
+    sink = DatabaseSink(mock_pool[0])
+
+    assert sink.route('/watch/NOISE_2024.csv') == 'noise_details'
+    assert sink.route('/watch/water_a.csv') == 'water_details'
+    assert sink.route('/watch/unknown.csv') is None
+
+def test_deliver_writes_the_file_in_one_transaction(mock_pool, noise_file):
+    pool, mock_conn, mock_cur = mock_pool
+    writer = MagicMock()
+    writer.write_frame.side_effect = lambda cur, table, df, *_: len(df)
+    sink = DatabaseSink(pool, writer=writer, chunk_rows=1)
+
+    assert sink.deliver(noise_file) is True
+
+    assert writer.write_frame.call_count == 2
+    _, table, chunk, exposure_columns, detail_columns = writer.write_frame.call_args.args
+    assert table == 'noise_details'
+    assert 'extra' not in chunk.columns
+    assert chunk['qualifier'].tolist() == ['OK']
+    assert detail_columns == ['dosimeter_interval_min', 'laeq', 'peak_db']
+    mock_conn.commit.assert_called_once()
+    mock_conn.rollback.assert_not_called()
+    pool.putconn.assert_called_once_with(mock_conn)
+
+def test_deliver_rejects_a_file_with_missing_columns(mock_pool, tmp_path):
+    pool, mock_conn, _ = mock_pool
+    path = tmp_path / 'rad_1.csv'
+    path.write_text("device_id,location_code,timestamp_utc,value,unit\naerps-7,ER,2024-06-01T12:00:00Z,1.0,uSv\n")
+    writer = MagicMock()
+    sink = DatabaseSink(pool, writer=writer)
+
+    assert sink.deliver(str(path)) == REJECTED
+
+    writer.write_frame.assert_not_called()
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
+    pool.putconn.assert_called_once_with(mock_conn)
+
+@pytest.mark.parametrize('error, result', [
+    (psycopg2.DataError('invalid input syntax for type numeric'), REJECTED),
+    (psycopg2.OperationalError('server closed the connection'), False),
+])
+def test_deliver_rejects_bad_data_but_retries_database_outages(mock_pool, noise_file, error, result):
+    pool, mock_conn, _ = mock_pool
+    writer = MagicMock()
+    writer.write_frame.side_effect = error
+    sink = DatabaseSink(pool, writer=writer)
+
+    assert sink.deliver(noise_file) is result
+    mock_conn.rollback.assert_called_once()
+
+def test_deliver_fails_without_a_connection_or_a_route(mock_pool, noise_file, tmp_path):
+    pool, _, _ = mock_pool
+    sink = DatabaseSink(pool, writer=MagicMock())
+
+    assert sink.deliver(str(tmp_path / 'unknown.csv')) == REJECTED
+    pool.getconn.assert_not_called()
+
+    pool.getconn.return_value = None
+    assert sink.deliver(noise_file) is False
+    pool.putconn.assert_not_called()
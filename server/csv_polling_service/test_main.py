@@ -0,0 +1,370 @@
+import gzip
+import json
+import pytest
+import requests
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+# main.py validates its configuration on import.
+WATCH_DIRECTORY = tempfile.mkdtemp(prefix='csv_polling_test_')
+os.environ.setdefault('WATCH_DIRECTORY', WATCH_DIRECTORY)
+os.environ.setdefault('NIFI_ENDPOINT_URL', 'http://nifi.test/contentListener')
+
+import main
+from main import CSVHandler
+from sent_index import SentIndex
+
+@pytest.fixture
+def make_handler(tmp_path):
+    """Fixture building a CSVHandler with an in-memory sent index and a temporary processed directory."""
+    def make(**kwargs):
+        kwargs.setdefault('sent_index', MagicMock())
+        return CSVHandler(processed_directory=str(tmp_path / 'processed'), **kwargs)
+    return make
+
+def test_database_mode_does_not_create_a_nifi_session(mocker, make_handler):
+    mocker.patch.object(main, 'INGEST_SINK', 'database')
+    create_session = mocker.patch.object(main, 'create_nifi_session')
+
+    handler = make_handler(db_sink=MagicMock())
+
+    create_session.assert_not_called()
+    assert handler.session is None
+
+@pytest.mark.parametrize('mode', ['nifi', 'auto'])
+def test_nifi_and_auto_modes_create_a_nifi_session(mocker, make_handler, mode):
+    mocker.patch.object(main, 'INGEST_SINK', mode)
+    create_session = mocker.patch.object(main, 'create_nifi_session')
+
+    handler = make_handler()
+
+    assert handler.session is create_session.return_value
+
+def test_database_mode_rejects_unrecognized_files(mocker, make_handler, tmp_path):
+    mocker.patch.object(main, 'INGEST_SINK', 'database')
+    db_sink = MagicMock()
+    db_sink.route.return_value = None
+    sent_index = MagicMock()
+    sent_index.contains_hash.return_value = False
+    handler = make_handler(db_sink=db_sink, sent_index=sent_index, failed_directory=str(tmp_path / 'failed'))
+    process_csv = mocker.patch.object(handler, 'process_csv')
+    path = tmp_path / 'unknown.csv'
+    path.write_text('device_id\naerps-7\n')
+
+    assert handler.send_file(str(path), 'abc') == main.REJECTED
+    assert handler.deliver_file(str(path)) == main.REJECTED
+
+    process_csv.assert_not_called()
+    db_sink.deliver.assert_not_called()
+    assert (tmp_path / 'failed' / 'unknown.csv').exists()
+
+def test_auto_mode_sends_recognized_files_to_the_database_and_the_rest_to_nifi(mocker, make_handler):
+    mocker.patch.object(main, 'INGEST_SINK', 'auto')
+    db_sink = MagicMock()
+    db_sink.route.side_effect = lambda path: 'noise_details' if 'noise' in path else None
+    handler = make_handler(session=MagicMock(), db_sink=db_sink)
+    process_csv = mocker.patch.object(handler, 'process_csv', return_value=True)
+
+    assert handler.send_file('/watch/noise_1.csv', 'abc') is db_sink.deliver.return_value
+    db_sink.deliver.assert_called_once_with('/watch/noise_1.csv', 'noise_details')
+    process_csv.assert_not_called()
+
+    assert handler.send_file('/watch/other.csv', 'abc') is True
+    process_csv.assert_called_once_with('/watch/other.csv', 'abc')
+
+class FakeClock:
+    """A monotonic clock the tests advance by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def run_worker(dispatcher, paths):
+    """Runs one worker loop in the test thread over the given paths."""
+    for path in paths:
+        dispatcher._queue.put(path)
+    dispatcher._queue.put(None)
+    dispatcher._work()
+
+def test_reconcile_backlog_queues_unsent_files_and_moves_sent_ones(make_handler, tmp_path):
+    watch = tmp_path / 'watch'
+    watch.mkdir()
+    for name in ('sent.csv', 'changed.csv', 'new.csv', 'notes.txt'):
+        (watch / name).write_text('device_id\naerps-7\n')
+    sent_index = MagicMock()
+    sent, changed = os.stat(watch / 'sent.csv'), os.stat(watch / 'changed.csv')
+    sent_index.load.return_value = {
+        str(watch / 'sent.csv'): (sent.st_size, sent.st_mtime_ns),
+        str(watch / 'changed.csv'): (changed.st_size + 1, changed.st_mtime_ns),
+    }
+    handler = make_handler(session=MagicMock(), sent_index=sent_index)
+    handler.dispatcher = MagicMock()
+
+    assert handler.reconcile_backlog(str(watch)) == 2
+
+    submitted = sorted(os.path.basename(c.args[0]) for c in handler.dispatcher.submit.call_args_list)
+    assert submitted == ['changed.csv', 'new.csv']
+    assert not (watch / 'sent.csv').exists()
+    assert (tmp_path / 'processed' / 'sent.csv').exists()
+
+def test_failed_deliveries_are_retried_with_backoff(tmp_path):
+    path = str(tmp_path / 'a.csv')
+    with open(path, 'w') as f:
+        f.write('device_id\naerps-7\n')
+    clock = FakeClock()
+    process = MagicMock(side_effect=[False, RuntimeError('NiFi down'), True])
+    dispatcher = main.FileDispatcher(process, workers=1, retry_backoff=5, retry_max_backoff=8, clock=clock)
+
+    dispatcher.submit(path)
+    run_worker(dispatcher, dispatcher._settled_paths())
+    assert process.call_count == 1
+
+    clock.now += 4.9
+    assert dispatcher._settled_paths() == []
+    clock.now += 0.1
+    run_worker(dispatcher, dispatcher._settled_paths())
+    assert process.call_count == 2
+
+    # The second failure doubles the delay, capped at retry_max_backoff.
+    clock.now += 7.9
+    assert dispatcher._settled_paths() == []
+    clock.now += 0.1
+    run_worker(dispatcher, dispatcher._settled_paths())
+    assert process.call_count == 3
+
+    clock.now += 60
+    assert dispatcher._settled_paths() == []
+    assert dispatcher._retries == {}
+
+def test_rejected_files_are_not_retried(tmp_path):
+    path = str(tmp_path / 'a.csv')
+    with open(path, 'w') as f:
+        f.write('device_id\naerps-7\n')
+    clock = FakeClock()
+    process = MagicMock(side_effect=[False, main.REJECTED])
+    dispatcher = main.FileDispatcher(process, workers=1, retry_backoff=5, clock=clock)
+
+    dispatcher.submit(path)
+    run_worker(dispatcher, dispatcher._settled_paths())
+    clock.now += 5
+    run_worker(dispatcher, dispatcher._settled_paths())
+
+    clock.now += 60
+    assert dispatcher._settled_paths() == []
+    assert process.call_count == 2
+    assert dispatcher._pending == {} and dispatcher._retries == {}
+
+@pytest.mark.parametrize('content', ['', 'device_id,value\n', 'device_id,value\n"dev-0,1\n', b'device_id\n\xff\xfe\n'])
+def test_empty_or_unparseable_files_are_rejected(make_handler, tmp_path, content):
+    path = tmp_path / 'a.csv'
+    if isinstance(content, bytes):
+        path.write_bytes(content)
+    else:
+        path.write_text(content)
+    session = MagicMock()
+    handler = make_handler(session=session, sent_index=SentIndex(str(tmp_path / 'sent.sqlite3')))
+
+    assert handler.process_csv(str(path), 'abc') == main.REJECTED
+    session.post.assert_not_called()
+
+def test_rejected_files_move_to_the_failed_directory(mocker, make_handler, tmp_path):
+    path = write_csv(tmp_path / 'a.csv', 1)
+    sent_index = MagicMock()
+    sent_index.contains_hash.return_value = False
+    handler = make_handler(session=MagicMock(), sent_index=sent_index, failed_directory=str(tmp_path / 'failed'))
+    mocker.patch.object(handler, 'send_file', return_value=main.REJECTED)
+
+    assert handler.deliver_file(path) == main.REJECTED
+
+    assert not os.path.exists(path)
+    assert (tmp_path / 'failed' / 'a.csv').exists()
+    sent_index.record.assert_not_called()
+
+def test_retries_stop_when_the_file_is_removed(tmp_path):
+    path = str(tmp_path / 'a.csv')
+    with open(path, 'w') as f:
+        f.write('device_id\naerps-7\n')
+    clock = FakeClock()
+    process = MagicMock(return_value=False)
+    dispatcher = main.FileDispatcher(process, workers=1, retry_backoff=5, clock=clock)
+
+    dispatcher.submit(path)
+    run_worker(dispatcher, dispatcher._settled_paths())
+    os.remove(path)
+    clock.now += 5
+
+    assert dispatcher._settled_paths() == []
+    assert dispatcher._pending == {} and dispatcher._retries == {}
+
+def write_csv(path, count):
+    with open(path, 'w') as f:
+        f.write('device_id,value\n')
+        for i in range(count):
+            f.write(f'dev-{i},{i}.5\n')
+    return str(path)
+
+def test_ndjson_batches_respect_the_byte_limit_across_chunks(tmp_path):
+    path = write_csv(tmp_path / 'a.csv', 5)
+    line = len(b'{"device_id":"dev-0","value":0.5}\n')
+
+    batches = list(main.iter_ndjson_batches(path, max_bytes=2 * line, chunk_rows=3))
+
+    assert [count for _, count in batches] == [2, 2, 1]
+    assert all(len(payload) <= 2 * line for payload, _ in batches)
+    records = [json.loads(l) for payload, _ in batches for l in payload.splitlines()]
+    assert [r['device_id'] for r in records] == [f'dev-{i}' for i in range(5)]
+
+def test_ndjson_batches_send_an_oversized_record_alone_and_skip_sent_records(tmp_path):
+    path = write_csv(tmp_path / 'a.csv', 5)
+
+    assert [count for _, count in main.iter_ndjson_batches(path, max_bytes=1)] == [1] * 5
+
+    batches = list(main.iter_ndjson_batches(path, chunk_rows=2, skip_records=3))
+    assert [json.loads(l)['device_id'] for l in batches[0][0].splitlines()] == ['dev-3', 'dev-4']
+
+def test_send_to_nifi_posts_gzip_ndjson_with_batch_headers(mocker, make_handler):
+    session = MagicMock()
+    handler = make_handler(session=session)
+
+    assert handler.send_to_nifi(b'{"a":1}\n', 'a.csv', 3, 1, is_last=True, batch_id='abc-30') is True
+
+    (url,), kwargs = session.post.call_args
+    assert url == main.NIFI_ENDPOINT_URL
+    assert gzip.decompress(kwargs['data']) == b'{"a":1}\n'
+    headers = kwargs['headers']
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Content-Type'] == 'application/x-ndjson'
+    assert (headers['X-Filename'], headers['X-Batch-Sequence'], headers['X-Batch-Records']) == ('a.csv', '3', '1')
+    assert (headers['X-Batch-Last'], headers['X-Batch-Id']) == ('true', 'abc-30')
+
+    session.post.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError('503')
+    assert handler.send_to_nifi(b'{"a":1}\n', 'a.csv', 3, 1, is_last=True, batch_id='abc-30') is False
+
+def test_a_failed_upload_resumes_after_the_last_acknowledged_batch(mocker, make_handler, tmp_path):
+    path = write_csv(tmp_path / 'a.csv', 5)
+    batches = main.iter_ndjson_batches
+    mocker.patch.object(main, 'iter_ndjson_batches',  # two records per batch
+                        lambda path, skip_records: batches(path, max_bytes=70, skip_records=skip_records))
+    handler = make_handler(session=MagicMock(), sent_index=SentIndex(str(tmp_path / 'sent.sqlite3')))
+    sent = []
+
+    def send(payload, filename, sequence, record_count, is_last, batch_id):
+        sent.append((sequence, record_count, is_last, batch_id))
+        return len(sent) != 2  # the second batch fails once
+
+    mocker.patch.object(handler, 'send_to_nifi', side_effect=send)
+
+    assert handler.process_csv(path, 'abc') is False
+    assert handler.sent_index.progress('abc') == (2, 1)
+    assert handler.process_csv(path, 'abc') is True
+
+    assert sent == [
+        (0, 2, False, 'abc-0'),
+        (1, 2, False, 'abc-2'),
+        (1, 2, False, 'abc-2'),
+        (2, 1, True, 'abc-4'),
+    ]
+
+def fake_event(src_path, dest_path=None, is_directory=False):
+    return SimpleNamespace(src_path=src_path, dest_path=dest_path, is_directory=is_directory)
+
+def test_watched_files_are_queued_once_unchanged_for_the_settle_time(tmp_path):
+    path = str(tmp_path / 'a.csv')
+    with open(path, 'w') as f:
+        f.write('device_id\n')
+    clock = FakeClock()
+    dispatcher = main.FileDispatcher(MagicMock(), workers=1, settle_seconds=2, clock=clock)
+
+    dispatcher.watch(path)
+    assert dispatcher._settled_paths() == []  # first look records size and mtime
+    clock.now += 1.5
+    with open(path, 'a') as f:
+        f.write('aerps-7\n')  # still being written: the settle timer restarts
+    assert dispatcher._settled_paths() == []
+    clock.now += 1.9
+    assert dispatcher._settled_paths() == []
+    clock.now += 0.1
+    assert dispatcher._settled_paths() == [path]
+
+    # A file that is queued or being processed is not watched a second time.
+    dispatcher.watch(path)
+    dispatcher.submit(path)
+    assert dispatcher._pending == {}
+
+def test_submitted_files_are_queued_without_settling(tmp_path):
+    path = str(tmp_path / 'a.csv')
+    with open(path, 'w') as f:
+        f.write('device_id\n')
+    dispatcher = main.FileDispatcher(MagicMock(), workers=1, settle_seconds=60, clock=FakeClock())
+
+    dispatcher.watch(path)
+    dispatcher.submit(path)
+
+    assert dispatcher._settled_paths() == [path]
+
+def test_a_full_queue_holds_back_the_monitor(tmp_path):
+    paths = []
+    for name in ('a.csv', 'b.csv', 'c.csv'):
+        paths.append(str(tmp_path / name))
+        with open(paths[-1], 'w') as f:
+            f.write('device_id\n')
+    release = threading.Event()
+    started = threading.Event()
+    processed = []
+
+    def process(path):
+        started.set()
+        release.wait(5)
+        processed.append(path)
+        return True
+
+    dispatcher = main.FileDispatcher(process, workers=1, queue_size=1, check_interval=0.01)
+    dispatcher.start()
+    try:
+        for path in paths:
+            dispatcher.submit(path)
+        assert started.wait(5)
+        # One file is being processed and one waits in the queue; the monitor blocks on the third.
+        deadline = time.monotonic() + 5
+        while not dispatcher._queue.full() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert dispatcher._queue.full()
+        assert processed == []
+    finally:
+        release.set()
+        dispatcher.stop()
+
+    assert sorted(processed) == paths
+
+def test_close_and_move_events_submit_csv_files_immediately(make_handler):
+    handler = make_handler(session=MagicMock())
+    handler.dispatcher = MagicMock()
+    watched = os.path.join(main.WATCH_DIRECTORY, 'a.csv')
+
+    handler.on_created(fake_event(watched))
+    handler.on_closed(fake_event(watched))
+    handler.on_moved(fake_event(os.path.join(main.WATCH_DIRECTORY, 'a.tmp'), dest_path=watched))
+
+    handler.dispatcher.watch.assert_called_once_with(watched)
+    assert handler.dispatcher.submit.call_args_list == [((watched,),), ((watched,),)]
+
+def test_events_for_other_files_are_ignored(make_handler, tmp_path):
+    handler = make_handler(session=MagicMock())
+    handler.dispatcher = MagicMock()
+
+    handler.on_created(fake_event(os.path.join(main.WATCH_DIRECTORY, 'a.txt')))
+    handler.on_closed(fake_event(os.path.join(main.WATCH_DIRECTORY, 'sub.csv'), is_directory=True))
+    handler.on_closed(fake_event(str(tmp_path / 'elsewhere.csv')))
+    handler.on_moved(fake_event(os.path.join(main.WATCH_DIRECTORY, 'a.csv'), dest_path=str(tmp_path / 'a.csv')))
+
+    handler.dispatcher.watch.assert_not_called()
+    handler.dispatcher.submit.assert_not_called()
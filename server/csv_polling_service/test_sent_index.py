@@ -0,0 +1,53 @@
+import pytest
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from sent_index import SentIndex
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / 'sent.sqlite3')
+
+def test_recorded_files_are_loaded_by_path_and_found_by_hash(index_path):
+    index = SentIndex(index_path)
+    index.record('/watch/a.csv', 10, 111, 'aaa')
+    index.record('/watch/b.csv', 20, 222, 'bbb')
+
+    assert index.load() == {'/watch/a.csv': (10, 111), '/watch/b.csv': (20, 222)}
+    assert index.contains_hash('bbb')
+    assert not index.contains_hash('ccc')
+    index.close()
+
+def test_recording_a_path_again_replaces_its_entry(index_path):
+    index = SentIndex(index_path)
+    index.record('/watch/a.csv', 10, 111, 'aaa')
+    index.record('/watch/a.csv', 12, 333, 'abc')
+
+    assert index.load() == {'/watch/a.csv': (12, 333)}
+    assert not index.contains_hash('aaa')
+    index.close()
+
+def test_entries_survive_a_restart(index_path):
+    index = SentIndex(index_path)
+    index.record('/watch/a.csv', 10, 111, 'aaa')
+    index.close()
+
+    reopened = SentIndex(index_path)
+    assert reopened.load() == {'/watch/a.csv': (10, 111)}
+    assert reopened.contains_hash('aaa')
+    reopened.close()
+
+def test_upload_progress_is_kept_until_the_file_is_recorded(index_path):
+    index = SentIndex(index_path)
+    assert index.progress('aaa') == (0, 0)
+
+    index.record_progress('aaa', 500, 2)
+    index.close()
+    index = SentIndex(index_path)
+    assert index.progress('aaa') == (500, 2)
+
+    index.record('/watch/a.csv', 10, 111, 'aaa')
+    assert index.progress('aaa') == (0, 0)
+    index.close()
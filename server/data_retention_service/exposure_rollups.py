@@ -0,0 +1,213 @@
+import json
+import logging
+from datetime import date, datetime, time, timedelta, timezone
+
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Per (day, unit, device, location, sign, log bucket): count/min/max/sum. NUMERIC
+# is cast to float8 once; |value| below 1e-9 is counted as zero.
+ROLLUP_BUCKET_QUERY = """
+    SELECT
+        (timestamp_utc AT TIME ZONE 'UTC')::date AS day,
+        unit,
+        COALESCE(device_id, '') AS device_id,
+        COALESCE(location_code, '') AS location_code,
+        sign(v)::int AS sign,
+        CASE WHEN abs(v) > 1e-9 THEN ceil(ln(abs(v)) / ln(%s))::int END AS bucket,
+        count(*), min(v), max(v), sum(v)
+    FROM (
+        SELECT timestamp_utc, unit, device_id, location_code, value::float8 AS v
+        FROM exposures
+        WHERE timestamp_utc >= %s AND timestamp_utc < %s
+    ) slice
+    GROUP BY 1, 2, 3, 4, 5, 6
+"""
+
+
+# --- Log-bucket quantile sketch ---
+
+def sketch_gamma(alpha):
+    return (1 + alpha) / (1 - alpha)
+
+
+def new_sketch(alpha):
+    return {'alpha': alpha, 'zero': 0, 'pos': {}, 'neg': {}}
+
+
+def add_bucket(sketch, sign, bucket, count):
+    """Adds count values of the given sign to a log bucket (bucket is None for zeros)."""
+    if sign == 0 or bucket is None:
+        sketch['zero'] += count
+        return
+    side = sketch['pos'] if sign > 0 else sketch['neg']
+    key = str(bucket)
+    side[key] = side.get(key, 0) + count
+
+
+def merge_sketches(sketches):
+    """Merges sketches with the same alpha; the result is exact with respect to the inputs' buckets."""
+    sketches = list(sketches)
+    merged = new_sketch(sketches[0]['alpha'])
+    for sketch in sketches:
+        if sketch['alpha'] != merged['alpha']:
+            raise ValueError("Cannot merge sketches with different accuracy.")
+        merged['zero'] += sketch['zero']
+        for side in ('pos', 'neg'):
+            for key, count in sketch[side].items():
+                merged[side][key] = merged[side].get(key, 0) + count
+    return merged
+
+
+def sketch_quantile(sketch, q, min_value=None, max_value=None):
+    """Returns the q-quantile estimate, within the sketch's relative accuracy."""
+    gamma = sketch_gamma(sketch['alpha'])
+    # Ascending value order: negatives by decreasing magnitude, then zeros, then positives.
+    ordered = [(-1, int(k), c) for k, c in sorted(sketch['neg'].items(), key=lambda item: -int(item[0]))]
+    ordered.append((0, None, sketch['zero']))
+    ordered.extend((1, int(k), c) for k, c in sorted(sketch['pos'].items(), key=lambda item: int(item[0])))
+
+    total = sum(c for _, _, c in ordered)
+    if not total:
+        return None
+    rank = q * (total - 1)
+    seen = 0
+    for sign, bucket, count in ordered:
+        seen += count
+        if count and seen > rank:
+            value = 0.0 if sign == 0 else sign * 2 * gamma ** bucket / (gamma + 1)
+            break
+    if min_value is not None:
+        value = max(value, min_value)
+    if max_value is not None:
+        value = min(value, max_value)
+    return value
+
+
+# --- Rollups ---
+
+def day_start(day):
+    return datetime.combine(day, time(), tzinfo=timezone.utc)
+
+
+def summary_row(period, key, stats, sketch):
+    count, min_value, max_value, sum_value = stats
+    quantiles = [sketch_quantile(sketch, q, min_value, max_value) for q in QUANTILES]
+    return (period, *key, count, min_value, max_value, sum_value, sum_value / count, *quantiles, json.dumps(sketch))
+
+
+def upsert_summaries(cur, table, period_column, rows):
+    execute_values(
+        cur,
+        f"""
+        INSERT INTO {table} ({period_column}, unit, device_id, location_code, sample_count, min_value, max_value,
+                             sum_value, mean_value, p50_value, p95_value, p99_value, sketch)
+        VALUES %s
+        ON CONFLICT ({period_column}, unit, device_id, location_code) DO UPDATE
+        SET sample_count = EXCLUDED.sample_count,
+            min_value = EXCLUDED.min_value,
+            max_value = EXCLUDED.max_value,
+            sum_value = EXCLUDED.sum_value,
+            mean_value = EXCLUDED.mean_value,
+            p50_value = EXCLUDED.p50_value,
+            p95_value = EXCLUDED.p95_value,
+            p99_value = EXCLUDED.p99_value,
+            sketch = EXCLUDED.sketch
+        """,
+        rows,
+        page_size=1000
+    )
+
+
+def rollup_days(conn, first_day, end_day, alpha):
+    """Summarizes raw exposures for [first_day, end_day) into exposure_daily_summary in one transaction."""
+    groups = {}
+    with conn.cursor() as cur:
+        cur.execute(ROLLUP_BUCKET_QUERY, (sketch_gamma(alpha), day_start(first_day), day_start(end_day)))
+        for day, unit, device_id, location_code, sign, bucket, count, min_value, max_value, sum_value in cur:
+            key = (day, unit, device_id, location_code)
+            if key not in groups:
+                groups[key] = ([0, min_value, max_value, 0.0], new_sketch(alpha))
+            stats, sketch = groups[key]
+            stats[0] += count
+            stats[1] = min(stats[1], min_value)
+            stats[2] = max(stats[2], max_value)
+            stats[3] += sum_value
+            add_bucket(sketch, sign, bucket, count)
+        rows = [summary_row(key[0], key[1:], stats, sketch) for key, (stats, sketch) in groups.items()]
+        if rows:
+            upsert_summaries(cur, 'exposure_daily_summary', 'day', rows)
+    conn.commit()
+    return len(rows)
+
+
+def rollup_month(conn, month):
+    """Rebuilds exposure_monthly_summary for one month by merging its daily summaries."""
+    next_month = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+    groups = {}
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT unit, device_id, location_code, sample_count, min_value, max_value, sum_value, sketch
+            FROM exposure_daily_summary
+            WHERE day >= %s AND day < %s
+            """,
+            (month, next_month)
+        )
+        for unit, device_id, location_code, count, min_value, max_value, sum_value, sketch in cur:
+            groups.setdefault((unit, device_id, location_code), []).append((count, min_value, max_value, sum_value, sketch))
+        rows = []
+        for key, days in groups.items():
+            stats = (
+                sum(d[0] for d in days), min(d[1] for d in days), max(d[2] for d in days), sum(d[3] for d in days)
+            )
+            rows.append(summary_row(month, key, stats, merge_sketches(d[4] for d in days)))
+        if rows:
+            upsert_summaries(cur, 'exposure_monthly_summary', 'month', rows)
+    conn.commit()
+    return len(rows)
+
+
+def rolled_up_until(conn):
+    """Returns the first day not yet summarized (or the first raw day), or None if there is no data."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT max(day) FROM exposure_daily_summary")
+        last_day = cur.fetchone()[0]
+        if last_day is None:
+            cur.execute("SELECT (min(timestamp_utc) AT TIME ZONE 'UTC')::date FROM exposures")
+            first_day = cur.fetchone()[0]
+        else:
+            first_day = last_day + timedelta(days=1)
+    conn.commit()
+    return first_day
+
+
+def run_rollups(conn, until, slice_days=1, alpha=0.01):
+    """
+    Summarizes every whole UTC day before `until` (a date) that is not yet
+    summarized, slice_days at a time with a commit per slice, and rebuilds the
+    monthly summary of each month touched. Returns the first day that is not
+    summarized, i.e. raw data before it may be purged.
+    """
+    day = rolled_up_until(conn)
+    if day is None:
+        return until
+    months = set()
+    total_days = max((until - day).days, 0)
+    while day < until:
+        end_day = min(day + timedelta(days=slice_days), until)
+        groups = rollup_days(conn, day, end_day, alpha)
+        month = date(day.year, day.month, 1)
+        while month < end_day:
+            months.add(month)
+            month = (month + timedelta(days=32)).replace(day=1)
+        done = total_days - (until - end_day).days
+        logger.info(f"Rolled up {day} - {end_day - timedelta(days=1)} ({groups} groups); {done}/{total_days} days done.")
+        day = end_day
+    for month in sorted(months):
+        groups = rollup_month(conn, month)
+        logger.info(f"Rebuilt monthly summary for {month:%Y-%m} ({groups} groups).")
+    return day
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import logging
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from checksums import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# One wide row per exposure; detail columns are NULL unless the matching detail table has a row.
+ARCHIVE_SCHEMA = pa.schema([
+    ('sample_id', pa.string()),
+    ('device_id', pa.string()),
+    ('location_code', pa.string()),
+    ('timestamp_utc', pa.timestamp('us', tz='UTC')),
+    ('captured_by', pa.string()),
+    ('method_code', pa.string()),
+    ('value', pa.float64()),
+    ('unit', pa.string()),
+    ('qualifier', pa.string()),
+    ('detail_table', pa.string()),
+    ('duration_sec', pa.int32()),
+    ('flow_rate_lpm', pa.float64()),
+    ('filter_type', pa.string()),
+    ('compound_name', pa.string()),
+    ('media_type', pa.string()),
+    ('humidity_pct', pa.float64()),
+    ('dosimeter_interval_min', pa.int32()),
+    ('laeq', pa.float64()),
+    ('peak_db', pa.float64()),
+    ('detector_type', pa.string()),
+    ('shielding_cm', pa.float64()),
+    ('calibration_date', pa.date32()),
+    ('sample_type', pa.string()),
+    ('temp_c', pa.float64()),
+    ('residual_chlorine_mg_l', pa.float64()),
+    ('db_c', pa.float64()),
+    ('wb_c', pa.float64()),
+    ('globe_c', pa.float64()),
+    ('flag_color', pa.string()),
+])
+
+ARCHIVE_QUERY = """
+    SELECT
+        e.sample_id::text, e.device_id, e.location_code, e.timestamp_utc, e.captured_by, e.method_code,
+        e.value::float8, e.unit, e.qualifier,
+        CASE
+            WHEN a.sample_id IS NOT NULL THEN 'air_quality_details'
+            WHEN v.sample_id IS NOT NULL THEN 'voc_details'
+            WHEN n.sample_id IS NOT NULL THEN 'noise_details'
+            WHEN r.sample_id IS NOT NULL THEN 'radiation_details'
+            WHEN w.sample_id IS NOT NULL THEN 'water_details'
+            WHEN h.sample_id IS NOT NULL THEN 'heat_stress_details'
+        END,
+        a.duration_sec, a.flow_rate_lpm::float8, a.filter_type,
+        v.compound_name, v.media_type, v.humidity_pct::float8,
+        n.dosimeter_interval_min, n.laeq::float8, n.peak_db::float8,
+        r.detector_type, r.shielding_cm::float8, r.calibration_date,
+        w.sample_type, w.temp_c::float8, w.residual_chlorine_mg_l::float8,
+        h.db_c::float8, h.wb_c::float8, h.globe_c::float8, h.flag_color
+    FROM exposures e
+    LEFT JOIN air_quality_details a ON a.sample_id = e.sample_id
+    LEFT JOIN voc_details v ON v.sample_id = e.sample_id
+    LEFT JOIN noise_details n ON n.sample_id = e.sample_id
+    LEFT JOIN radiation_details r ON r.sample_id = e.sample_id
+    LEFT JOIN water_details w ON w.sample_id = e.sample_id
+    LEFT JOIN heat_stress_details h ON h.sample_id = e.sample_id
+    WHERE e.timestamp_utc >= %s AND e.timestamp_utc < %s
+"""
+
+
+def archive_directory_writable(directory):
+    """True if directory is, or could be created as, a writable directory. Creates nothing."""
+    path = os.path.abspath(directory)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK)
+
+
+class ParquetArchiver:
+    """
+    Streams expired exposure ranges (joined with their detail rows) out of
+    Postgres through a server-side cursor into compressed Parquet files under
+    directory/year=YYYY/month=MM/unit=<unit>/. Every verified range is appended
+    to directory/manifest.jsonl; only verified ranges may be purged.
+    """
+
+    def __init__(self, directory, compression='zstd', fetch_rows=50000):
+        self.directory = directory
+        self.compression = compression
+        self.fetch_rows = fetch_rows
+        self.manifest_path = os.path.join(directory, 'manifest.jsonl')
+        os.makedirs(directory, exist_ok=True)
+
+    def archived_ranges(self):
+        """Returns the set of (range_start, range_end) ISO strings already archived and verified."""
+        if not os.path.exists(self.manifest_path):
+            return set()
+        with open(self.manifest_path, encoding='utf-8') as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        return {(e['range_start'], e['range_end']) for e in entries}
+
+    def partition_path(self, year, month, unit, range_start, range_end):
+        filename = f"exposures_{range_start:%Y%m%dT%H%M%S}_{range_end:%Y%m%dT%H%M%S}.parquet"
+        return os.path.join(
+            self.directory, f"year={year:04d}", f"month={month:02d}", f"unit={quote(unit, safe='')}", filename
+        )
+
+    def _write_batch(self, writers, rows, range_start, range_end):
+        """Splits a fetched batch by (year, month, unit) and appends each part to its partition's writer."""
+        table = pa.Table.from_pylist([dict(zip(ARCHIVE_SCHEMA.names, row)) for row in rows], schema=ARCHIVE_SCHEMA)
+        partitions = {}
+        for index, (ts, unit) in enumerate(zip(table.column('timestamp_utc').to_pylist(), table.column('unit').to_pylist())):
+            partitions.setdefault((ts.year, ts.month, unit), []).append(index)
+        for key, indices in partitions.items():
+            if key not in writers:
+                path = self.partition_path(*key, range_start, range_end)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writers[key] = (path, pq.ParquetWriter(path + '.part', ARCHIVE_SCHEMA, compression=self.compression))
+            writers[key][1].write_table(table.take(indices))
+
+    def archive_range(self, conn, range_start, range_end):
+        """
+        Archives exposures in [range_start, range_end). Returns True once the files
+        are written and verified (or the range was archived by an earlier run).
+        The row count and the stream share one REPEATABLE READ snapshot, so rows
+        written into the range meanwhile cannot fail the verification.
+        """
+        key = (range_start.isoformat(), range_end.isoformat())
+        if key in self.archived_ranges():
+            logger.info(f"Range {range_start} - {range_end} is already archived.")
+            return True
+
+        writers = {}
+        streamed = 0
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                cur.execute(
+                    "SELECT count(*) FROM exposures WHERE timestamp_utc >= %s AND timestamp_utc < %s",
+                    (range_start, range_end)
+                )
+                expected = cur.fetchone()[0]
+            with conn.cursor(name=f"archive_{range_start:%Y%m%d%H%M%S}") as cur:
+                cur.itersize = self.fetch_rows
+                cur.execute(ARCHIVE_QUERY, (range_start, range_end))
+                while True:
+                    rows = cur.fetchmany(self.fetch_rows)
+                    if not rows:
+                        break
+                    self._write_batch(writers, rows, range_start, range_end)
+                    streamed += len(rows)
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to archive {range_start} - {range_end}: {e}")
+            conn.rollback()
+            for path, writer in writers.values():
+                writer.close()
+                os.remove(path + '.part')
+            return False
+        for _, writer in writers.values():
+            writer.close()
+
+        # Verify before anything may be deleted: row counts must match the database and the written files.
+        written = sum(pq.read_metadata(path + '.part').num_rows for path, _ in writers.values())
+        if streamed != expected or written != expected:
+            logger.error(
+                f"Archive verification failed for {range_start} - {range_end}: "
+                f"{expected} rows in database, {streamed} streamed, {written} written."
+            )
+            for path, _ in writers.values():
+                os.remove(path + '.part')
+            return False
+
+        files = []
+        for path, _ in writers.values():
+            os.replace(path + '.part', path)
+            files.append({
+                'path': os.path.relpath(path, self.directory),
+                'rows': pq.read_metadata(path).num_rows,
+                'bytes': os.path.getsize(path),
+                'sha256': file_sha256(path),
+            })
+        with open(self.manifest_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({
+                'range_start': key[0],
+                'range_end': key[1],
+                'rows': expected,
+                'files': files,
+                'archived_at': datetime.now(timezone.utc).isoformat(),
+            }) + '\n')
+        logger.info(f"Archived {expected} rows from {range_start} - {range_end} into {len(files)} Parquet files.")
+        return True
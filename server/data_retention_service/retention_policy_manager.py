@@ -1,8 +1,17 @@
 import os
+import sys
+import time
 import logging
-import psycopg2
+import argparse
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from db_pool import connect
+
+from parquet_archiver import ParquetArchiver, archive_directory_writable
+from exposure_rollups import run_rollups, day_start
+
 # --- Load Configuration ---
 load_dotenv()
 
@@ -17,6 +26,36 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 RAW_DATA_RETENTION_YEARS = int(os.getenv("RAW_DATA_RETENTION_YEARS", 5))
 AGGREGATE_DATA_RETENTION_YEARS = int(os.getenv("AGGREGATE_DATA_RETENTION_YEARS", 10))
 
+# Purge Batching Config
+PURGE_SLICE_HOURS = float(os.getenv("PURGE_SLICE_HOURS", 6))
+PURGE_MAX_ROWS_PER_SECOND = int(os.getenv("PURGE_MAX_ROWS_PER_SECOND", 50000))
+PURGE_PAUSE_SECONDS = float(os.getenv("PURGE_PAUSE_SECONDS", 0.1))
+PURGE_LOCK_TIMEOUT_MS = int(os.getenv("PURGE_LOCK_TIMEOUT_MS", 5000))
+
+# Rollup Config: raw exposures are summarized per UTC day/month before they are purged
+ROLLUP_ENABLED = os.getenv("ROLLUP_ENABLED", "true").lower() in ("1", "true", "yes")
+ROLLUP_SLICE_DAYS = int(os.getenv("ROLLUP_SLICE_DAYS", 1))
+ROLLUP_LAG_DAYS = int(os.getenv("ROLLUP_LAG_DAYS", 2))
+SKETCH_ALPHA = float(os.getenv("SKETCH_ALPHA", 0.01))
+
+# Parquet Archive Config (archiving is enabled when ARCHIVE_DIRECTORY is set)
+ARCHIVE_DIRECTORY = os.getenv("ARCHIVE_DIRECTORY", "")
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zstd")
+ARCHIVE_FETCH_ROWS = int(os.getenv("ARCHIVE_FETCH_ROWS", 50000))
+
+DETAIL_TABLES = [
+    'air_quality_details',
+    'voc_details',
+    'noise_details',
+    'radiation_details',
+    'water_details',
+    'heat_stress_details',
+]
+AGGREGATE_VIEWS = [
+    'hourly_air_quality_summary',
+    'hourly_heat_stress_summary',
+]
+
 # Logging Config
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
@@ -26,70 +65,353 @@ logger = logging.getLogger(__name__)
 
 def get_db_connection():
     """Establishes and returns a connection to the PostgreSQL database."""
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
+    return connect(dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD))
+
+def get_cutoff(conn, years):
+    """Returns NOW() - years, truncated to a UTC day boundary, as evaluated by the database."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT date_trunc('day', (NOW() - make_interval(years => %s)) AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'",
+            (years,)
+        )
+        cutoff = cur.fetchone()[0]
+    conn.commit()
+    return cutoff
+
+def raw_purge_cutoff(conn, dry_run=False):
+    """
+    Returns the cutoff for purging raw exposures: RAW_DATA_RETENTION_YEARS back,
+    but never past the first day missing from the summaries. With rollups
+    enabled, a run first summarizes every day before today - ROLLUP_LAG_DAYS;
+    a dry run assumes that rollup succeeds instead of writing it.
+    """
+    raw_cutoff = get_cutoff(conn, RAW_DATA_RETENTION_YEARS)
+    if not ROLLUP_ENABLED:
+        return raw_cutoff
+    until = datetime.now(timezone.utc).date() - timedelta(days=ROLLUP_LAG_DAYS)
+    rolled_until = day_start(until if dry_run else run_rollups(conn, until, ROLLUP_SLICE_DAYS, SKETCH_ALPHA))
+    if rolled_until < raw_cutoff:
+        logger.warning(f"Summaries only reach {rolled_until}; purging raw data up to there.")
+        return rolled_until
+    return raw_cutoff
+
+def list_expired_chunks(conn, hypertable, cutoff):
+    """Returns (chunk_schema, chunk_name, range_start, range_end) for every chunk of hypertable starting before cutoff."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT chunk_schema, chunk_name, range_start, range_end
+            FROM timescaledb_information.chunks
+            WHERE hypertable_name = %s AND range_start < %s
+            ORDER BY range_start
+            """,
+            (hypertable, cutoff)
+        )
+        chunks = cur.fetchall()
+    conn.commit()
+    return chunks
+
+def iter_slices(start, end, step):
+    """Yields consecutive [slice_start, slice_end) ranges covering [start, end)."""
+    while start < end:
+        yield start, min(start + step, end)
+        start += step
+
+class PurgeThrottle:
+    """Sleeps between batches so the purge stays under max_rows_per_second (0 disables it)."""
+
+    def __init__(self, max_rows_per_second):
+        self.max_rows_per_second = max_rows_per_second
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def record(self, rows):
+        self.rows += rows
+        if self.max_rows_per_second > 0:
+            ahead = self.rows / self.max_rows_per_second - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+        if PURGE_PAUSE_SECONDS:
+            time.sleep(PURGE_PAUSE_SECONDS)
+
+    @property
+    def rate(self):
+        return self.rows / max(time.monotonic() - self.started, 1e-6)
+
+def run_batch(conn, query, params):
+    """Executes one purge statement in its own short transaction. Returns the affected row count."""
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = %s", (f"{PURGE_LOCK_TIMEOUT_MS}ms",))
+        cur.execute(query, params)
+        count = cur.rowcount
+    conn.commit()
+    return count
+
+def purge_detail_slice(conn, slice_start, slice_end):
+    """Deletes the detail rows of exposures in [slice_start, slice_end), one table per transaction."""
+    deleted = 0
+    for table in DETAIL_TABLES:
+        deleted += run_batch(
+            conn,
+            f"""
+            DELETE FROM {table} d
+            USING exposures e
+            WHERE d.sample_id = e.sample_id
+            AND e.timestamp_utc >= %s AND e.timestamp_utc < %s
+            """,
+            (slice_start, slice_end)
         )
-        return conn
-    except psycopg2.OperationalError as e:
-        logger.error(f"Could not connect to the database: {e}")
-        return None
+    return deleted
+
+def drop_exposure_chunk(conn, range_start, range_end):
+    """Drops exactly the exposures chunk covering [range_start, range_end)."""
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = %s", (f"{PURGE_LOCK_TIMEOUT_MS}ms",))
+        cur.execute(
+            "SELECT drop_chunks('exposures', older_than => %s, newer_than => %s)",
+            (range_end, range_start)
+        )
+        dropped = len(cur.fetchall())
+    conn.commit()
+    return dropped
+
+def purge_raw_data(conn, cutoff, throttle, archiver=None):
+    """
+    Purges exposures older than cutoff. Chunks that lie entirely before the
+    cutoff are dropped whole after their detail rows are removed slice by slice;
+    the chunk that straddles the cutoff is deleted in time slices, each its own
+    transaction (ON DELETE CASCADE removes the detail rows of that slice).
+    With an archiver, a range is only purged once its archive is verified.
+    Returns (chunks_dropped, detail_rows_deleted, exposure_rows_deleted).
+    """
+    step = timedelta(hours=PURGE_SLICE_HOURS)
+    chunks = list_expired_chunks(conn, 'exposures', cutoff)
+    logger.info(f"Found {len(chunks)} exposures chunks starting before {cutoff}.")
+
+    chunks_dropped = detail_rows = exposure_rows = 0
+    for index, (schema, name, range_start, range_end) in enumerate(chunks, start=1):
+        if archiver and not archiver.archive_range(conn, range_start, min(range_end, cutoff)):
+            logger.warning(f"[{index}/{len(chunks)}] kept {schema}.{name}: its archive could not be verified.")
+            continue
+        if range_end <= cutoff:
+            for slice_start, slice_end in iter_slices(range_start, range_end, step):
+                deleted = purge_detail_slice(conn, slice_start, slice_end)
+                detail_rows += deleted
+                throttle.record(deleted)
+            chunks_dropped += drop_exposure_chunk(conn, range_start, range_end)
+            action = "dropped"
+        else:
+            for slice_start, slice_end in iter_slices(range_start, cutoff, step):
+                deleted = run_batch(
+                    conn,
+                    "DELETE FROM exposures WHERE timestamp_utc >= %s AND timestamp_utc < %s",
+                    (slice_start, slice_end)
+                )
+                exposure_rows += deleted
+                throttle.record(deleted)
+            action = "trimmed"
+        logger.info(
+            f"[{index}/{len(chunks)}] {action} {schema}.{name} ({range_start} - {range_end}); "
+            f"{chunks_dropped} chunks dropped, {detail_rows} detail and {exposure_rows} exposure rows deleted, "
+            f"{throttle.rate:,.0f} rows/s."
+        )
+    return chunks_dropped, detail_rows, exposure_rows
 
 def apply_retention_policies(conn):
     """
     Deletes data from the database that is older than the defined retention periods.
+    Work is done in many short transactions so ingest is never blocked for long;
+    an interrupted run simply resumes where it stopped on the next run.
     """
     try:
-        with conn.cursor() as cur:
-            # --- 1. Purge Raw Sensor Data ---
-            # The ON DELETE CASCADE foreign key constraint will automatically clean up
-            # records in the detail tables (e.g., noise_details, water_details).
-            raw_cutoff_date = f"NOW() - INTERVAL '{RAW_DATA_RETENTION_YEARS} years'"
-            logger.info(f"Deleting raw exposure data older than {RAW_DATA_RETENTION_YEARS} years...")
-            
-            raw_delete_query = f"DELETE FROM exposures WHERE timestamp_utc < {raw_cutoff_date};"
-            cur.execute(raw_delete_query)
-            
-            deleted_raw_count = cur.rowcount
-            logger.info(f"Deleted {deleted_raw_count} raw exposure records.")
-
-            # --- 2. Purge Aggregated Data ---
-            # We need to do this for each continuous aggregate view.
-            agg_cutoff_date = f"NOW() - INTERVAL '{AGGREGATE_DATA_RETENTION_YEARS} years'"
-            aggregate_views = [
-                'hourly_air_quality_summary',
-                'hourly_heat_stress_summary'
-            ]
-
-            for view_name in aggregate_views:
-                logger.info(f"Deleting aggregated data from {view_name} older than {AGGREGATE_DATA_RETENTION_YEARS} years...")
-                agg_delete_query = f"DELETE FROM {view_name} WHERE bucket < {agg_cutoff_date};"
-                cur.execute(agg_delete_query)
-                deleted_agg_count = cur.rowcount
-                logger.info(f"Deleted {deleted_agg_count} aggregated records from {view_name}.")
+        # --- 1. Purge Raw Sensor Data ---
+        logger.info(f"Purging raw exposure data older than {RAW_DATA_RETENTION_YEARS} years...")
+        # Raw rows are only purged once their days are in the daily/monthly summaries.
+        raw_cutoff = raw_purge_cutoff(conn)
+        throttle = PurgeThrottle(PURGE_MAX_ROWS_PER_SECOND)
+        archiver = None
+        if ARCHIVE_DIRECTORY:
+            archiver = ParquetArchiver(ARCHIVE_DIRECTORY, ARCHIVE_COMPRESSION, ARCHIVE_FETCH_ROWS)
+            logger.info(f"Archiving expired ranges to {ARCHIVE_DIRECTORY} before purging.")
+        chunks_dropped, detail_rows, exposure_rows = purge_raw_data(conn, raw_cutoff, throttle, archiver)
+        logger.info(
+            f"Dropped {chunks_dropped} chunks and deleted {exposure_rows} raw exposure records "
+            f"({detail_rows} detail records removed ahead of chunk drops)."
+        )
 
+        # --- 2. Purge Aggregated Data ---
+        # Continuous aggregates are hypertables too; whole expired chunks are dropped.
+        agg_cutoff = get_cutoff(conn, AGGREGATE_DATA_RETENTION_YEARS)
+        for view_name in AGGREGATE_VIEWS:
+            logger.info(f"Dropping aggregated data from {view_name} older than {AGGREGATE_DATA_RETENTION_YEARS} years...")
+            with conn.cursor() as cur:
+                cur.execute("SELECT drop_chunks(%s, older_than => %s)", (view_name, agg_cutoff))
+                dropped = len(cur.fetchall())
             conn.commit()
-            logger.info("Successfully applied all data retention policies.")
+            logger.info(f"Dropped {dropped} chunks from {view_name}.")
+
+        logger.info("Successfully applied all data retention policies.")
 
     except Exception as e:
         logger.error(f"An error occurred while applying retention policies: {e}")
         conn.rollback()
 
-def run_retention_manager():
-    """Main function to run the data retention process."""
+# --- Dry Run ---
+
+def relation_estimate(cur, schema, name):
+    """Returns (planner row estimate, total bytes incl. indexes and TOAST) for a relation, without scanning it."""
+    cur.execute(
+        """
+        SELECT GREATEST(c.reltuples, 0)::bigint, pg_total_relation_size(c.oid)
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s
+        """,
+        (schema, name)
+    )
+    row = cur.fetchone()
+    return (int(row[0]), int(row[1])) if row else (0, 0)
+
+def explain_rows(cur, query, params):
+    """Returns the planner's row estimate for query (EXPLAIN only, the query is not executed)."""
+    cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+    return int(cur.fetchone()[0][0]['Plan']['Plan Rows'])
+
+def scaled_bytes(total_bytes, rows, total_rows):
+    return int(total_bytes * rows / total_rows) if total_rows else 0
+
+def estimate_retention(conn):
+    """
+    Estimates what apply_retention_policies would remove, using chunk metadata,
+    pg_class statistics and EXPLAIN row estimates instead of COUNT(*) scans.
+    Uses the same rollup-capped cutoff as a real run. When ARCHIVE_DIRECTORY
+    cannot be written, no archive can be verified, so expired exposure chunks
+    are reported as 'keep' and their detail rows are not counted.
+    Returns {'entries': [...], 'batches': n, 'throttled_rows': n}; each entry is a
+    dict with table, chunk, action ('drop', 'delete' or 'keep'), rows and bytes.
+    """
+    raw_cutoff = raw_purge_cutoff(conn, dry_run=True)
+    archivable = not ARCHIVE_DIRECTORY or archive_directory_writable(ARCHIVE_DIRECTORY)
+    if not archivable:
+        logger.warning(f"{ARCHIVE_DIRECTORY} is not writable; a run would keep every expired exposures chunk.")
+    agg_cutoff = get_cutoff(conn, AGGREGATE_DATA_RETENTION_YEARS)
+    step = timedelta(hours=PURGE_SLICE_HOURS)
+    entries = []
+    batches = throttled_rows = 0
+
+    with conn.cursor() as cur:
+        # Exposures: whole chunks are dropped, the boundary chunk is deleted up to the cutoff.
+        for schema, name, range_start, range_end in list_expired_chunks(conn, 'exposures', raw_cutoff):
+            rows, size = relation_estimate(cur, schema, name)
+            if not archivable:
+                entries.append({'table': 'exposures', 'chunk': f"{schema}.{name}", 'action': 'keep', 'rows': rows, 'bytes': size})
+            elif range_end <= raw_cutoff:
+                slices = len(list(iter_slices(range_start, range_end, step)))
+                batches += slices * len(DETAIL_TABLES) + 1
+                entries.append({'table': 'exposures', 'chunk': f"{schema}.{name}", 'action': 'drop', 'rows': rows, 'bytes': size})
+            else:
+                expired = explain_rows(cur, f'SELECT 1 FROM "{schema}"."{name}" WHERE timestamp_utc < %s', (raw_cutoff,))
+                expired = min(expired, rows) if rows else expired
+                batches += len(list(iter_slices(range_start, raw_cutoff, step)))
+                throttled_rows += expired
+                entries.append({'table': 'exposures', 'chunk': f"{schema}.{name}", 'action': 'delete',
+                                'rows': expired, 'bytes': scaled_bytes(size, expired, rows)})
+
+        # Detail tables: rows joined to expired exposures, removed in slices ahead of the drops or by cascade.
+        for table in DETAIL_TABLES if archivable else []:
+            rows, size = relation_estimate(cur, 'public', table)
+            expired = explain_rows(
+                cur,
+                f"SELECT 1 FROM {table} d JOIN exposures e ON e.sample_id = d.sample_id WHERE e.timestamp_utc < %s",
+                (raw_cutoff,)
+            )
+            expired = min(expired, rows)
+            throttled_rows += expired
+            entries.append({'table': table, 'chunk': '-', 'action': 'delete', 'rows': expired, 'bytes': scaled_bytes(size, expired, rows)})
+
+        # Continuous aggregates: drop_chunks only removes chunks that end before the cutoff.
+        for view_name in AGGREGATE_VIEWS:
+            cur.execute(
+                """
+                SELECT materialization_hypertable_name
+                FROM timescaledb_information.continuous_aggregates
+                WHERE view_name = %s
+                """,
+                (view_name,)
+            )
+            row = cur.fetchone()
+            if not row:
+                continue
+            for schema, name, range_start, range_end in list_expired_chunks(conn, row[0], agg_cutoff):
+                if range_end > agg_cutoff:
+                    continue
+                rows, size = relation_estimate(cur, schema, name)
+                batches += 1
+                entries.append({'table': view_name, 'chunk': f"{schema}.{name}", 'action': 'drop', 'rows': rows, 'bytes': size})
+    conn.rollback()
+    return {'entries': entries, 'batches': batches, 'throttled_rows': throttled_rows}
+
+def estimated_duration_seconds(report):
+    """Expected run time at the configured rate limit and per-batch pause."""
+    seconds = report['batches'] * PURGE_PAUSE_SECONDS
+    if PURGE_MAX_ROWS_PER_SECOND > 0:
+        seconds += report['throttled_rows'] / PURGE_MAX_ROWS_PER_SECOND
+    return seconds
+
+def format_retention_report(report):
+    """
+    Renders the dry-run report as text: one line per chunk/table, per-table
+    totals of what would be removed ('keep' entries are listed but not totalled)
+    and the duration estimate.
+    """
+    lines = [f"{'table':<30} {'chunk':<45} {'action':<7} {'rows':>14} {'MB':>10}"]
+    totals = {}
+    for entry in report['entries']:
+        lines.append(
+            f"{entry['table']:<30} {entry['chunk']:<45} {entry['action']:<7} "
+            f"{entry['rows']:>14,} {entry['bytes'] / 1048576:>10,.1f}"
+        )
+        if entry['action'] == 'keep':
+            continue
+        rows, size = totals.get(entry['table'], (0, 0))
+        totals[entry['table']] = (rows + entry['rows'], size + entry['bytes'])
+    lines.append("")
+    lines.append(f"{'table total':<30} {'':<45} {'':<7} {'rows':>14} {'MB':>10}")
+    for table, (rows, size) in totals.items():
+        lines.append(f"{table:<30} {'':<45} {'':<7} {rows:>14,} {size / 1048576:>10,.1f}")
+    rate = f"{PURGE_MAX_ROWS_PER_SECOND:,} rows/s" if PURGE_MAX_ROWS_PER_SECOND > 0 else "unthrottled"
+    lines.append("")
+    lines.append(
+        f"{report['batches']:,} batches, {report['throttled_rows']:,} rows deleted row by row; "
+        f"estimated duration at {rate}: {timedelta(seconds=round(estimated_duration_seconds(report)))}"
+    )
+    return "\n".join(lines)
+
+def run_retention_manager(dry_run=False, conn=None):
+    """
+    Main function to run the data retention process. dry_run only prints the
+    estimate report. A caller-supplied conn (e.g. from the job scheduler's pool)
+    is left open.
+    """
     logger.info("Starting data retention policy manager...")
-    conn = get_db_connection()
+    owns_conn = conn is None
+    conn = conn or get_db_connection()
     if not conn:
         return
 
     try:
-        apply_retention_policies(conn)
+        if dry_run:
+            print(format_retention_report(estimate_retention(conn)))
+        else:
+            apply_retention_policies(conn)
     finally:
-        if conn:
+        if conn and owns_conn:
             conn.close()
             logger.info("Database connection closed.")
     
     logger.info("Data retention policy manager finished.")
 
 if __name__ == "__main__":
-    run_retention_manager()
+    parser = argparse.ArgumentParser(description="Applies the data retention policies.")
+    parser.add_argument('--dry-run', action='store_true', help="Estimate rows, bytes and duration without deleting anything.")
+    args = parser.parse_args()
+    run_retention_manager(dry_run=args.dry_run)
@@ -1,6 +1,10 @@
 import pytest
+from datetime import date, datetime, timedelta, timezone
 from unittest.mock import MagicMock, patch
-from retention_policy_manager import apply_retention_policies
+from retention_policy_manager import (
+    apply_retention_policies, purge_raw_data, PurgeThrottle, DETAIL_TABLES,
+    estimate_retention, estimated_duration_seconds, format_retention_report
+)
 
 @pytest.fixture
 def mock_db_connection(mocker):
@@ -11,32 +15,280 @@ def mock_db_connection(mocker):
     mock_conn.cursor.return_value.__enter__.return_value = mock_cur
     return mock_conn, mock_cur
 
+def executed(mock_cur, text):
+    """Returns the (query, params) of every execute call containing text."""
+    return [(c[0][0], c[0][1] if len(c[0]) > 1 else None) for c in mock_cur.execute.call_args_list if text in c[0][0]]
+
+CUTOFF = datetime(2020, 1, 10, tzinfo=timezone.utc)
+EXPIRED_CHUNK = ('_timescaledb_internal', '_hyper_1_1_chunk', datetime(2020, 1, 1, tzinfo=timezone.utc), datetime(2020, 1, 2, tzinfo=timezone.utc))
+STRADDLING_CHUNK = ('_timescaledb_internal', '_hyper_1_2_chunk', datetime(2020, 1, 9, tzinfo=timezone.utc), datetime(2020, 1, 16, tzinfo=timezone.utc))
+
+def test_purge_raw_data_drops_expired_chunks_and_trims_the_boundary_chunk(mock_db_connection, mocker):
+    """Whole expired chunks are dropped; only the chunk straddling the cutoff is deleted row by row, in slices."""
+    mock_conn, mock_cur = mock_db_connection
+    mocker.patch('retention_policy_manager.PURGE_SLICE_HOURS', 12)
+    mocker.patch('retention_policy_manager.list_expired_chunks', return_value=[EXPIRED_CHUNK, STRADDLING_CHUNK])
+    mock_cur.rowcount = 10
+    mock_cur.fetchall.return_value = [('_timescaledb_internal._hyper_1_1_chunk',)]
+
+    chunks_dropped, detail_rows, exposure_rows = purge_raw_data(mock_conn, CUTOFF, PurgeThrottle(0))
+
+    # 1 day of the expired chunk = 2 slices x 6 detail tables, removed before the chunk is dropped.
+    detail_deletes = [q for q, _ in executed(mock_cur, 'USING exposures e')]
+    assert len(detail_deletes) == 2 * len(DETAIL_TABLES)
+    drops = executed(mock_cur, 'drop_chunks')
+    assert drops == [(drops[0][0], (EXPIRED_CHUNK[3], EXPIRED_CHUNK[2]))]
+    assert chunks_dropped == 1
+
+    # The straddling chunk is only deleted up to the cutoff, in two 12-hour slices.
+    exposure_deletes = executed(mock_cur, 'DELETE FROM exposures')
+    assert [p for _, p in exposure_deletes] == [
+        (STRADDLING_CHUNK[2], STRADDLING_CHUNK[2] + timedelta(hours=12)),
+        (STRADDLING_CHUNK[2] + timedelta(hours=12), CUTOFF),
+    ]
+    assert exposure_rows == 20 and detail_rows == 120
+
+    # Every batch is its own transaction with a lock timeout.
+    assert mock_conn.commit.call_count == len(detail_deletes) + len(drops) + len(exposure_deletes)
+    assert len(executed(mock_cur, 'lock_timeout')) == mock_conn.commit.call_count
+
 def test_apply_retention_policies(mock_db_connection, mocker):
-    """Test that the correct DELETE statements are executed."""
+    """Raw data uses the raw retention period; continuous aggregates drop chunks older than the aggregate period."""
     mock_conn, mock_cur = mock_db_connection
-    
-    # Mock the config values to be predictable
     mocker.patch('retention_policy_manager.RAW_DATA_RETENTION_YEARS', 5)
     mocker.patch('retention_policy_manager.AGGREGATE_DATA_RETENTION_YEARS', 10)
+    mock_rollups = mocker.patch('retention_policy_manager.run_rollups', return_value=date(2024, 1, 1))
+    mock_purge = mocker.patch('retention_policy_manager.purge_raw_data', return_value=(0, 0, 0))
+    agg_cutoff = datetime(2015, 1, 10, tzinfo=timezone.utc)
+    mock_cur.fetchone.side_effect = [(CUTOFF,), (agg_cutoff,)]
+    mock_cur.fetchall.return_value = []
 
     apply_retention_policies(mock_conn)
 
-    # Check that execute was called for each deletion task
-    assert mock_cur.execute.call_count == 3 # 1 for raw, 2 for aggregates
+    assert [p for _, p in executed(mock_cur, 'make_interval')] == [(5,), (10,)]
+    assert "date_trunc('day'" in executed(mock_cur, 'make_interval')[0][0]
+    mock_rollups.assert_called_once()
+    assert mock_purge.call_args[0][1] == CUTOFF
+    assert [p for _, p in executed(mock_cur, 'drop_chunks')] == [
+        ('hourly_air_quality_summary', agg_cutoff),
+        ('hourly_heat_stress_summary', agg_cutoff),
+    ]
+    mock_conn.rollback.assert_not_called()
+
+def test_apply_retention_policies_never_purges_past_the_rollups(mock_db_connection, mocker):
+    mock_conn, mock_cur = mock_db_connection
+    mocker.patch('retention_policy_manager.run_rollups', return_value=date(2020, 1, 5))
+    mock_purge = mocker.patch('retention_policy_manager.purge_raw_data', return_value=(0, 0, 0))
+    mock_cur.fetchone.side_effect = [(CUTOFF,), (CUTOFF,)]
+    mock_cur.fetchall.return_value = []
+
+    apply_retention_policies(mock_conn)
+
+    assert mock_purge.call_args[0][1] == datetime(2020, 1, 5, tzinfo=timezone.utc)
+
+def test_purge_throttle_limits_row_rate(mocker):
+    mocker.patch('retention_policy_manager.PURGE_PAUSE_SECONDS', 0)
+    mock_sleep = mocker.patch('retention_policy_manager.time.sleep')
+
+    throttle = PurgeThrottle(max_rows_per_second=1000)
+    throttle.record(5000)
+
+    assert mock_sleep.call_args[0][0] == pytest.approx(5.0, abs=0.5)
+
+def test_estimate_retention_uses_metadata_and_planner_estimates(mock_db_connection, mocker):
+    """The dry run reports rows/bytes per chunk and table without COUNT(*) and without deleting anything."""
+    mock_conn, mock_cur = mock_db_connection
+    mocker.patch('retention_policy_manager.PURGE_SLICE_HOURS', 12)
+    mocker.patch('retention_policy_manager.get_cutoff', return_value=CUTOFF)
+    agg_chunk = ('_timescaledb_internal', '_hyper_2_9_chunk', datetime(2009, 1, 1, tzinfo=timezone.utc), datetime(2009, 2, 1, tzinfo=timezone.utc))
+    mocker.patch('retention_policy_manager.list_expired_chunks',
+                 side_effect=lambda conn, table, cutoff: [EXPIRED_CHUNK, STRADDLING_CHUNK] if table == 'exposures' else [agg_chunk])
+    mocker.patch('retention_policy_manager.relation_estimate', return_value=(1000, 8 * 1048576))
+    mocker.patch('retention_policy_manager.explain_rows', return_value=250)
+    mock_cur.fetchone.return_value = ('_materialized_hypertable_2',)
+
+    report = estimate_retention(mock_conn)
+
+    by_chunk = {(e['table'], e['chunk']): e for e in report['entries']}
+    assert by_chunk[('exposures', '_timescaledb_internal._hyper_1_1_chunk')] == {
+        'table': 'exposures', 'chunk': '_timescaledb_internal._hyper_1_1_chunk', 'action': 'drop', 'rows': 1000, 'bytes': 8 * 1048576}
+    # The boundary chunk is scaled by the planner's estimate of expired rows.
+    assert by_chunk[('exposures', '_timescaledb_internal._hyper_1_2_chunk')]['bytes'] == 2 * 1048576
+    assert all(by_chunk[(t, '-')]['rows'] == 250 for t in DETAIL_TABLES)
+    assert by_chunk[('hourly_air_quality_summary', '_timescaledb_internal._hyper_2_9_chunk')]['action'] == 'drop'
+    # 2 slices x 6 detail tables + 1 drop, 2 boundary slices, 2 aggregate chunk drops.
+    assert report['batches'] == 13 + 2 + 2
+    assert report['throttled_rows'] == 250 + 250 * len(DETAIL_TABLES)
+    assert not any('DELETE' in c[0][0] or 'drop_chunks' in c[0][0] for c in mock_cur.execute.call_args_list)
+
+def test_estimate_retention_uses_the_rollup_capped_cutoff_without_rolling_up(mock_db_connection, mocker):
+    """Like a real run, the dry run never counts raw data past the days the rollup would reach."""
+    mock_conn, mock_cur = mock_db_connection
+    rolled_until = date(2020, 1, 5)
+    mocker.patch('retention_policy_manager.ROLLUP_LAG_DAYS', (datetime.now(timezone.utc).date() - rolled_until).days)
+    mocker.patch('retention_policy_manager.get_cutoff', return_value=CUTOFF)
+    mock_rollups = mocker.patch('retention_policy_manager.run_rollups')
+    mock_chunks = mocker.patch('retention_policy_manager.list_expired_chunks', return_value=[])
+    mocker.patch('retention_policy_manager.explain_rows', return_value=0)
+    mocker.patch('retention_policy_manager.relation_estimate', return_value=(0, 0))
+    mock_cur.fetchone.return_value = None
+
+    estimate_retention(mock_conn)
+
+    assert mock_chunks.call_args_list[0][0][1:] == ('exposures', datetime(2020, 1, 5, tzinfo=timezone.utc))
+    mock_rollups.assert_not_called()
+
+def test_estimate_retention_keeps_chunks_when_the_archive_directory_is_not_writable(mock_db_connection, mocker, tmp_path):
+    mock_conn, mock_cur = mock_db_connection
+    blocker = tmp_path / 'not_a_directory'
+    blocker.write_text('')
+    mocker.patch('retention_policy_manager.ARCHIVE_DIRECTORY', str(blocker / 'archive'))
+    mocker.patch('retention_policy_manager.get_cutoff', return_value=CUTOFF)
+    mocker.patch('retention_policy_manager.list_expired_chunks',
+                 side_effect=lambda conn, table, cutoff: [EXPIRED_CHUNK, STRADDLING_CHUNK] if table == 'exposures' else [])
+    mocker.patch('retention_policy_manager.relation_estimate', return_value=(1000, 8 * 1048576))
+    mocker.patch('retention_policy_manager.explain_rows', return_value=250)
+    mock_cur.fetchone.return_value = None
+
+    report = estimate_retention(mock_conn)
+
+    assert [(e['table'], e['action']) for e in report['entries']] == [('exposures', 'keep'), ('exposures', 'keep')]
+    assert report['batches'] == 0 and report['throttled_rows'] == 0
+    assert "table total" in format_retention_report(report)
+    assert not (blocker / 'archive').exists()
+
+def test_estimated_duration_uses_configured_rate(mocker):
+    mocker.patch('retention_policy_manager.PURGE_MAX_ROWS_PER_SECOND', 1000)
+    mocker.patch('retention_policy_manager.PURGE_PAUSE_SECONDS', 0.5)
+    report = {'entries': [{'table': 'exposures', 'chunk': 'c', 'action': 'drop', 'rows': 10, 'bytes': 1048576}],
+              'batches': 20, 'throttled_rows': 60000}
+
+    assert estimated_duration_seconds(report) == 70
+    assert "0:01:10" in format_retention_report(report)
+
+def archive_row(sample_id, ts, unit, value):
+    return (sample_id, 'dev-1', 'loc-1', ts, 'tech', 'M1', value, unit, 'OK', 'noise_details',
+            None, None, None, None, None, None, 15, value, value + 10, None, None, None, None, None, None, None, None, None, None)
+
+def test_parquet_archiver_writes_verified_partitions_and_manifest(tmp_path):
+    import pyarrow.parquet as pq
+    from parquet_archiver import ParquetArchiver
+
+    rows = [
+        archive_row('a', datetime(2020, 1, 31, 23, tzinfo=timezone.utc), 'dBA', 85.0),
+        archive_row('b', datetime(2020, 2, 1, 1, tzinfo=timezone.utc), 'dBA', 86.0),
+        archive_row('c', datetime(2020, 2, 1, 2, tzinfo=timezone.utc), 'µg/m³', 12.0),
+    ]
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.fetchone.return_value = (3,)
+    cur.fetchmany.side_effect = [rows[:2], rows[2:], []]
+    start, end = datetime(2020, 1, 30, tzinfo=timezone.utc), datetime(2020, 2, 6, tzinfo=timezone.utc)
+
+    archiver = ParquetArchiver(str(tmp_path), fetch_rows=2)
+    assert archiver.archive_range(conn, start, end) is True
+
+    # The count and the stream read one snapshot, in a single transaction.
+    assert cur.execute.call_args_list[0][0][0] == "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY"
+    assert "count(*)" in cur.execute.call_args_list[1][0][0]
+    conn.commit.assert_called_once()
+
+    files = sorted(p.relative_to(tmp_path).as_posix() for p in tmp_path.rglob('*.parquet'))
+    assert [f.rsplit('/', 1)[0] for f in files] == [
+        'year=2020/month=01/unit=dBA', 'year=2020/month=02/unit=%C2%B5g%2Fm%C2%B3', 'year=2020/month=02/unit=dBA']
+    assert pq.read_table(tmp_path / files[2]).column('sample_id').to_pylist() == ['b']
+    assert (start.isoformat(), end.isoformat()) in archiver.archived_ranges()
+
+    # An archived range is not streamed again.
+    conn.reset_mock()
+    assert archiver.archive_range(conn, start, end) is True
+    conn.cursor.assert_not_called()
+
+def test_parquet_archiver_rejects_incomplete_archive(tmp_path):
+    from parquet_archiver import ParquetArchiver
+
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.fetchone.return_value = (5,)  # rows the database says exist
+    cur.fetchmany.side_effect = [[archive_row('a', datetime(2020, 1, 1, tzinfo=timezone.utc), 'dBA', 85.0)], []]
+
+    archiver = ParquetArchiver(str(tmp_path))
+    assert archiver.archive_range(conn, EXPIRED_CHUNK[2], EXPIRED_CHUNK[3]) is False
+    assert not list(tmp_path.rglob('*.parquet*'))
+    assert archiver.archived_ranges() == set()
+
+def test_purge_raw_data_keeps_chunks_whose_archive_failed(mock_db_connection, mocker):
+    mock_conn, mock_cur = mock_db_connection
+    mocker.patch('retention_policy_manager.list_expired_chunks', return_value=[EXPIRED_CHUNK, STRADDLING_CHUNK])
+    archiver = MagicMock()
+    archiver.archive_range.side_effect = [False, True]
+    mock_cur.rowcount = 1
+
+    chunks_dropped, _, exposure_rows = purge_raw_data(mock_conn, CUTOFF, PurgeThrottle(0), archiver)
+
+    assert chunks_dropped == 0 and not executed(mock_cur, 'drop_chunks')
+    assert exposure_rows > 0
+    # The boundary chunk is archived only up to the cutoff.
+    assert archiver.archive_range.call_args_list[1][0][1:] == (STRADDLING_CHUNK[2], CUTOFF)
+
+# --- Rollups ---
+
+def sketch_of(values, alpha=0.01):
+    import math
+    from exposure_rollups import new_sketch, add_bucket, sketch_gamma
+    sketch = new_sketch(alpha)
+    for v in values:
+        bucket = math.ceil(math.log(abs(v)) / math.log(sketch_gamma(alpha))) if v else None
+        add_bucket(sketch, int(v > 0) - int(v < 0), bucket, 1)
+    return sketch
+
+def test_merged_sketch_quantiles_stay_within_relative_accuracy():
+    """Sketches of separate days merge into a month sketch with the same accuracy guarantee."""
+    import numpy as np
+    from exposure_rollups import merge_sketches, sketch_quantile
+
+    rng = np.random.default_rng(7)
+    days = [np.concatenate([rng.lognormal(3, 1, 2000), -rng.lognormal(1, 0.5, 200)]) for _ in range(5)]
+    month = merge_sketches(sketch_of(day) for day in days)
+    values = np.concatenate(days)
+
+    assert month['zero'] == 0 and sum(month['pos'].values()) + sum(month['neg'].values()) == len(values)
+    for q in (0.05, 0.5, 0.95, 0.99):
+        exact = np.quantile(values, q, method='lower')
+        assert sketch_quantile(month, q) == pytest.approx(exact, rel=0.03)
+
+def test_rollup_days_writes_one_summary_per_day_and_key(mocker):
+    from exposure_rollups import rollup_days
+
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    day = date(2020, 1, 1)
+    # Two buckets of the same group plus a zero reading; they collapse into one summary row.
+    cur.__iter__.return_value = iter([
+        (day, 'dBA', 'dev-1', '', 1, 443, 3, 80.0, 82.0, 243.0),
+        (day, 'dBA', 'dev-1', '', 1, 445, 1, 90.0, 90.0, 90.0),
+        (day, 'dBA', 'dev-1', '', 0, None, 1, 0.0, 0.0, 0.0),
+    ])
+    mock_upsert = mocker.patch('exposure_rollups.upsert_summaries')
+
+    assert rollup_days(conn, day, date(2020, 1, 2), 0.01) == 1
+
+    table, period_column, rows = mock_upsert.call_args[0][1:]
+    assert (table, period_column) == ('exposure_daily_summary', 'day')
+    period, unit, device_id, location_code, count, min_value, max_value, sum_value, mean_value = rows[0][:9]
+    assert (period, unit, device_id, location_code) == (day, 'dBA', 'dev-1', '')
+    assert (count, min_value, max_value, sum_value, mean_value) == (5, 0.0, 90.0, 333.0, 66.6)
+    conn.commit.assert_called_once()
 
-    # Check the raw data deletion call
-    raw_delete_call = mock_cur.execute.call_args_list[0][0][0]
-    assert "DELETE FROM exposures" in raw_delete_call
-    assert "INTERVAL '5 years'" in raw_delete_call
+def test_run_rollups_resumes_after_last_summarized_day(mocker):
+    from exposure_rollups import run_rollups
 
-    # Check the aggregate data deletion calls
-    agg_delete_call_1 = mock_cur.execute.call_args_list[1][0][0]
-    assert "DELETE FROM hourly_air_quality_summary" in agg_delete_call_1
-    assert "INTERVAL '10 years'" in agg_delete_call_1
+    mocker.patch('exposure_rollups.rolled_up_until', return_value=date(2020, 1, 30))
+    mock_days = mocker.patch('exposure_rollups.rollup_days', return_value=1)
+    mock_month = mocker.patch('exposure_rollups.rollup_month', return_value=1)
 
-    agg_delete_call_2 = mock_cur.execute.call_args_list[2][0][0]
-    assert "DELETE FROM hourly_heat_stress_summary" in agg_delete_call_2
-    assert "INTERVAL '10 years'" in agg_delete_call_2
+    assert run_rollups(MagicMock(), date(2020, 2, 3), slice_days=2) == date(2020, 2, 3)
 
-    # Check that commit was called
-    mock_conn.commit.assert_called_once()
+    assert [c[0][1:3] for c in mock_days.call_args_list] == [
+        (date(2020, 1, 30), date(2020, 2, 1)), (date(2020, 2, 1), date(2020, 2, 3))]
+    assert [c[0][1] for c in mock_month.call_args_list] == [date(2020, 1, 1), date(2020, 2, 1)]
@@ -1,10 +1,16 @@
 import os
+import sys
 import logging
+import threading
 import grpc
-import psycopg2
 from concurrent import futures
 from dotenv import load_dotenv
-import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from db_pool import ConnectionManager
+from exposure_writer import ExposureRecord, ExposureWriter
+from tracing import traceparent_from_headers, tracer_from_env
+from noise_dose import CRITERIA, DoseAccumulator, DoseCache, dose_query
 
 # Import generated classes
 import noise_dosimeter_pb2
@@ -14,6 +20,7 @@ import noise_dosimeter_pb2_grpc
 load_dotenv()
 
 GRPC_SERVER_PORT = os.getenv("GRPC_SERVER_PORT", "50051")
+GRPC_MAX_WORKERS = int(os.getenv("GRPC_MAX_WORKERS", "10"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 # Database connection details
@@ -22,29 +29,41 @@ DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
+# One pooled connection per worker thread by default
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(GRPC_MAX_WORKERS)))
+
+# StreamNoiseDose: summaries per page (default and cap), interval rows per cursor fetch,
+# cached closed windows, and how long after its end a window counts as closed
+DOSE_PAGE_SIZE = int(os.getenv("DOSE_PAGE_SIZE", "500"))
+DOSE_MAX_PAGE_SIZE = int(os.getenv("DOSE_MAX_PAGE_SIZE", "5000"))
+DOSE_FETCH_ROWS = int(os.getenv("DOSE_FETCH_ROWS", "10000"))
+DOSE_CACHE_SIZE = int(os.getenv("DOSE_CACHE_SIZE", "256"))
+DOSE_CACHE_SETTLE_MIN = int(os.getenv("DOSE_CACHE_SETTLE_MIN", "60"))
 
 # --- Logging Setup ---
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Database Connection ---
+db_pool = ConnectionManager(
+    dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD),
+    max_connections=DB_POOL_SIZE
+)
+writer = ExposureWriter()
+dose_cache = DoseCache(DOSE_CACHE_SIZE)
+
+# --- Tracing (TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH) ---
+tracer = tracer_from_env('grpc_service')
+
 def get_db_connection():
-    """Establishes and returns a connection to the PostgreSQL database."""
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        logger.info("Successfully connected to the database.")
-        return conn
-    except psycopg2.OperationalError as e:
-        logger.error(f"Could not connect to the database: {e}")
-        return None
+    """Returns a pooled connection to the PostgreSQL database, or None if it is unreachable."""
+    return db_pool.getconn()
 
-from datetime import datetime, timedelta
+def release_db_connection(conn):
+    """Returns a connection obtained from get_db_connection() to the pool."""
+    db_pool.putconn(conn)
+
+from datetime import datetime, timedelta, timezone
 
 # ... (rest of the imports)
 
@@ -55,9 +74,17 @@ class NoiseDosimeterServicer(noise_dosimeter_pb2_grpc.NoiseDosimeterServicer):
     def UploadNoiseData(self, request, context):
         """
         Receives noise data, validates it, inserts it into the database, 
-        and returns a confirmation.
+        and returns a confirmation. A "traceparent" metadata entry continues
+        the caller's trace.
         """
-        logger.info(f"Received noise data upload for device: {request.device_id}")
+        parent = traceparent_from_headers(context.invocation_metadata())
+        with tracer.start_span('UploadNoiseData', parent=parent, attributes={'device_id': request.device_id}) as span:
+            response = self._upload_noise_data(request, context)
+            span.set_attribute('success', response.success)
+            return response
+
+    def _upload_noise_data(self, request, context):
+        logger.debug(f"Received noise data upload for device: {request.device_id}")
 
         # --- Calibration Enforcement Rule ---
         if request.HasField('calibration_date'):
@@ -77,44 +104,23 @@ class NoiseDosimeterServicer(noise_dosimeter_pb2_grpc.NoiseDosimeterServicer):
             context.set_details("Database connection failed.")
             return noise_dosimeter_pb2.NoiseDataResponse(success=False, message="Database connection failed.")
 
-        sample_id = str(uuid.uuid4())
-        
+        record = ExposureRecord(
+            device_id=request.device_id,
+            location_code=request.location_code,
+            timestamp_utc=request.timestamp_utc.ToDatetime(),
+            captured_by=request.captured_by,
+            value=request.laeq, # Using LAeq as the primary 'value'
+            unit='dBA',         # Standard unit for LAeq
+            detail=(request.dosimeter_interval_min, request.laeq, request.peak_db)
+        )
+        sample_id = record.sample_id
+
         try:
             with conn.cursor() as cur:
-                # Insert into generic exposures table
-                cur.execute(
-                    """
-                    INSERT INTO exposures (sample_id, device_id, location_code, timestamp_utc, captured_by, value, unit, qualifier)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (
-                        sample_id,
-                        request.device_id,
-                        request.location_code,
-                        request.timestamp_utc.ToDatetime(),
-                        request.captured_by,
-                        request.laeq, # Using LAeq as the primary 'value'
-                        'dBA',      # Standard unit for LAeq
-                        'OK'        # Default qualifier
-                    )
-                )
-
-                # Insert into noise-specific details table
-                cur.execute(
-                    """
-                    INSERT INTO noise_details (sample_id, dosimeter_interval_min, laeq, peak_db)
-                    VALUES (%s, %s, %s, %s)
-                    """,
-                    (
-                        sample_id,
-                        request.dosimeter_interval_min,
-                        request.laeq,
-                        request.peak_db
-                    )
-                )
-                
+                # One transaction for the exposures row and its noise_details row
+                writer.write_records(cur, 'noise_details', [record])
                 conn.commit()
-                logger.info(f"Successfully inserted noise data with sample_id: {sample_id}")
+                logger.debug(f"Successfully inserted noise data with sample_id: {sample_id}")
                 
                 return noise_dosimeter_pb2.NoiseDataResponse(
                     success=True,
@@ -130,13 +136,112 @@ class NoiseDosimeterServicer(noise_dosimeter_pb2_grpc.NoiseDosimeterServicer):
             context.set_details(f"Database insert failed: {e}")
             return noise_dosimeter_pb2.NoiseDataResponse(success=False, message=f"Database insert failed: {e}")
         finally:
-            if conn:
-                conn.close()
+            release_db_connection(conn)
+
+    def StreamNoiseDose(self, request, context):
+        """
+        Streams daily dose and 8-hour TWA for the requested device, wearer or
+        location in pages of up to page_size summaries. Intervals are read
+        with a server-side cursor, and windows that closed more than
+        DOSE_CACHE_SETTLE_MIN minutes ago are answered from an LRU cache.
+        """
+        subject = request.WhichOneof('subject')
+        if not subject or not request.HasField('start_utc') or not request.HasField('end_utc'):
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("A device_id, captured_by or location_code and a start_utc and end_utc are required.")
+            return
+        start = request.start_utc.ToDatetime(tzinfo=timezone.utc)
+        end = request.end_utc.ToDatetime(tzinfo=timezone.utc)
+        if end <= start:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("end_utc must be after start_utc.")
+            return
+        criterion = noise_dosimeter_pb2.DoseCriterion.DESCRIPTOR.values_by_number.get(request.criterion)
+        if criterion is None or criterion.name not in CRITERIA:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"criterion must be one of {', '.join(CRITERIA)}.")
+            return
+
+        criterion_name = criterion.name
+        page_size = min(request.page_size if request.page_size > 0 else DOSE_PAGE_SIZE, DOSE_MAX_PAGE_SIZE)
+        value = getattr(request, subject)
+        cache_key = (subject, value, start, end, criterion_name)
+        closed = end <= datetime.now(timezone.utc) - timedelta(minutes=DOSE_CACHE_SETTLE_MIN)
+
+        parent = traceparent_from_headers(context.invocation_metadata())
+        with tracer.start_span('StreamNoiseDose', parent=parent, attributes={subject: value}) as span:
+            summaries = dose_cache.get(cache_key) if closed else None
+            span.set_attribute('cached', summaries is not None)
+            if summaries is not None:
+                yield from self._dose_pages(summaries, page_size, cached=True)
+                return
+
+            conn = get_db_connection()
+            if not conn:
+                context.set_code(grpc.StatusCode.INTERNAL)
+                context.set_details("Database connection failed.")
+                return
+
+            computed = []
+            try:
+                yield from self._dose_pages(
+                    self._read_dose(conn, subject, value, start, end, CRITERIA[criterion_name]),
+                    page_size, collected=computed
+                )
+                conn.commit()
+            except GeneratorExit:
+                # The client cancelled or disconnected mid-stream
+                conn.rollback()
+                raise
+            except Exception as e:
+                logger.error(f"Failed to compute noise dose for {subject} {value}: {e}")
+                conn.rollback()
+                context.set_code(grpc.StatusCode.INTERNAL)
+                context.set_details(f"Noise dose query failed: {e}")
+                return
+            finally:
+                release_db_connection(conn)
+
+            span.set_attribute('summaries', len(computed))
+            if closed:
+                dose_cache.put(cache_key, computed)
+
+    def _read_dose(self, conn, subject, value, start, end, criterion):
+        """Yields DoseSummaries as the cursor's interval rows complete each subject and day."""
+        accumulator = DoseAccumulator(criterion)
+        with conn.cursor(name=f"noise_dose_{os.getpid()}_{threading.get_ident()}") as cur:
+            cur.itersize = DOSE_FETCH_ROWS
+            cur.execute(dose_query(subject), (value, start, end))
+            while True:
+                rows = cur.fetchmany(DOSE_FETCH_ROWS)
+                if not rows:
+                    break
+                yield from accumulator.add(rows)
+        yield from accumulator.flush()
+
+    def _dose_pages(self, summaries, page_size, cached=False, collected=None):
+        """Groups summaries into NoiseDosePages; the final (possibly empty) page has last_page set."""
+        page, number = [], 0
+        for summary in summaries:
+            if collected is not None:
+                collected.append(summary)
+            if len(page) == page_size:
+                yield self._dose_page(page, number, False, cached)
+                page, number = [], number + 1
+            page.append(summary)
+        yield self._dose_page(page, number, True, cached)
+
+    @staticmethod
+    def _dose_page(summaries, number, last_page, cached):
+        return noise_dosimeter_pb2.NoiseDosePage(
+            summaries=[noise_dosimeter_pb2.NoiseDoseSummary(**summary._asdict()) for summary in summaries],
+            page=number, last_page=last_page, cached=cached
+        )
 
 # --- Server Setup ---
 def serve():
     """Starts the gRPC server."""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=GRPC_MAX_WORKERS))
     noise_dosimeter_pb2_grpc.add_NoiseDosimeterServicer_to_server(
         NoiseDosimeterServicer(), server
     )
@@ -150,6 +255,8 @@ def serve():
     except KeyboardInterrupt:
         logger.info("gRPC server stopped by user.")
         server.stop(0)
+    finally:
+        db_pool.close()
 
 if __name__ == '__main__':
     # Before running, ensure you have generated the gRPC code:
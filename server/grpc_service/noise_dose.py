@@ -0,0 +1,148 @@
+"""
+Daily noise dose and 8-hour TWA from LAeq intervals, for StreamNoiseDose.
+
+For each interval of t hours at level L the allowed time is
+T(L) = 8 / 2 ** ((L - criterion) / exchange_rate) hours, the dose is
+D = 100 * sum(t / T(L)) percent, and TWA = criterion + exchange_rate * log2(D / 100).
+Intervals below the threshold do not count towards the dose.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+Criterion = namedtuple('Criterion', ['criterion_db', 'exchange_rate', 'threshold_db'])
+
+# Keyed by DoseCriterion enum name
+CRITERIA = {
+    'OSHA': Criterion(90.0, 5.0, 80.0),
+    'DOD': Criterion(85.0, 3.0, 80.0),
+}
+
+DoseSummary = namedtuple(
+    'DoseSummary',
+    ['subject_id', 'day', 'dose_percent', 'twa_dba', 'exposure_minutes', 'interval_count', 'max_laeq']
+)
+
+# request subject -> (column the request filters on, expression the results are grouped by)
+SUBJECTS = {
+    'device_id': ('device_id', "e.device_id"),
+    'captured_by': ('captured_by', "COALESCE(e.captured_by, '')"),
+    'location_code': ('location_code', "COALESCE(e.captured_by, '')"),
+}
+
+DOSE_QUERY = """
+    SELECT {group} AS subject_id,
+           to_char(e.timestamp_utc AT TIME ZONE 'UTC', 'YYYY-MM-DD') AS day,
+           nd.laeq::float8,
+           nd.dosimeter_interval_min::float8
+    FROM exposures e
+    JOIN noise_details nd ON nd.sample_id = e.sample_id
+    WHERE e.{column} = %s AND e.timestamp_utc >= %s AND e.timestamp_utc < %s
+      AND nd.laeq IS NOT NULL AND nd.dosimeter_interval_min > 0
+    ORDER BY 1, 2
+"""
+
+
+def dose_query(subject):
+    """The interval query for a request subject ('device_id', 'captured_by' or 'location_code')."""
+    column, group = SUBJECTS[subject]
+    return DOSE_QUERY.format(column=column, group=group)
+
+
+def dose_fractions(laeq, minutes, criterion):
+    """Per-interval dose as a fraction of the allowed daily exposure (1.0 = 100%)."""
+    laeq = np.asarray(laeq, dtype=float)
+    allowed_hours = 8.0 / np.exp2((laeq - criterion.criterion_db) / criterion.exchange_rate)
+    fractions = np.asarray(minutes, dtype=float) / 60.0 / allowed_hours
+    return np.where(laeq >= criterion.threshold_db, fractions, 0.0)
+
+
+def twa_from_dose(dose_percent, criterion):
+    """8-hour TWA for dose percentages; 0 where the dose is 0."""
+    dose_percent = np.asarray(dose_percent, dtype=float)
+    with np.errstate(divide='ignore'):
+        twa = criterion.criterion_db + criterion.exchange_rate * np.log2(dose_percent / 100.0)
+    return np.where(dose_percent > 0, twa, 0.0)
+
+
+class DoseAccumulator:
+    """
+    Sums interval rows ordered by subject and day into daily DoseSummaries.
+    Rows arrive in cursor batches, so the last group of a batch is held back
+    until the next batch shows whether it continues.
+    """
+
+    def __init__(self, criterion):
+        self.criterion = criterion
+        self._carry = None  # [subject_id, day, dose_fraction, minutes, count, max_laeq]
+
+    def add(self, rows):
+        """rows: (subject_id, day, laeq, interval_min) tuples. Returns the summaries completed by them."""
+        if not rows:
+            return []
+        subjects, days, laeq, minutes = (np.asarray(column) for column in zip(*rows))
+        laeq = laeq.astype(float)
+        minutes = minutes.astype(float)
+
+        changed = (subjects[1:] != subjects[:-1]) | (days[1:] != days[:-1])
+        starts = np.concatenate(([0], np.flatnonzero(changed) + 1))
+        dose = np.add.reduceat(dose_fractions(laeq, minutes, self.criterion), starts)
+        exposure_minutes = np.add.reduceat(minutes, starts)
+        counts = np.diff(np.append(starts, len(rows)))
+        max_laeq = np.maximum.reduceat(laeq, starts)
+
+        groups = [
+            [subjects[s], days[s], dose[i], exposure_minutes[i], counts[i], max_laeq[i]]
+            for i, s in enumerate(starts)
+        ]
+        if self._carry is not None:
+            if self._carry[:2] == groups[0][:2]:
+                first = groups[0]
+                groups[0] = [first[0], first[1], self._carry[2] + first[2], self._carry[3] + first[3],
+                             self._carry[4] + first[4], max(self._carry[5], first[5])]
+            else:
+                groups.insert(0, self._carry)
+        self._carry = groups.pop()
+        return self._summaries(groups)
+
+    def flush(self):
+        """Returns the summary still held back, once the cursor is exhausted."""
+        groups, self._carry = ([self._carry] if self._carry is not None else []), None
+        return self._summaries(groups)
+
+    def _summaries(self, groups):
+        if not groups:
+            return []
+        dose_percent = np.array([g[2] for g in groups]) * 100.0
+        twa = twa_from_dose(dose_percent, self.criterion)
+        return [
+            DoseSummary(str(g[0]), str(g[1]), round(float(dose_percent[i]), 3), round(float(twa[i]), 2),
+                        float(g[3]), int(g[4]), float(g[5]))
+            for i, g in enumerate(groups)
+        ]
+
+
+class DoseCache:
+    """Thread-safe bounded LRU of summaries for closed windows, which no longer change."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, summaries):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = tuple(summaries)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
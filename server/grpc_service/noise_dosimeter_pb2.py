@@ -2,7 +2,7 @@
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # NO CHECKED-IN PROTOBUF GENCODE
 # source: noise_dosimeter.proto
-# Protobuf Python Version: 6.31.0
+# Protobuf Python Version: 7.35.1
 """Generated protocol buffer code."""
 from google.protobuf import descriptor as _descriptor
 from google.protobuf import descriptor_pool as _descriptor_pool
@@ -11,9 +11,9 @@ from google.protobuf import symbol_database as _symbol_database
 from google.protobuf.internal import builder as _builder
 _runtime_version.ValidateProtobufRuntimeVersion(
     _runtime_version.Domain.PUBLIC,
-    6,
-    31,
-    0,
+    7,
+    35,
+    1,
     '',
     'noise_dosimeter.proto'
 )
@@ -25,17 +25,25 @@ _sym_db = _symbol_database.Default()
 from google.protobuf import timestamp_pb2 as google_dot_protobuf_dot_timestamp__pb2
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x15noise_dosimeter.proto\x12\x0enoisedosimeter\x1a\x1fgoogle/protobuf/timestamp.proto\"\xf9\x01\n\x10NoiseDataRequest\x12\x11\n\tdevice_id\x18\x01 \x01(\t\x12\x15\n\rlocation_code\x18\x02 \x01(\t\x12\x31\n\rtimestamp_utc\x18\x03 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12\x13\n\x0b\x63\x61ptured_by\x18\x04 \x01(\t\x12\x1e\n\x16\x64osimeter_interval_min\x18\x05 \x01(\x01\x12\x0c\n\x04laeq\x18\x06 \x01(\x01\x12\x0f\n\x07peak_db\x18\x07 \x01(\x01\x12\x34\n\x10\x63\x61libration_date\x18\x08 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\"H\n\x11NoiseDataResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x11\n\tsample_id\x18\x03 \x01(\t2j\n\x0eNoiseDosimeter\x12X\n\x0fUploadNoiseData\x12 .noisedosimeter.NoiseDataRequest\x1a!.noisedosimeter.NoiseDataResponse\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x15noise_dosimeter.proto\x12\x0enoisedosimeter\x1a\x1fgoogle/protobuf/timestamp.proto\"\xf9\x01\n\x10NoiseDataRequest\x12\x11\n\tdevice_id\x18\x01 \x01(\t\x12\x15\n\rlocation_code\x18\x02 \x01(\t\x12\x31\n\rtimestamp_utc\x18\x03 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12\x13\n\x0b\x63\x61ptured_by\x18\x04 \x01(\t\x12\x1e\n\x16\x64osimeter_interval_min\x18\x05 \x01(\x01\x12\x0c\n\x04laeq\x18\x06 \x01(\x01\x12\x0f\n\x07peak_db\x18\x07 \x01(\x01\x12\x34\n\x10\x63\x61libration_date\x18\x08 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\"H\n\x11NoiseDataResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x11\n\tsample_id\x18\x03 \x01(\t\"\x83\x02\n\x10NoiseDoseRequest\x12\x13\n\tdevice_id\x18\x01 \x01(\tH\x00\x12\x15\n\x0b\x63\x61ptured_by\x18\x02 \x01(\tH\x00\x12\x17\n\rlocation_code\x18\x03 \x01(\tH\x00\x12-\n\tstart_utc\x18\x04 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12+\n\x07\x65nd_utc\x18\x05 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12\x30\n\tcriterion\x18\x06 \x01(\x0e\x32\x1d.noisedosimeter.DoseCriterion\x12\x11\n\tpage_size\x18\x07 \x01(\x05\x42\t\n\x07subject\"\x9e\x01\n\x10NoiseDoseSummary\x12\x12\n\nsubject_id\x18\x01 \x01(\t\x12\x0b\n\x03\x64\x61y\x18\x02 \x01(\t\x12\x14\n\x0c\x64ose_percent\x18\x03 \x01(\x01\x12\x0f\n\x07twa_dba\x18\x04 \x01(\x01\x12\x18\n\x10\x65xposure_minutes\x18\x05 \x01(\x01\x12\x16\n\x0einterval_count\x18\x06 \x01(\x03\x12\x10\n\x08max_laeq\x18\x07 \x01(\x01\"u\n\rNoiseDosePage\x12\x33\n\tsummaries\x18\x01 \x03(\x0b\x32 .noisedosimeter.NoiseDoseSummary\x12\x0c\n\x04page\x18\x02 \x01(\x05\x12\x11\n\tlast_page\x18\x03 \x01(\x08\x12\x0e\n\x06\x63\x61\x63hed\x18\x04 \x01(\x08*\"\n\rDoseCriterion\x12\x08\n\x04OSHA\x10\x00\x12\x07\n\x03\x44OD\x10\x01\x32\xc2\x01\n\x0eNoiseDosimeter\x12X\n\x0fUploadNoiseData\x12 .noisedosimeter.NoiseDataRequest\x1a!.noisedosimeter.NoiseDataResponse\"\x00\x12V\n\x0fStreamNoiseDose\x12 .noisedosimeter.NoiseDoseRequest\x1a\x1d.noisedosimeter.NoiseDosePage\"\x00\x30\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'noise_dosimeter_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
+  _globals['_DOSECRITERION']._serialized_start=942
+  _globals['_DOSECRITERION']._serialized_end=976
   _globals['_NOISEDATAREQUEST']._serialized_start=75
   _globals['_NOISEDATAREQUEST']._serialized_end=324
   _globals['_NOISEDATARESPONSE']._serialized_start=326
   _globals['_NOISEDATARESPONSE']._serialized_end=398
-  _globals['_NOISEDOSIMETER']._serialized_start=400
-  _globals['_NOISEDOSIMETER']._serialized_end=506
+  _globals['_NOISEDOSEREQUEST']._serialized_start=401
+  _globals['_NOISEDOSEREQUEST']._serialized_end=660
+  _globals['_NOISEDOSESUMMARY']._serialized_start=663
+  _globals['_NOISEDOSESUMMARY']._serialized_end=821
+  _globals['_NOISEDOSEPAGE']._serialized_start=823
+  _globals['_NOISEDOSEPAGE']._serialized_end=940
+  _globals['_NOISEDOSIMETER']._serialized_start=979
+  _globals['_NOISEDOSIMETER']._serialized_end=1173
 # @@protoc_insertion_point(module_scope)
@@ -5,7 +5,7 @@ import warnings
 
 import noise_dosimeter_pb2 as noise__dosimeter__pb2
 
-GRPC_GENERATED_VERSION = '1.73.1'
+GRPC_GENERATED_VERSION = '1.84.0'
 GRPC_VERSION = grpc.__version__
 _version_not_supported = False
 
@@ -18,14 +18,14 @@ except ImportError:
 if _version_not_supported:
     raise RuntimeError(
         f'The grpc package installed is at version {GRPC_VERSION},'
-        + f' but the generated code in noise_dosimeter_pb2_grpc.py depends on'
+        + ' but the generated code in noise_dosimeter_pb2_grpc.py depends on'
         + f' grpcio>={GRPC_GENERATED_VERSION}.'
         + f' Please upgrade your grpc module to grpcio>={GRPC_GENERATED_VERSION}'
         + f' or downgrade your generated code using grpcio-tools<={GRPC_VERSION}.'
     )
 
 
-class NoiseDosimeterStub(object):
+class NoiseDosimeterStub:
     """The service definition for the NoisePro Dosimeter.
     """
 
@@ -40,9 +40,14 @@ class NoiseDosimeterStub(object):
                 request_serializer=noise__dosimeter__pb2.NoiseDataRequest.SerializeToString,
                 response_deserializer=noise__dosimeter__pb2.NoiseDataResponse.FromString,
                 _registered_method=True)
+        self.StreamNoiseDose = channel.unary_stream(
+                '/noisedosimeter.NoiseDosimeter/StreamNoiseDose',
+                request_serializer=noise__dosimeter__pb2.NoiseDoseRequest.SerializeToString,
+                response_deserializer=noise__dosimeter__pb2.NoiseDosePage.FromString,
+                _registered_method=True)
 
 
-class NoiseDosimeterServicer(object):
+class NoiseDosimeterServicer:
     """The service definition for the NoisePro Dosimeter.
     """
 
@@ -53,6 +58,13 @@ class NoiseDosimeterServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def StreamNoiseDose(self, request, context):
+        """Streams daily noise dose and 8-hour TWA per wearer (or per device) in pages.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_NoiseDosimeterServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -61,6 +73,11 @@ def add_NoiseDosimeterServicer_to_server(servicer, server):
                     request_deserializer=noise__dosimeter__pb2.NoiseDataRequest.FromString,
                     response_serializer=noise__dosimeter__pb2.NoiseDataResponse.SerializeToString,
             ),
+            'StreamNoiseDose': grpc.unary_stream_rpc_method_handler(
+                    servicer.StreamNoiseDose,
+                    request_deserializer=noise__dosimeter__pb2.NoiseDoseRequest.FromString,
+                    response_serializer=noise__dosimeter__pb2.NoiseDosePage.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'noisedosimeter.NoiseDosimeter', rpc_method_handlers)
@@ -69,7 +86,7 @@ def add_NoiseDosimeterServicer_to_server(servicer, server):
 
 
  # This class is part of an EXPERIMENTAL API.
-class NoiseDosimeter(object):
+class NoiseDosimeter:
     """The service definition for the NoisePro Dosimeter.
     """
 
@@ -99,3 +116,30 @@ class NoiseDosimeter(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def StreamNoiseDose(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/noisedosimeter.NoiseDosimeter/StreamNoiseDose',
+            noise__dosimeter__pb2.NoiseDoseRequest.SerializeToString,
+            noise__dosimeter__pb2.NoiseDosePage.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
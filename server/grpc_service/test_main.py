@@ -11,6 +11,7 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 # Import the generated protobuf classes and the servicer
 import noise_dosimeter_pb2
 from main import NoiseDosimeterServicer
+from noise_dose import CRITERIA, DoseAccumulator, DoseCache, DoseSummary, dose_fractions, twa_from_dose
 
 @pytest.fixture
 def servicer():
@@ -89,3 +90,83 @@ def test_upload_noise_data_db_error(servicer, mock_db_connection, mock_context):
     assert "Database insert failed" in response.message
     mock_context.set_code.assert_called_with(grpc.StatusCode.INTERNAL)
     mock_conn.rollback.assert_called_once()
+
+def test_upload_noise_data_continues_the_caller_trace(servicer, mock_db_connection, mock_context, mocker):
+    """A traceparent in the call metadata becomes the parent of the server span."""
+    exporter = mocker.patch('main.tracer.exporter')
+    mock_context.invocation_metadata.return_value = (('traceparent', '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'),)
+    request = noise_dosimeter_pb2.NoiseDataRequest(device_id='test-device-04', laeq=80.0)
+
+    response = servicer.UploadNoiseData(request, mock_context)
+
+    assert response.success is True
+    span = exporter.export.call_args[0][0]
+    assert span['trace_id'] == '4bf92f3577b34da6a3ce929d0e0e4736'
+    assert span['parent_id'] == '00f067aa0ba902b7'
+    assert span['attributes'] == {'device_id': 'test-device-04', 'success': True}
+
+def dose_request(**kwargs):
+    request = noise_dosimeter_pb2.NoiseDoseRequest(**kwargs)
+    request.start_utc.FromDatetime(datetime(2025, 3, 1))
+    request.end_utc.FromDatetime(datetime(2025, 3, 3))
+    return request
+
+def test_dose_math_follows_the_exchange_rate():
+    """8 h at the criterion is 100%; each exchange rate above it halves the allowed time."""
+    osha, dod = CRITERIA['OSHA'], CRITERIA['DOD']
+    assert list(dose_fractions([90, 95, 85, 79], [480, 240, 480, 480], osha)) == [1.0, 1.0, 0.5, 0.0]
+    assert list(dose_fractions([85, 88], [480, 240], dod)) == [1.0, 1.0]
+    assert list(twa_from_dose([100, 200, 0], osha)) == [90.0, 95.0, 0.0]
+    assert list(twa_from_dose([50], dod)) == [82.0]
+
+def test_dose_accumulator_joins_a_day_split_across_fetches():
+    accumulator = DoseAccumulator(CRITERIA['OSHA'])
+    first = accumulator.add([('sailor-1', '2025-03-01', 90.0, 240.0), ('sailor-1', '2025-03-02', 95.0, 120.0)])
+    second = accumulator.add([('sailor-1', '2025-03-02', 95.0, 120.0), ('sailor-2', '2025-03-01', 85.0, 60.0)])
+
+    assert [(s.subject_id, s.day, s.dose_percent, s.twa_dba) for s in first] == [('sailor-1', '2025-03-01', 50.0, 85.0)]
+    assert second[0] == DoseSummary('sailor-1', '2025-03-02', 100.0, 90.0, 240.0, 2, 95.0)
+    assert accumulator.flush()[0].subject_id == 'sailor-2'
+    assert accumulator.flush() == []
+
+def test_stream_noise_dose_pages_results_and_caches_closed_windows(servicer, mock_db_connection, mock_context, mocker):
+    """Closed windows are computed once with a server-side cursor and then served from the cache."""
+    mock_conn, mock_cur = mock_db_connection
+    mocker.patch('main.dose_cache', DoseCache(8))
+    mock_cur.fetchmany.side_effect = [
+        [('sailor-1', '2025-03-01', 90.0, 480.0), ('sailor-2', '2025-03-01', 95.0, 60.0)],
+        [('sailor-3', '2025-03-01', 100.0, 240.0)],
+        [],
+    ]
+    request = dose_request(location_code='DDG-51', page_size=2)
+
+    pages = list(servicer.StreamNoiseDose(request, mock_context))
+
+    assert [(len(p.summaries), p.page, p.last_page, p.cached) for p in pages] == [(2, 0, False, False), (1, 1, True, False)]
+    assert pages[0].summaries[0].dose_percent == 100.0
+    assert (pages[1].summaries[0].dose_percent, pages[1].summaries[0].twa_dba) == (200.0, 95.0)
+    assert mock_conn.cursor.call_args.kwargs['name'].startswith('noise_dose_')
+    assert mock_cur.execute.call_args[0][1][0] == 'DDG-51'
+
+    cached = list(servicer.StreamNoiseDose(request, mock_context))
+
+    assert [p.cached for p in cached] == [True, True]
+    assert [s.subject_id for p in cached for s in p.summaries] == ['sailor-1', 'sailor-2', 'sailor-3']
+    mock_cur.execute.assert_called_once()
+
+def test_stream_noise_dose_requires_a_subject(servicer, mock_db_connection, mock_context):
+    mock_conn, mock_cur = mock_db_connection
+
+    assert list(servicer.StreamNoiseDose(dose_request(), mock_context)) == []
+    mock_context.set_code.assert_called_with(grpc.StatusCode.INVALID_ARGUMENT)
+    mock_cur.execute.assert_not_called()
+
+def test_stream_noise_dose_rejects_an_unknown_criterion(servicer, mock_db_connection, mock_context):
+    mock_conn, mock_cur = mock_db_connection
+    request = dose_request(device_id='aerps-7')
+    request.criterion = 7  # a value added to the enum after this server was built
+
+    assert list(servicer.StreamNoiseDose(request, mock_context)) == []
+    mock_context.set_code.assert_called_with(grpc.StatusCode.INVALID_ARGUMENT)
+    mock_context.set_details.assert_called_with("criterion must be one of OSHA, DOD.")
+    mock_cur.execute.assert_not_called()
@@ -1,12 +1,17 @@
 import os
+import sys
 import socket
 import logging
 import requests
 from dotenv import load_dotenv
 from hl7apy import parser
-from hl7apy.mllp import MLLPServer, MLLPHandler
+from hl7apy.core import Message
+from hl7apy.mllp import AbstractErrorHandler, AbstractHandler, MLLPServer
 from hl7apy.exceptions import HL7apyException
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from tracing import current_span, inject_headers, tracer_from_env
+
 # --- Load Configuration ---
 load_dotenv()
 
@@ -19,6 +24,9 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Tracing (TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH) ---
+tracer = tracer_from_env('hl7_listener')
+
 # --- Input Validation ---
 if not FHIR_SERVER_ENDPOINT:
     logger.critical("FHIR_SERVER_ENDPOINT is not set. Please check your .env file.")
@@ -66,54 +74,105 @@ def map_hl7_to_fhir(hl7_message):
 
 def post_to_fhir_server(fhir_resource):
     """
-    Posts a FHIR resource to the configured FHIR server endpoint.
+    Posts a FHIR resource to the configured FHIR server endpoint, passing the
+    current trace on in a traceparent header.
     """
     try:
-        headers = {'Content-Type': 'application/fhir+json'}
-        response = requests.post(FHIR_SERVER_ENDPOINT, json=fhir_resource, headers=headers, timeout=15)
-        response.raise_for_status()
-        logger.info(f"Successfully posted FHIR Observation to {FHIR_SERVER_ENDPOINT}. Response: {response.json()}")
+        with tracer.start_span('post_to_fhir_server') as span:
+            headers = inject_headers({'Content-Type': 'application/fhir+json'})
+            response = requests.post(FHIR_SERVER_ENDPOINT, json=fhir_resource, headers=headers, timeout=15)
+            span.set_attribute('http.status_code', response.status_code)
+            response.raise_for_status()
+        logger.debug(f"Successfully posted FHIR Observation to {FHIR_SERVER_ENDPOINT}. Response: {response.json()}")
         return True
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to post FHIR resource: {e}")
         return False
 
-class MyHandler(MLLPHandler):
+def build_ack(message, ack_code, error_message=None):
+    """
+    Builds an MLLP-framed ACK for a parsed message: sender and receiver are
+    swapped and MSA-2 echoes the message control id.
+    """
+    msh = message.msh
+    ack = Message('ACK', version=msh.msh_12.value or '2.5')
+    ack.msh.msh_3 = msh.msh_5.value
+    ack.msh.msh_4 = msh.msh_6.value
+    ack.msh.msh_5 = msh.msh_3.value
+    ack.msh.msh_6 = msh.msh_4.value
+    ack.msh.msh_9 = f"ACK^{msh.msh_9.msh_9_2.value}^ACK"
+    ack.msh.msh_10 = f"ACK{msh.msh_10.value}"
+    ack.msh.msh_11 = msh.msh_11.value or 'P'
+    ack.msa.msa_1 = ack_code
+    ack.msa.msa_2 = msh.msh_10.value
+    if error_message:
+        ack.msa.msa_3 = error_message
+    return ack.to_mllp()
+
+# Returned when the message cannot be parsed, so there is nothing to echo back.
+ERROR_ACK = '\x0bMSH|^~\\&|||||||ACK|||P|2.5\rMSA|AE|\r\x1c\r'
+
+class MyHandler(AbstractHandler):
     """
-    Custom handler for incoming HL7 messages.
+    Custom handler for incoming ORU^R01 messages. hl7apy's MLLP server strips
+    the framing, passes the ER7 text in and writes back the reply.
     """
+    def reply(self):
+        return self.handle(self.incoming_message)
+
     def handle(self, message):
         """
-        This method is called when a message is received.
-        It parses the message, maps it to FHIR, posts it, and returns an ACK.
+        Parses the message, maps it to FHIR, posts it, and returns an ACK.
+        Each message starts a trace; HL7 v2 has no field to carry one in.
         """
-        logger.info("Received a new HL7 message.")
+        logger.debug("Received a new HL7 message.")
+        with tracer.start_span('handle'):
+            return self._handle(message)
+
+    def _handle(self, message):
+        span = current_span()
         try:
             # Parse the message
-            parsed_message = parser.parse_message(message.decode(), find_groups=False)
+            parsed_message = parser.parse_message(message, find_groups=False)
             logger.debug(f"Parsed message: {parsed_message.to_er7()}")
+            span.set_attribute('hl7.control_id', parsed_message.msh.msh_10.value)
 
             # Map to FHIR
             fhir_observation = map_hl7_to_fhir(parsed_message)
-            
+
             if fhir_observation:
                 # Post to FHIR server
                 success = post_to_fhir_server(fhir_observation)
                 if success:
                     # Create a positive acknowledgement (ACK)
-                    ack = parsed_message.create_ack(ack_type='AA')
+                    ack = build_ack(parsed_message, 'AA')
+                    span.set_attribute('hl7.ack_code', 'AA')
                 else:
                     # Create a negative acknowledgement (AE - Application Error)
-                    ack = parsed_message.create_ack(ack_type='AE', error_message="Failed to post to FHIR server.")
+                    ack = build_ack(parsed_message, 'AE', "Failed to post to FHIR server.")
+                    span.set_attribute('hl7.ack_code', 'AE')
             else:
-                ack = parsed_message.create_ack(ack_type='AE', error_message="Failed to map HL7 to FHIR.")
+                ack = build_ack(parsed_message, 'AE', "Failed to map HL7 to FHIR.")
+                span.set_attribute('hl7.ack_code', 'AE')
 
-            return ack.to_mllp()
+            return ack
 
         except HL7apyException as e:
             logger.error(f"Failed to parse HL7 message: {e}")
+            span.set_attribute('hl7.ack_code', 'AE')
             # Return a basic error ACK if parsing fails
-            return b'\x0bMSH|^~\\&|||||...||ACK^A01|...|P|2.5\rMSA|AE|...\r\x1c\r'
+            return ERROR_ACK
+
+class ErrorHandler(AbstractErrorHandler):
+    """Answers invalid and unsupported message types with an error ACK instead of closing the connection."""
+    def reply(self):
+        logger.error(f"Rejected HL7 message: {self.exc!r}")
+        return ERROR_ACK
+
+HANDLERS = {
+    'ORU^R01': (MyHandler,),
+    'ERR': (ErrorHandler,),
+}
 
 
 def run_server():
@@ -121,7 +180,7 @@ def run_server():
     Starts the MLLP server.
     """
     try:
-        server = MLLPServer(LISTENER_HOST, LISTENER_PORT, MyHandler)
+        server = MLLPServer(LISTENER_HOST, LISTENER_PORT, HANDLERS)
         logger.info(f"Starting HL7 MLLP listener on {LISTENER_HOST}:{LISTENER_PORT}")
         server.serve_forever()
     except Exception as e:
@@ -0,0 +1,83 @@
+import os
+import sys
+import socket
+import threading
+import pytest
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+os.environ.setdefault('FHIR_SERVER_ENDPOINT', 'http://fhir.test/Observation')
+
+import main
+from main import MyHandler
+
+ORU_MESSAGE = 'MSH|^~\\&|DOSIMETER|SHIP|EHR|NAVY|20250301120000||ORU^R01|MSG00001|P|2.5\r'
+
+@pytest.fixture
+def handler():
+    """A handler without the socket plumbing; handle() only needs the message."""
+    return MyHandler.__new__(MyHandler)
+
+@pytest.fixture
+def exporter(mocker):
+    mocker.patch('main.tracer.sample_rate', 1.0)
+    return mocker.patch('main.tracer.exporter')
+
+def handle_span(exporter):
+    return next(call[0][0] for call in exporter.export.call_args_list if call[0][0]['name'] == 'handle')
+
+@pytest.mark.parametrize('posted, ack_code', [(True, 'AA'), (False, 'AE')])
+def test_handle_acknowledges_the_fhir_post(handler, exporter, mocker, posted, ack_code):
+    mocker.patch('main.map_hl7_to_fhir', return_value={'resourceType': 'Observation'})
+    mocker.patch('main.post_to_fhir_server', return_value=posted)
+
+    ack = handler.handle(ORU_MESSAGE)
+
+    assert ack.startswith('\x0bMSH|^~\\&|EHR|NAVY|DOSIMETER|SHIP|')
+    assert '|ACK^R01^ACK|ACKMSG00001|P|2.5\r' in ack
+    assert f'MSA|{ack_code}|MSG00001' in ack
+    assert handle_span(exporter)['attributes'] == {'hl7.control_id': 'MSG00001', 'hl7.ack_code': ack_code}
+
+def test_handle_rejects_a_message_that_does_not_map(handler, exporter, mocker):
+    post = mocker.patch('main.post_to_fhir_server')
+    mocker.patch('main.map_hl7_to_fhir', return_value=None)
+
+    ack = handler.handle(ORU_MESSAGE)
+
+    assert 'MSA|AE|MSG00001' in ack
+    post.assert_not_called()
+    assert handle_span(exporter)['attributes']['hl7.ack_code'] == 'AE'
+
+def test_handle_returns_an_error_ack_for_unparseable_messages(handler, exporter):
+    ack = handler.handle('not an hl7 message')
+
+    assert 'MSA|AE' in ack
+    assert handle_span(exporter)['attributes'] == {'hl7.ack_code': 'AE'}
+
+def test_post_to_fhir_server_passes_the_trace_on(exporter, mocker):
+    post = mocker.patch('main.requests.post')
+    post.return_value = MagicMock(status_code=201)
+
+    with main.tracer.start_span('handle') as parent:
+        assert main.post_to_fhir_server({'resourceType': 'Observation'}) is True
+
+    headers = post.call_args.kwargs['headers']
+    assert headers['traceparent'].split('-')[1] == parent.context.trace_id
+
+def test_mllp_server_routes_messages_to_the_handlers(exporter, mocker):
+    mocker.patch('main.map_hl7_to_fhir', return_value={'resourceType': 'Observation'})
+    mocker.patch('main.post_to_fhir_server', return_value=True)
+    server = main.MLLPServer('127.0.0.1', 0, main.HANDLERS)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def send(message):
+        with socket.create_connection(server.server_address, timeout=5) as conn:
+            conn.sendall(b'\x0b' + message.encode() + b'\x1c\r')
+            return conn.makefile('rb').read().decode()
+
+    try:
+        assert 'MSA|AA|MSG00001' in send(ORU_MESSAGE)
+        assert 'MSA|AE' in send(ORU_MESSAGE.replace('ORU^R01', 'ADT^A01'))
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from db_pool import ConnectionManager
+from metrics_http import start_metrics_server
+
+# --- Load Configuration ---
+load_dotenv()
+
+# DB Config (shared by every job through one pool)
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_NAME = os.getenv("DB_NAME")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+
+# Scheduler Config
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", 3))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", SCHEDULER_WORKERS))
+SCHEDULER_JITTER_SECONDS = float(os.getenv("SCHEDULER_JITTER_SECONDS", 30))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# Job intervals in seconds (0 disables a job)
+ANOMALY_INTERVAL_SECONDS = float(os.getenv("ANOMALY_INTERVAL_SECONDS", 300))
+SFTP_INTERVAL_SECONDS = float(os.getenv("SFTP_INTERVAL_SECONDS", 300))
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", 86400))
+
+# Logging Config
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# --- Logging Setup ---
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Job:
+    """A registered job: func(conn) runs every interval seconds, plus up to jitter seconds."""
+
+    def __init__(self, name, func, interval, jitter=0.0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.next_run = time.monotonic() + random.uniform(0, jitter)
+        self.running = False
+
+    def schedule_next(self, now):
+        self.next_run = now + self.interval + random.uniform(0, self.jitter)
+
+
+class JobMetrics:
+    """Thread-safe per-job run counters and durations."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def _job(self, name):
+        return self._jobs.setdefault(name, {
+            'runs': 0, 'failures': 0, 'skipped_overlap': 0, 'skipped_locked': 0,
+            'last_seconds': None, 'mean_seconds': None, 'max_seconds': None,
+            'last_finished_at': None, 'running': False,
+        })
+
+    def record_start(self, name):
+        with self._lock:
+            self._job(name)['running'] = True
+
+    def record_run(self, name, seconds, failed):
+        with self._lock:
+            job = self._job(name)
+            job['runs'] += 1
+            job['failures'] += int(failed)
+            job['last_seconds'] = round(seconds, 3)
+            job['mean_seconds'] = round(((job['mean_seconds'] or 0) * (job['runs'] - 1) + seconds) / job['runs'], 3)
+            job['max_seconds'] = round(max(job['max_seconds'] or 0, seconds), 3)
+            job['last_finished_at'] = time.time()
+            job['running'] = False
+
+    def record_skip(self, name, reason):
+        with self._lock:
+            job = self._job(name)
+            job[f'skipped_{reason}'] += 1
+            if reason == 'locked':
+                job['running'] = False
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(job) for name, job in self._jobs.items()}
+
+
+class JobScheduler:
+    """
+    Runs registered jobs on a worker pool with connections from a shared pool.
+    A job never overlaps itself: a run that is still going when the job is due
+    again is skipped, and a Postgres advisory lock keyed by the job name keeps
+    other scheduler instances from running it at the same time.
+    """
+
+    def __init__(self, db_pool, workers, metrics=None):
+        self.db_pool = db_pool
+        self.workers = workers
+        self.metrics = metrics or JobMetrics()
+        self.jobs = []
+        self._lock = threading.Lock()
+
+    def register(self, name, func, interval, jitter=0.0):
+        if interval <= 0:
+            logger.info(f"Job '{name}' is disabled.")
+            return None
+        job = Job(name, func, interval, jitter)
+        self.jobs.append(job)
+        logger.info(f"Registered job '{name}' every {interval:.0f}s (+ up to {jitter:.0f}s jitter).")
+        return job
+
+    def execute(self, job):
+        """Runs one job with a pooled connection; always returns the connection to the pool."""
+        started = time.monotonic()
+        failed = False
+        conn = self.db_pool.getconn()
+        if conn is None:
+            logger.error(f"Job '{job.name}' skipped: no database connection available.")
+            with self._lock:
+                job.running = False
+            self.metrics.record_run(job.name, time.monotonic() - started, True)
+            return
+        locked = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (job.name,))
+                locked = cur.fetchone()[0]
+            conn.commit()
+            if not locked:
+                logger.info(f"Job '{job.name}' is running in another scheduler; skipping.")
+                self.metrics.record_skip(job.name, 'locked')
+                return
+            job.func(conn)
+        except Exception as e:
+            failed = True
+            logger.error(f"Job '{job.name}' failed: {e}")
+        finally:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                    if locked:
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (job.name,))
+                        conn.commit()
+                except psycopg2.Error:
+                    pass
+            self.db_pool.putconn(conn)
+            with self._lock:
+                job.running = False
+            if locked:
+                elapsed = time.monotonic() - started
+                self.metrics.record_run(job.name, elapsed, failed)
+                logger.info(f"Job '{job.name}' {'failed' if failed else 'finished'} in {elapsed:.2f}s.")
+
+    def dispatch_due(self, executor, now):
+        """Submits every job that is due and not already running. Returns the time of the next due job."""
+        for job in self.jobs:
+            if job.next_run > now:
+                continue
+            job.schedule_next(now)
+            with self._lock:
+                if job.running:
+                    logger.warning(f"Job '{job.name}' is still running; skipping this run.")
+                    self.metrics.record_skip(job.name, 'overlap')
+                    continue
+                job.running = True
+            self.metrics.record_start(job.name)
+            executor.submit(self.execute, job)
+        return min((job.next_run for job in self.jobs), default=now + 60)
+
+    def run(self, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job') as executor:
+            while not stop_event.is_set():
+                next_due = self.dispatch_due(executor, time.monotonic())
+                stop_event.wait(max(next_due - time.monotonic(), 0.1))
+        logger.info("Scheduler stopped; waited for running jobs to finish.")
+
+
+def load_jobs(scheduler):
+    """Imports the batch services once and registers their entry points."""
+    for service in ('anomaly_detection_service', 'data_retention_service', 'sftp_cron_loader'):
+        sys.path.insert(0, os.path.join(SERVER_DIR, service))
+
+    import anomaly_detector
+    import retention_policy_manager
+    import process_sftp_files
+
+    scheduler.register(
+        'anomaly_detection', lambda conn: anomaly_detector.run_anomaly_detection(conn=conn),
+        ANOMALY_INTERVAL_SECONDS, SCHEDULER_JITTER_SECONDS
+    )
+    scheduler.register(
+        'sftp_loader', lambda conn: process_sftp_files.process_files_from_sftp(conn=conn),
+        SFTP_INTERVAL_SECONDS, SCHEDULER_JITTER_SECONDS
+    )
+    scheduler.register(
+        'data_retention', lambda conn: retention_policy_manager.run_retention_manager(conn=conn),
+        RETENTION_INTERVAL_SECONDS, SCHEDULER_JITTER_SECONDS
+    )
+
+
+def main():
+    db_pool = ConnectionManager(
+        dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD),
+        max_connections=DB_POOL_SIZE
+    )
+    metrics = JobMetrics()
+    if METRICS_PORT:
+        start_metrics_server(metrics, METRICS_PORT, 'scheduler')
+    scheduler = JobScheduler(db_pool, SCHEDULER_WORKERS, metrics)
+    load_jobs(scheduler)
+
+    stop_event = threading.Event()
+    try:
+        scheduler.run(stop_event)
+    except KeyboardInterrupt:
+        logger.info("Shutting down job scheduler...")
+        stop_event.set()
+    finally:
+        db_pool.close()
+        logger.info("Database connection pool closed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import pytest
+from unittest.mock import MagicMock
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from main import JobScheduler, JobMetrics
+
+@pytest.fixture
+def mock_pool():
+    """Fixture to mock the shared connection pool and its connection."""
+    mock_pool = MagicMock()
+    mock_conn = MagicMock()
+    mock_conn.closed = 0
+    mock_cur = MagicMock()
+    mock_cur.fetchone.return_value = (True,)
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+    mock_pool.getconn.return_value = mock_conn
+    return mock_pool, mock_conn, mock_cur
+
+def test_execute_passes_pooled_connection_and_records_runtime(mock_pool):
+    pool, conn, cur = mock_pool
+    job_func = MagicMock()
+    scheduler = JobScheduler(pool, workers=1)
+    job = scheduler.register('anomaly_detection', job_func, interval=60)
+    job.running = True
+
+    scheduler.execute(job)
+
+    job_func.assert_called_once_with(conn)
+    pool.putconn.assert_called_once_with(conn)
+    statements = [c[0][0] for c in cur.execute.call_args_list]
+    assert 'pg_try_advisory_lock' in statements[0] and 'pg_advisory_unlock' in statements[-1]
+    stats = scheduler.metrics.snapshot()['anomaly_detection']
+    assert stats['runs'] == 1 and stats['failures'] == 0 and not stats['running']
+    assert not job.running
+
+def test_execute_counts_failures_and_returns_connection(mock_pool):
+    pool, conn, _ = mock_pool
+    scheduler = JobScheduler(pool, workers=1)
+    job = scheduler.register('sftp_loader', MagicMock(side_effect=RuntimeError("boom")), interval=60)
+
+    scheduler.execute(job)
+
+    conn.rollback.assert_called()
+    pool.putconn.assert_called_once_with(conn)
+    assert scheduler.metrics.snapshot()['sftp_loader']['failures'] == 1
+
+def test_execute_counts_a_failure_when_no_connection_is_available(mock_pool):
+    pool, _, _ = mock_pool
+    pool.getconn.return_value = None
+    job_func = MagicMock()
+    scheduler = JobScheduler(pool, workers=1)
+    job = scheduler.register('anomaly_detection', job_func, interval=60)
+    job.running = True
+
+    scheduler.execute(job)
+
+    job_func.assert_not_called()
+    pool.putconn.assert_not_called()
+    assert scheduler.metrics.snapshot()['anomaly_detection']['failures'] == 1
+    assert not job.running
+
+def test_execute_skips_job_locked_by_another_scheduler(mock_pool):
+    pool, conn, cur = mock_pool
+    cur.fetchone.return_value = (False,)
+    job_func = MagicMock()
+    scheduler = JobScheduler(pool, workers=1)
+    job = scheduler.register('data_retention', job_func, interval=60)
+
+    scheduler.execute(job)
+
+    job_func.assert_not_called()
+    assert not any('pg_advisory_unlock' in c[0][0] for c in cur.execute.call_args_list)
+    stats = scheduler.metrics.snapshot()['data_retention']
+    assert stats['skipped_locked'] == 1 and stats['runs'] == 0
+    pool.putconn.assert_called_once_with(conn)
+
+def test_dispatch_due_never_overlaps_a_running_job(mock_pool):
+    pool, _, _ = mock_pool
+    executor = MagicMock()
+    scheduler = JobScheduler(pool, workers=2, metrics=JobMetrics())
+    slow = scheduler.register('data_retention', MagicMock(), interval=10)
+    fast = scheduler.register('sftp_loader', MagicMock(), interval=30)
+    assert scheduler.register('disabled', MagicMock(), interval=0) is None
+    slow.next_run = fast.next_run = 0
+
+    next_due = scheduler.dispatch_due(executor, now=100)
+
+    assert executor.submit.call_count == 2
+    assert next_due == 110
+    # The retention run is still going when it is due again; only that run is skipped.
+    fast.running = False
+    next_due = scheduler.dispatch_due(executor, now=110)
+
+    assert executor.submit.call_count == 2
+    assert scheduler.metrics.snapshot()['data_retention']['skipped_overlap'] == 1
+    assert next_due == 120
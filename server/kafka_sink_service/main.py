@@ -0,0 +1,369 @@
+import os
+import sys
+import csv
+import json
+import math
+import time
+import uuid
+import logging
+from io import StringIO
+from datetime import datetime, date, timezone
+import psycopg2
+from dotenv import load_dotenv
+from kafka import KafkaConsumer, KafkaProducer, ConsumerRebalanceListener
+from kafka.errors import CommitFailedError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from db_pool import connect
+from tracing import parse_traceparent, traceparent_from_headers, tracer_from_env
+
+# --- Load Configuration ---
+load_dotenv()
+
+# Kafka settings
+KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092").split(',')
+KAFKA_TOPIC = os.getenv("KAFKA_TOPIC", "environmental_exposures")
+# Run several instances with the same group id to split the topic's partitions between them.
+KAFKA_GROUP_ID = os.getenv("KAFKA_GROUP_ID", "exposures_sink")
+# Invalid messages are published here (if set) instead of only being logged.
+KAFKA_DLQ_TOPIC = os.getenv("KAFKA_DLQ_TOPIC", "")
+
+# Batching
+BATCH_MAX_RECORDS = int(os.getenv("BATCH_MAX_RECORDS", 5000))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", 1000))
+RETRY_BACKOFF_SECONDS = float(os.getenv("RETRY_BACKOFF_SECONDS", 5))
+
+# DB Config
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_NAME = os.getenv("DB_NAME")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+
+# Logging Config
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# --- Logging Setup ---
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Tracing (TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH) ---
+tracer = tracer_from_env('kafka_sink')
+
+EXPOSURE_COLUMNS = ['sample_id', 'device_id', 'location_code', 'timestamp_utc', 'captured_by', 'method_code', 'value', 'unit', 'qualifier']
+QUALIFIERS = {'OK', 'ALERT', 'OVER_LIMIT', 'PENDING'}
+# VARCHAR widths of the exposures and detail columns (migration 009); longer values are rejected up front.
+MAX_LENGTHS = {
+    'device_id': 255, 'location_code': 255, 'captured_by': 255, 'method_code': 255, 'unit': 50,
+    'filter_type': 100, 'compound_name': 255, 'media_type': 100, 'detector_type': 100,
+    'sample_type': 100, 'flag_color': 50,
+}
+
+# Detail columns and the Python type each value is coerced to.
+DETAIL_COLUMNS = {
+    'air_quality_details': {'duration_sec': int, 'flow_rate_lpm': float, 'filter_type': str},
+    'voc_details': {'compound_name': str, 'media_type': str, 'humidity_pct': float},
+    'noise_details': {'dosimeter_interval_min': int, 'laeq': float, 'peak_db': float},
+    'radiation_details': {'detector_type': str, 'shielding_cm': float, 'calibration_date': date.fromisoformat},
+    'water_details': {'sample_type': str, 'temp_c': float, 'residual_chlorine_mg_l': float},
+    'heat_stress_details': {'db_c': float, 'wb_c': float, 'globe_c': float, 'flag_color': str},
+}
+
+# Accepted values of a message's "type" field.
+DETAIL_TYPES = {
+    'air': 'air_quality_details', 'air_quality': 'air_quality_details',
+    'voc': 'voc_details',
+    'noise': 'noise_details',
+    'rad': 'radiation_details', 'radiation': 'radiation_details',
+    'water': 'water_details',
+    'heat': 'heat_stress_details', 'heat_stress': 'heat_stress_details',
+}
+
+# Namespace for sample_ids derived from message content, so a redelivered or
+# republished reading always maps to the same row.
+SAMPLE_ID_NAMESPACE = uuid.UUID('6f1d3c2e-8a4b-4f0e-9d5a-2b7c1e9f4a60')
+
+
+class InvalidMessage(ValueError):
+    pass
+
+
+def get_db_connection():
+    """Establishes and returns a connection to the PostgreSQL database, or None if it is unreachable."""
+    return connect(dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD))
+
+
+def check_length(column, value):
+    """Raises InvalidMessage if a string value would not fit its column."""
+    if isinstance(value, str) and column in MAX_LENGTHS and len(value) > MAX_LENGTHS[column]:
+        raise InvalidMessage(f"{column} is longer than {MAX_LENGTHS[column]} characters.")
+
+
+def parse_timestamp(value):
+    """Parses an ISO 8601 timestamp; naive timestamps are taken as UTC."""
+    ts = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+
+def parse_message(payload):
+    """
+    Validates one message and returns (exposure_row, detail_table, detail_row);
+    detail_table/detail_row are None for readings without details.
+
+    Expected JSON: {"device_id", "location_code", "timestamp_utc", "value", "unit",
+    optional "captured_by", "method_code", "qualifier", "sample_id", and "type"
+    (noise, radiation, ...) with the detail fields either top-level or in "details"}.
+    """
+    try:
+        message = json.loads(payload)
+    except (TypeError, ValueError) as e:
+        raise InvalidMessage(f"Not valid JSON: {e}")
+    if not isinstance(message, dict):
+        raise InvalidMessage("Message is not a JSON object.")
+
+    missing = [f for f in ('device_id', 'timestamp_utc', 'value', 'unit') if message.get(f) in (None, '')]
+    if missing:
+        raise InvalidMessage(f"Missing required fields: {', '.join(missing)}")
+    try:
+        timestamp_utc = parse_timestamp(message['timestamp_utc'])
+        value = float(message['value'])
+    except (TypeError, ValueError) as e:
+        raise InvalidMessage(f"Invalid timestamp_utc or value: {e}")
+    if not math.isfinite(value):
+        raise InvalidMessage("value must be finite.")
+    unit = str(message['unit'])
+    qualifier = message.get('qualifier') or 'OK'
+    if qualifier not in QUALIFIERS:
+        raise InvalidMessage(f"Unknown qualifier '{qualifier}'.")
+
+    device_id = str(message['device_id'])
+    if message.get('sample_id'):
+        try:
+            sample_id = str(uuid.UUID(str(message['sample_id'])))
+        except ValueError:
+            raise InvalidMessage("sample_id is not a UUID.")
+    else:
+        key = f"{device_id}|{timestamp_utc.astimezone(timezone.utc).isoformat()}|{unit}"
+        sample_id = str(uuid.uuid5(SAMPLE_ID_NAMESPACE, key))
+
+    exposure = [
+        sample_id, device_id, message.get('location_code'), timestamp_utc.isoformat(),
+        message.get('captured_by'), message.get('method_code'), value, unit, qualifier
+    ]
+    for column, field in zip(EXPOSURE_COLUMNS, exposure):
+        check_length(column, field)
+
+    detail_type = message.get('type')
+    if not detail_type:
+        return exposure, None, None
+    detail_table = DETAIL_TYPES.get(str(detail_type).lower())
+    if detail_table is None:
+        raise InvalidMessage(f"Unknown type '{detail_type}'.")
+    source = message.get('details') if isinstance(message.get('details'), dict) else message
+    detail = [sample_id]
+    for column, cast in DETAIL_COLUMNS[detail_table].items():
+        raw = source.get(column)
+        try:
+            detail.append(None if raw in (None, '') else cast(raw))
+        except (TypeError, ValueError) as e:
+            raise InvalidMessage(f"Invalid {column}: {e}")
+        check_length(column, detail[-1])
+    return exposure, detail_table, detail
+
+
+def copy_via_stage(cur, table, columns, rows):
+    """COPYs rows into a temp copy of table, then inserts them, skipping rows that already exist. Returns rows inserted."""
+    stage = f"stage_{table}"
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if v is None else (v.isoformat() if isinstance(v, date) else v) for v in row])
+    buffer.seek(0)
+    column_list = ', '.join(columns)
+    cur.copy_expert(f"COPY {stage} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+    cur.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {stage} ON CONFLICT DO NOTHING")
+    return cur.rowcount
+
+
+def load_batch(conn, parsed):
+    """
+    Writes a batch of parsed messages to exposures and the detail tables in one
+    transaction. Duplicates (same sample_id) are skipped. Returns rows inserted.
+    """
+    exposures = {}
+    details = {}
+    for exposure, detail_table, detail in parsed:
+        # Last copy wins within a batch; across batches ON CONFLICT skips repeats.
+        exposures[exposure[0]] = exposure
+        if detail_table:
+            details.setdefault(detail_table, {})[detail[0]] = detail
+
+    with conn.cursor() as cur:
+        inserted = copy_via_stage(cur, 'exposures', EXPOSURE_COLUMNS, exposures.values())
+        for table, rows in details.items():
+            copy_via_stage(cur, table, ['sample_id'] + list(DETAIL_COLUMNS[table]), rows.values())
+    conn.commit()
+    return inserted
+
+
+def load_splitting(conn, parsed, records):
+    """
+    Loads parsed messages, halving the batch whenever the database rejects it
+    with a DataError or IntegrityError so the good messages still land.
+    Returns (rows_inserted, [(record, error), ...]) for the messages that
+    failed on their own. Other database errors are raised to the caller.
+    """
+    try:
+        return load_batch(conn, parsed), []
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        conn.rollback()
+        if len(parsed) == 1:
+            return 0, [(records[0], e)]
+    middle = len(parsed) // 2
+    inserted, rejected = load_splitting(conn, parsed[:middle], records[:middle])
+    more, more_rejected = load_splitting(conn, parsed[middle:], records[middle:])
+    return inserted + more, rejected + more_rejected
+
+
+class SinkRebalanceListener(ConsumerRebalanceListener):
+    """Offsets are committed after every batch, so a rebalance only needs logging."""
+
+    def on_partitions_revoked(self, revoked):
+        logger.info(f"Partitions revoked: {sorted((tp.topic, tp.partition) for tp in revoked)}")
+
+    def on_partitions_assigned(self, assigned):
+        logger.info(f"Partitions assigned: {sorted((tp.topic, tp.partition) for tp in assigned)}")
+
+
+def poll_batch(consumer):
+    """Polls until BATCH_MAX_RECORDS messages or BATCH_MAX_WAIT_MS have been reached. Returns a list of records."""
+    records = []
+    deadline = time.monotonic() + BATCH_MAX_WAIT_MS / 1000.0
+    while len(records) < BATCH_MAX_RECORDS:
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if remaining_ms <= 0:
+            break
+        polled = consumer.poll(timeout_ms=remaining_ms, max_records=BATCH_MAX_RECORDS - len(records))
+        for partition_records in polled.values():
+            records.extend(partition_records)
+    return records
+
+
+def rewind(consumer, records):
+    """Seeks every partition in the batch back to its first record so the batch is redelivered."""
+    first = {}
+    for record in records:
+        tp = (record.topic, record.partition)
+        first[tp] = min(first.get(tp, record.offset), record.offset)
+    for tp in consumer.assignment():
+        if (tp.topic, tp.partition) in first:
+            consumer.seek(tp, first[(tp.topic, tp.partition)])
+
+
+def process_batch(consumer, conn, records, dlq_producer=None):
+    """
+    Validates and loads one polled batch, then commits the consumer offsets.
+    Offsets are only committed after the database commit (at-least-once).
+    Messages that fail validation or that the database rejects (DataError,
+    IntegrityError) go to the DLQ; transient database errors are raised so
+    the caller can retry the batch. Messages carrying a sampled traceparent
+    header get one span each for the shared batch load.
+    Returns (rows_inserted, invalid_count).
+    """
+    started = time.time()
+    parsed = []
+    loaded = []
+    rejected = []
+    traced = []
+    for record in records:
+        context = parse_traceparent(traceparent_from_headers(getattr(record, 'headers', None)))
+        if context is not None and context.sampled:
+            traced.append((record, context))
+        try:
+            parsed.append(parse_message(record.value))
+            loaded.append(record)
+        except InvalidMessage as e:
+            rejected.append((record, e))
+
+    inserted = 0
+    if parsed:
+        inserted, failed = load_splitting(conn, parsed, loaded)
+        rejected.extend(failed)
+    for record, error in rejected:
+        logger.warning(f"Invalid message at {record.topic}[{record.partition}]@{record.offset}: {error}")
+        if dlq_producer:
+            dlq_producer.send(KAFKA_DLQ_TOPIC, value=record.value, headers=[('error', str(error).encode('utf-8'))])
+    if dlq_producer and rejected:
+        dlq_producer.flush()
+    consumer.commit()
+
+    finished = time.time()
+    for record, context in traced:
+        attributes = {'kafka.partition': record.partition, 'kafka.offset': record.offset, 'batch.size': len(records)}
+        if getattr(record, 'timestamp', None):
+            # Time the message waited in Kafka before this batch picked it up
+            attributes['kafka.queue_ms'] = round(started * 1000 - record.timestamp, 1)
+        tracer.record_span('load_batch', context, started, finished, attributes)
+    return inserted, len(rejected)
+
+
+def run_consumer():
+    """Main loop: poll, validate, load and commit, forever."""
+    consumer = KafkaConsumer(
+        bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+        group_id=KAFKA_GROUP_ID,
+        enable_auto_commit=False,
+        auto_offset_reset='earliest',
+        max_poll_records=BATCH_MAX_RECORDS,
+    )
+    consumer.subscribe([KAFKA_TOPIC], listener=SinkRebalanceListener())
+    dlq_producer = KafkaProducer(bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS) if KAFKA_DLQ_TOPIC else None
+    logger.info(f"Consuming {KAFKA_TOPIC} as group {KAFKA_GROUP_ID} in batches of up to {BATCH_MAX_RECORDS}.")
+
+    conn = None
+    try:
+        while True:
+            records = poll_batch(consumer)
+            if not records:
+                continue
+            if conn is None or conn.closed:
+                conn = get_db_connection()
+                if conn is None:
+                    rewind(consumer, records)
+                    time.sleep(RETRY_BACKOFF_SECONDS)
+                    continue
+            started = time.monotonic()
+            try:
+                inserted, invalid = process_batch(consumer, conn, records, dlq_producer)
+            except psycopg2.Error as e:
+                # Rejected messages were already split out, so this is transient (connection lost, deadlock, ...).
+                logger.error(f"Failed to load batch of {len(records)} messages; it will be retried: {e}")
+                if not conn.closed:
+                    conn.rollback()
+                rewind(consumer, records)
+                time.sleep(RETRY_BACKOFF_SECONDS)
+                continue
+            except CommitFailedError as e:
+                # The group rebalanced mid-batch; the rows are in the database and the
+                # redelivered messages are skipped as duplicates.
+                logger.warning(f"Offset commit failed after loading the batch: {e}")
+                continue
+            elapsed = time.monotonic() - started
+            logger.info(
+                f"Loaded {inserted} of {len(records)} messages ({invalid} invalid, "
+                f"{len(records) - invalid - inserted} duplicates) in {elapsed:.2f}s."
+            )
+    except KeyboardInterrupt:
+        logger.info("Shutting down Kafka sink...")
+    finally:
+        consumer.close()
+        if dlq_producer:
+            dlq_producer.close()
+        if conn:
+            conn.close()
+            logger.info("Database connection closed.")
+
+
+if __name__ == "__main__":
+    run_consumer()
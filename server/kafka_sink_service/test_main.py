@@ -0,0 +1,157 @@
+import json
+import pytest
+from unittest.mock import MagicMock, call
+from collections import namedtuple
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import psycopg2
+from main import parse_message, load_batch, process_batch, rewind, InvalidMessage
+
+Record = namedtuple('Record', 'topic partition offset value')
+TracedRecord = namedtuple('TracedRecord', 'topic partition offset value headers timestamp')
+
+def reading(**overrides):
+    message = {
+        'device_id': 'aerps-7', 'location_code': 'DDG-51-ER', 'timestamp_utc': '2024-05-01T12:00:00Z',
+        'value': 88.5, 'unit': 'dBA', 'type': 'noise', 'details': {'laeq': 88.5, 'peak_db': 120, 'dosimeter_interval_min': '1'},
+    }
+    message.update(overrides)
+    return json.dumps(message).encode('utf-8')
+
+@pytest.fixture
+def mock_db_connection():
+    """Fixture to mock the database connection and cursor."""
+    mock_conn = MagicMock()
+    mock_cur = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+    return mock_conn, mock_cur
+
+def test_parse_message_builds_exposure_and_detail_rows():
+    exposure, detail_table, detail = parse_message(reading())
+
+    assert detail_table == 'noise_details'
+    assert exposure[1:] == ['aerps-7', 'DDG-51-ER', '2024-05-01T12:00:00+00:00', None, None, 88.5, 'dBA', 'OK']
+    assert detail == [exposure[0], 1, 88.5, 120.0]
+
+def test_parse_message_derives_the_same_sample_id_for_a_redelivered_reading():
+    """The id depends on the reading, not on the Kafka offset, so replays and MQTT duplicates dedupe."""
+    first = parse_message(reading())[0][0]
+    again = parse_message(reading(timestamp_utc='2024-05-01T12:00:00+00:00', details={}))[0][0]
+    other = parse_message(reading(timestamp_utc='2024-05-01T12:00:01Z'))[0][0]
+
+    assert first == again
+    assert first != other
+
+@pytest.mark.parametrize('payload', [
+    b'not json',
+    b'[1, 2]',
+    reading(value=None),
+    reading(value='NaN'),
+    reading(timestamp_utc='yesterday'),
+    reading(qualifier='MAYBE'),
+    reading(type='seismic'),
+    reading(details={'dosimeter_interval_min': 'ten'}),
+    reading(device_id='d' * 256),
+    reading(location_code='L' * 256),
+    reading(unit='u' * 51),
+    reading(type='rad', details={'detector_type': 'x' * 101}),
+])
+def test_parse_message_rejects_invalid_messages(payload):
+    with pytest.raises(InvalidMessage):
+        parse_message(payload)
+
+def test_load_batch_copies_through_staging_and_skips_duplicates(mock_db_connection):
+    mock_conn, mock_cur = mock_db_connection
+    mock_cur.rowcount = 2
+    parsed = [parse_message(reading()), parse_message(reading()), parse_message(reading(device_id='aerps-8', type=None))]
+
+    assert load_batch(mock_conn, parsed) == 2
+
+    copies = [c[0][0] for c in mock_cur.copy_expert.call_args_list]
+    assert [c.split()[1] for c in copies] == ['stage_exposures', 'stage_noise_details']
+    # The in-batch duplicate is collapsed before COPY.
+    assert mock_cur.copy_expert.call_args_list[0][0][1].getvalue().count('\n') == 2
+    inserts = [c[0][0] for c in mock_cur.execute.call_args_list if c[0][0].startswith('INSERT')]
+    assert all('ON CONFLICT DO NOTHING' in q for q in inserts)
+    mock_conn.commit.assert_called_once()
+
+def test_process_batch_commits_offsets_only_after_the_database(mock_db_connection):
+    mock_conn, mock_cur = mock_db_connection
+    mock_cur.rowcount = 1
+    order = MagicMock()
+    mock_conn.commit.side_effect = lambda: order('db')
+    consumer = MagicMock()
+    consumer.commit.side_effect = lambda: order('kafka')
+    dlq = MagicMock()
+    records = [Record('environmental_exposures', 0, 10, reading()), Record('environmental_exposures', 0, 11, b'{}')]
+
+    inserted, invalid = process_batch(consumer, mock_conn, records, dlq)
+
+    assert (inserted, invalid) == (1, 1)
+    assert order.call_args_list == [call('db'), call('kafka')]
+    dlq.send.assert_called_once()
+
+def test_process_batch_records_a_span_for_sampled_traces(mock_db_connection, mocker):
+    mock_conn, mock_cur = mock_db_connection
+    mock_cur.rowcount = 2
+    record_span = mocker.patch('main.tracer.record_span')
+    sampled = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+    records = [
+        TracedRecord('environmental_exposures', 0, 10, reading(), [('traceparent', sampled.encode())], 1),
+        TracedRecord('environmental_exposures', 0, 11, reading(device_id='b'), [('traceparent', sampled[:-2].encode() + b'00')], 1),
+    ]
+
+    process_batch(MagicMock(), mock_conn, records)
+
+    record_span.assert_called_once()
+    name, context, started, finished, attributes = record_span.call_args[0]
+    assert name == 'load_batch' and context.trace_id == '4bf92f3577b34da6a3ce929d0e0e4736'
+    assert finished >= started
+    assert attributes['kafka.offset'] == 10 and attributes['batch.size'] == 2
+
+def test_failed_load_does_not_commit_offsets(mock_db_connection):
+    mock_conn, mock_cur = mock_db_connection
+    mock_cur.copy_expert.side_effect = psycopg2.OperationalError('server closed the connection')
+    consumer = MagicMock()
+
+    with pytest.raises(psycopg2.Error):
+        process_batch(consumer, mock_conn, [Record('environmental_exposures', 0, 10, reading())])
+
+    consumer.commit.assert_not_called()
+
+def test_process_batch_sends_rows_the_database_rejects_to_the_dlq(mock_db_connection, mocker):
+    """A data error splits the batch until the bad message is alone; the rest load and offsets commit."""
+    mock_conn, _ = mock_db_connection
+    bad = reading(device_id='bad')
+
+    def load(conn, parsed):
+        if any(exposure[1] == 'bad' for exposure, _, _ in parsed):
+            raise psycopg2.DataError('numeric field overflow')
+        return len(parsed)
+
+    mocker.patch('main.load_batch', side_effect=load)
+    consumer = MagicMock()
+    dlq = MagicMock()
+    records = [Record('environmental_exposures', 0, offset, reading(device_id=str(offset))) for offset in range(4)]
+    records.insert(2, Record('environmental_exposures', 0, 9, bad))
+
+    inserted, invalid = process_batch(consumer, mock_conn, records, dlq)
+
+    assert (inserted, invalid) == (4, 1)
+    dlq.send.assert_called_once()
+    assert dlq.send.call_args[1]['value'] == bad
+    assert dlq.send.call_args[1]['headers'][0][1] == b'numeric field overflow'
+    consumer.commit.assert_called_once()
+
+def test_rewind_seeks_each_partition_to_its_first_offset():
+    tp0, tp1 = MagicMock(topic='t', partition=0), MagicMock(topic='t', partition=1)
+    consumer = MagicMock()
+    consumer.assignment.return_value = {tp0, tp1}
+    records = [Record('t', 0, 12, b''), Record('t', 0, 10, b''), Record('t', 1, 5, b'')]
+
+    rewind(consumer, records)
+
+    assert sorted((c[0][0].partition, c[0][1]) for c in consumer.seek.call_args_list) == [(0, 10), (1, 5)]
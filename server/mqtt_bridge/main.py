@@ -1,4 +1,5 @@
 import os
+import sys
 import logging
 import json
 from dotenv import load_dotenv
@@ -8,6 +9,9 @@ from kafka import KafkaProducer
 from kafka.errors import NoBrokersAvailable
 import asyncio
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from tracing import TRACEPARENT, kafka_headers, tracer_from_env
+
 # --- Load Configuration ---
 load_dotenv()
 
@@ -27,6 +31,9 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Tracing (TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH) ---
+tracer = tracer_from_env('mqtt_bridge')
+
 # --- FastAPI App ---
 app = FastAPI(
     title="AERPS Sensor MQTT Bridge",
@@ -74,22 +81,28 @@ def connect_mqtt() -> mqtt_client.Client:
     return client
 
 def on_message(client, userdata, msg):
-    """Callback for when a message is received from MQTT."""
+    """
+    Callback for when a message is received from MQTT. A "traceparent" field in
+    the payload continues the publisher's trace; it is moved into the Kafka
+    record headers so the downstream loaders continue it in turn.
+    """
     try:
         payload = msg.payload.decode()
-        logger.info(f"Received message from topic `{msg.topic}`: {payload}")
+        logger.debug(f"Received message from topic `{msg.topic}`: {payload}")
         
         # Assume payload is a JSON string
         sensor_data = json.loads(payload)
+        parent = sensor_data.pop(TRACEPARENT, None) if isinstance(sensor_data, dict) else None
 
         # TODO: Add validation logic here (e.g., using Pydantic)
         # For now, we just forward it.
 
-        producer = get_kafka_producer()
-        if producer:
-            producer.send(KAFKA_TOPIC, value=sensor_data)
-            producer.flush()
-            logger.info(f"Message sent to Kafka topic `{KAFKA_TOPIC}`")
+        with tracer.start_span('forward', parent=parent, attributes={'mqtt.topic': msg.topic}) as span:
+            producer = get_kafka_producer()
+            if producer:
+                producer.send(KAFKA_TOPIC, value=sensor_data, headers=kafka_headers(span))
+                producer.flush()
+                logger.debug(f"Message sent to Kafka topic `{KAFKA_TOPIC}`")
 
     except json.JSONDecodeError:
         logger.error(f"Failed to decode JSON from message: {msg.payload.decode()}")
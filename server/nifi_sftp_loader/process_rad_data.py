@@ -1,70 +1,202 @@
+import re
+import csv
 import json
 import uuid
-from org.apache.nifi.processor.io import StreamCallback
+from datetime import datetime
+from java.nio.charset import StandardCharsets
+from org.apache.commons.io import IOUtils
+from org.apache.nifi.processor.io import InputStreamCallback, OutputStreamCallback
 
-class PyStreamCallback(StreamCallback):
+# Column order of the RAD-1 CSV export (also used for FlowFile attributes).
+CSV_FIELDS = [
+    'device_id', 'location_code', 'timestamp_utc', 'captured_by', 'detector_type',
+    'shielding_cm', 'calibration_date', 'gamma_dose', 'unit'
+]
+REQUIRED_FIELDS = ['device_id', 'location_code', 'timestamp_utc', 'gamma_dose', 'unit']
+
+# ISO 8601 date and time, optional fraction and UTC offset (readings without one are UTC).
+# Matched by hand because Jython 2.7 has neither datetime.fromisoformat nor %z.
+TIMESTAMP_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(\.\d{1,6})?(Z|[+-]\d{2}:?\d{2})?$')
+
+# FlowFiles pulled per trigger; override with an ExecuteScript dynamic property named "BatchSize".
+DEFAULT_BATCH_SIZE = 500
+
+# One statement for the whole batch: the readings travel as a JSON array and are
+# inserted into exposures and radiation_details together, so PutSQL commits both
+# tables in a single transaction. The foreign key is checked at the end of the
+# statement, after the exposures rows exist. Record sets for PutDatabaseRecord
+# would need one FlowFile per table, and PutDatabaseRecord commits each FlowFile
+# on its own, so a failed radiation_details load would leave its exposures
+# committed (or, in the other order, violate the foreign key).
+BATCH_SQL = """WITH readings AS (
+    SELECT * FROM json_to_recordset({payload}::json) AS r(
+        sample_id uuid, device_id varchar, location_code varchar, timestamp_utc timestamptz,
+        captured_by varchar, value numeric, unit varchar, qualifier varchar,
+        detector_type varchar, shielding_cm numeric, calibration_date date
+    )
+), inserted AS (
+    INSERT INTO exposures (sample_id, device_id, location_code, timestamp_utc, captured_by, value, unit, qualifier)
+    SELECT sample_id, device_id, location_code, timestamp_utc, captured_by, value, unit, qualifier FROM readings
+)
+INSERT INTO radiation_details (sample_id, detector_type, shielding_cm, calibration_date)
+SELECT sample_id, detector_type, shielding_cm, calibration_date FROM readings"""
+
+
+class ReadContentCallback(InputStreamCallback):
     def __init__(self):
-        pass
-
-    def process(self, inputStream, outputStream):
-        # Generate a unique sample_id for this record
-        sample_id = str(uuid.uuid4())
-
-        # Read attributes from the FlowFile
-        device_id = flowFile.getAttribute('device_id')
-        location_code = flowFile.getAttribute('location_code')
-        timestamp_utc = flowFile.getAttribute('timestamp_utc')
-        captured_by = flowFile.getAttribute('captured_by')
-        detector_type = flowFile.getAttribute('detector_type')
-        shielding_cm = flowFile.getAttribute('shielding_cm')
-        calibration_date = flowFile.getAttribute('calibration_date')
-        gamma_dose = flowFile.getAttribute('gamma_dose')
-        unit = flowFile.getAttribute('unit')
-
-        # Basic validation
-        if not all([device_id, location_code, timestamp_utc, gamma_dose, unit]):
-            # You can route to a failure relationship in NiFi if needed
-            # For now, we just log and write an empty output
-            # log.error("Missing required fields in FlowFile attributes.")
-            return
-
-        # --- SQL Statement Generation ---
-        
-        # SQL for the 'exposures' table
-        sql_exposures = (
-            "INSERT INTO exposures (sample_id, device_id, location_code, timestamp_utc, captured_by, value, unit, qualifier) "
-            "VALUES ('{}', '{}', '{}', '{}', '{}', {}, '{}', 'OK');"
-        ).format(
-            sample_id,
-            device_id,
-            location_code,
-            timestamp_utc,
-            captured_by,
-            float(gamma_dose),
-            unit
-        )
-
-        # SQL for the 'radiation_details' table
-        sql_radiation_details = (
-            "INSERT INTO radiation_details (sample_id, detector_type, shielding_cm, calibration_date) "
-            "VALUES ('{}', '{}', {}, '{}');"
-        ).format(
-            sample_id,
-            detector_type,
-            float(shielding_cm) if shielding_cm else 'NULL',
-            calibration_date if calibration_date else 'NULL'
-        )
-
-        # Combine the SQL statements. The PutDatabaseRecord processor can handle multiple statements.
-        combined_sql = sql_exposures + "\n" + sql_radiation_details
-
-        # Write the combined SQL to the FlowFile content
-        outputStream.write(combined_sql.encode('utf-8'))
-
-# Instantiate the callback and process the flowfile
-flowFile = session.get()
-if flowFile is not None:
-    flowFile = session.write(flowFile, PyStreamCallback())
-    # Route to success
-    session.transfer(flowFile, REL_SUCCESS)
+        self.text = None
+
+    def process(self, inputStream):
+        self.text = IOUtils.toString(inputStream, StandardCharsets.UTF_8)
+
+
+class WriteContentCallback(OutputStreamCallback):
+    def __init__(self, content):
+        self.content = content
+
+    def process(self, outputStream):
+        outputStream.write(bytearray(self.content.encode('utf-8')))
+
+
+def parse_csv(text):
+    """
+    Returns one reading dict per CSV line. Header lines are skipped: SplitText
+    with "Header Line Count: 1" repeats the header at the top of every split.
+    """
+    lines = text.splitlines()
+    if str is bytes:
+        # Jython 2.7: the csv module reads byte strings
+        lines = [line.encode('utf-8') for line in lines]
+    readings = []
+    for row in csv.reader(lines):
+        values = [value.strip() for value in row]
+        if not ''.join(values) or values == CSV_FIELDS:
+            continue
+        readings.append(dict(zip(CSV_FIELDS, values)))
+    return readings
+
+
+def readings_from_flowfile(flowFile):
+    """
+    Returns the readings carried by one FlowFile as a list of dicts: either one
+    reading from its attributes (SplitText + UpdateAttribute), or one reading
+    per CSV line of its content (SplitText with a larger Line Split Count).
+    """
+    if flowFile.getAttribute('gamma_dose') is not None:
+        return [dict((field, flowFile.getAttribute(field)) for field in CSV_FIELDS)]
+
+    callback = ReadContentCallback()
+    session.read(flowFile, callback)
+    return parse_csv(callback.text)
+
+
+def parse_timestamp(value):
+    """Validates an ISO 8601 timestamp and returns it with an explicit UTC offset."""
+    match = TIMESTAMP_PATTERN.match(value.strip())
+    if not match:
+        raise ValueError("Invalid timestamp_utc: " + value)
+    day, time_of_day, fraction, offset = match.groups()
+    offset = '+00:00' if offset in (None, 'Z') else offset.replace(':', '')
+    try:
+        # strptime rejects out-of-range fields such as month 13 or 25:00
+        datetime.strptime(day + 'T' + time_of_day, '%Y-%m-%dT%H:%M:%S')
+        datetime.strptime(offset[1:].replace(':', ''), '%H%M')
+    except ValueError:
+        raise ValueError("Invalid timestamp_utc: " + value)
+    offset = offset[:3] + ':' + offset[-2:]
+    return day + 'T' + time_of_day + (fraction or '') + offset
+
+
+def parse_date(value):
+    """Validates a YYYY-MM-DD date and returns it unchanged."""
+    try:
+        return datetime.strptime(value.strip(), '%Y-%m-%d').date().isoformat()
+    except ValueError:
+        raise ValueError("Invalid calibration_date: " + value)
+
+
+def to_record(reading):
+    """
+    Validates one reading and returns it as one row for BATCH_SQL, with a new
+    sample_id. Values Postgres would reject are raised here as ValueError, so
+    only the FlowFile holding them fails instead of the whole batch statement.
+    """
+    missing = [field for field in REQUIRED_FIELDS if not reading.get(field)]
+    if missing:
+        raise ValueError("Missing required fields: " + ", ".join(missing))
+
+    shielding_cm = reading.get('shielding_cm')
+    calibration_date = reading.get('calibration_date')
+    return {
+        'sample_id': str(uuid.uuid4()),
+        'device_id': reading['device_id'],
+        'location_code': reading['location_code'],
+        'timestamp_utc': parse_timestamp(reading['timestamp_utc']),
+        'captured_by': reading.get('captured_by') or None,
+        'value': float(reading['gamma_dose']),
+        'unit': reading['unit'],
+        'qualifier': 'OK',
+        'detector_type': reading.get('detector_type') or None,
+        'shielding_cm': float(shielding_cm) if shielding_cm else None,
+        'calibration_date': parse_date(calibration_date) if calibration_date else None,
+    }
+
+
+def batch_statement(records):
+    """
+    Returns the SQL that writes records to both tables. The JSON is
+    dollar-quoted with a random tag, so no value needs SQL escaping.
+    """
+    payload = json.dumps(records)
+    tag = '$rad_' + uuid.uuid4().hex + '$'
+    if tag in payload:
+        raise ValueError("Quote tag collides with the batch payload")
+    return BATCH_SQL.format(payload=tag + payload + tag)
+
+
+def create_output(parents, records):
+    """Creates the SQL FlowFile for one batch, derived from all parents."""
+    output = session.create(parents)
+    output = session.write(output, WriteContentCallback(batch_statement(records)))
+    output = session.putAllAttributes(output, {
+        'record.count': str(len(records)),
+        'mime.type': 'text/plain',
+        'batch.id': str(uuid.uuid4()),
+    })
+    return output
+
+
+def process_batch(flowFiles):
+    """Routes invalid FlowFiles to failure and the valid ones' readings to one SQL FlowFile."""
+    records = []
+    accepted = []
+    for flowFile in flowFiles:
+        try:
+            readings = [to_record(reading) for reading in readings_from_flowfile(flowFile)]
+        except Exception as e:
+            log.error("Rejected FlowFile {}: {}".format(flowFile.getAttribute('filename'), e))
+            flowFile = session.putAttribute(flowFile, 'rad.error', str(e))
+            session.transfer(flowFile, REL_FAILURE)
+            continue
+        records.extend(readings)
+        accepted.append(flowFile)
+
+    if records:
+        session.transfer(create_output(accepted, records), REL_SUCCESS)
+    for flowFile in accepted:
+        session.remove(flowFile)
     session.commit()
+
+
+try:
+    batch_size = int(BatchSize.getValue())
+except NameError:
+    batch_size = DEFAULT_BATCH_SIZE
+
+try:
+    flowFiles = session.get(batch_size)
+except NameError:
+    # Not running in ExecuteScript, e.g. imported by the tests
+    flowFiles = None
+if flowFiles is not None and not flowFiles.isEmpty():
+    process_batch(flowFiles)
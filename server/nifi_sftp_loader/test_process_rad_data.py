@@ -0,0 +1,132 @@
+import importlib.util
+import json
+import os
+import sys
+import types
+import pytest
+from unittest.mock import MagicMock
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process_rad_data.py')
+
+HEADER = ','.join([
+    'device_id', 'location_code', 'timestamp_utc', 'captured_by', 'detector_type',
+    'shielding_cm', 'calibration_date', 'gamma_dose', 'unit'
+])
+ROW = 'RAD-1,DDG-51,2025-03-01T12:00:00Z,HM2 Doe,TLD,2.5,2025-01-15,0.42,mrem'
+
+
+@pytest.fixture
+def script(monkeypatch):
+    """Loads the ExecuteScript body with the NiFi classes it imports replaced by plain ones."""
+    nifi_classes = {
+        'java.nio.charset': {'StandardCharsets': MagicMock()},
+        'org.apache.commons.io': {'IOUtils': MagicMock()},
+        'org.apache.nifi.processor.io': {'InputStreamCallback': object, 'OutputStreamCallback': object},
+    }
+    for name, attributes in nifi_classes.items():
+        parts = name.split('.')
+        for i in range(1, len(parts) + 1):
+            monkeypatch.setitem(sys.modules, '.'.join(parts[:i]), types.ModuleType('.'.join(parts[:i])))
+        for key, value in attributes.items():
+            setattr(sys.modules[name], key, value)
+
+    spec = importlib.util.spec_from_file_location('process_rad_data', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def flowfile(content=None, **attributes):
+    flow = MagicMock(content=content)
+    flow.getAttribute.side_effect = attributes.get
+    return flow
+
+
+@pytest.fixture
+def session(script):
+    """A NiFi session whose read() feeds a FlowFile's content to the callback."""
+    session = MagicMock()
+    session.read.side_effect = lambda flow, callback: setattr(callback, 'text', flow.content)
+    session.write.side_effect = lambda flow, callback: setattr(flow, 'written', callback.content) or flow
+    script.session, script.log = session, MagicMock()
+    script.REL_SUCCESS, script.REL_FAILURE = 'success', 'failure'
+    return session
+
+
+def test_parse_csv_skips_repeated_headers_and_blank_lines(script):
+    readings = script.parse_csv('\n'.join([HEADER, ROW, '', ' , ', ROW.replace('0.42', '0.43')]))
+
+    assert [r['gamma_dose'] for r in readings] == ['0.42', '0.43']
+    assert readings[0]['captured_by'] == 'HM2 Doe'
+
+
+def test_to_record_validates_and_converts(script):
+    record = script.to_record(script.parse_csv(ROW)[0])
+
+    assert record['value'] == 0.42 and record['shielding_cm'] == 2.5
+    assert record['qualifier'] == 'OK' and len(record['sample_id']) == 36
+
+    with pytest.raises(ValueError, match='gamma_dose, unit'):
+        script.to_record({'device_id': 'RAD-1', 'location_code': 'DDG-51', 'timestamp_utc': '2025-03-01'})
+    with pytest.raises(ValueError):
+        script.to_record(script.parse_csv(ROW.replace('0.42', 'n/a'))[0])
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2025-03-01T12:00:00Z', '2025-03-01T12:00:00+00:00'),
+    ('2025-03-01 12:00:00.250', '2025-03-01T12:00:00.250+00:00'),
+    ('2025-03-01T12:00:00-0500', '2025-03-01T12:00:00-05:00'),
+])
+def test_to_record_normalizes_timestamps(script, value, expected):
+    record = script.to_record(script.parse_csv(ROW.replace('2025-03-01T12:00:00Z', value))[0])
+
+    assert record['timestamp_utc'] == expected
+    assert record['calibration_date'] == '2025-01-15'
+
+
+@pytest.mark.parametrize('field, value', [
+    ('timestamp_utc', 'yesterday'),
+    ('timestamp_utc', '2025-13-01T12:00:00Z'),
+    ('timestamp_utc', '2025-03-01T12:00:00+25:00'),
+    ('calibration_date', '2025-02-30'),
+    ('calibration_date', '15/01/2025'),
+])
+def test_to_record_rejects_invalid_timestamps_and_dates(script, field, value):
+    reading = script.parse_csv(ROW)[0]
+    reading[field] = value
+
+    with pytest.raises(ValueError, match=field):
+        script.to_record(reading)
+
+
+def test_batch_statement_writes_both_tables_in_one_statement(script):
+    records = [script.to_record(script.parse_csv(ROW.replace('HM2 Doe', "O'Brien"))[0])]
+
+    sql = script.batch_statement(records)
+
+    tag = sql[sql.index('$rad_'):sql.index('$', sql.index('$rad_') + 1) + 1]
+    payload = sql.split(tag)[1]
+    assert json.loads(payload) == records
+    assert sql.count(tag) == 2 and sql.count(';') == 0
+    assert 'INSERT INTO exposures' in sql and 'INSERT INTO radiation_details' in sql
+
+
+def test_process_batch_emits_one_statement_and_rejects_bad_flowfiles(script, session):
+    good = flowfile('\n'.join([HEADER, ROW, ROW]), filename='rad_1.csv')
+    from_attributes = flowfile(**dict(zip(HEADER.split(','), ROW.split(','))))
+    bad = flowfile('\n'.join([HEADER, 'RAD-1,DDG-51,,,,,,0.1,mrem']), filename='rad_2.csv')
+    bad_date = flowfile('\n'.join([HEADER, ROW.replace('2025-01-15', '2025-01-32')]), filename='rad_3.csv')
+
+    script.process_batch([good, from_attributes, bad, bad_date])
+
+    transfers = [call[0] for call in session.transfer.call_args_list]
+    assert [relationship for _, relationship in transfers] == ['failure', 'failure', 'success']
+    assert session.putAttribute.call_args_list[0][0] == (bad, 'rad.error', 'Missing required fields: timestamp_utc')
+    assert session.putAttribute.call_args_list[1][0] == (bad_date, 'rad.error', 'Invalid calibration_date: 2025-01-32')
+    session.create.assert_called_once_with([good, from_attributes])
+    output = session.create.return_value
+    session.putAllAttributes.assert_called_once()
+    assert session.putAllAttributes.call_args[0][1]['record.count'] == '3'
+    assert output.written.count('INSERT INTO') == 2
+    assert [call[0][0] for call in session.remove.call_args_list] == [good, from_attributes]
+    session.commit.assert_called_once()
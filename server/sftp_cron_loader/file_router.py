@@ -0,0 +1,211 @@
+import os
+import sys
+import fnmatch
+import json
+import logging
+from io import BytesIO
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from exposure_writer import DEFAULT_ROUTES
+
+logger = logging.getLogger(__name__)
+
+# Columns written to the generic exposures table, with the dtype used when reading the CSV.
+EXPOSURE_COLUMNS = {
+    'device_id': 'string',
+    'location_code': 'string',
+    'timestamp_utc': 'string',
+    'captured_by': 'string',
+    'value': 'float64',
+    'unit': 'string',
+    'qualifier': 'string',
+}
+
+# Detail tables from migration 009 and their columns/dtypes.
+DETAIL_TABLES = {
+    'air_quality_details': {
+        'duration_sec': 'Int64',
+        'flow_rate_lpm': 'float64',
+        'filter_type': 'string',
+    },
+    'voc_details': {
+        'compound_name': 'string',
+        'media_type': 'string',
+        'humidity_pct': 'float64',
+    },
+    'noise_details': {
+        'dosimeter_interval_min': 'Int64',
+        'laeq': 'float64',
+        'peak_db': 'float64',
+    },
+    'radiation_details': {
+        'detector_type': 'string',
+        'shielding_cm': 'float64',
+        'calibration_date': 'string',
+    },
+    'water_details': {
+        'sample_type': 'string',
+        'temp_c': 'float64',
+        'residual_chlorine_mg_l': 'float64',
+    },
+    'heat_stress_details': {
+        'db_c': 'float64',
+        'wb_c': 'float64',
+        'globe_c': 'float64',
+        'flag_color': 'string',
+    },
+}
+
+
+class RoutePlan:
+    """
+    Precompiled load plan for one detail table: which source columns to read,
+    their dtypes, and how they are renamed to the target columns.
+    """
+
+    def __init__(self, detail_table, column_map=None):
+        if detail_table not in DETAIL_TABLES:
+            raise ValueError(f"Unknown detail table '{detail_table}'.")
+
+        self.detail_table = detail_table
+        self.detail_columns = list(DETAIL_TABLES[detail_table])
+        self.exposure_columns = list(EXPOSURE_COLUMNS)
+
+        # column_map is {source_column: target_column}; unmapped targets are read as-is.
+        column_map = dict(column_map or {})
+        target_to_source = {target: source for source, target in column_map.items()}
+        target_dtypes = {**EXPOSURE_COLUMNS, **DETAIL_TABLES[detail_table]}
+
+        self.dtypes = {target_to_source.get(target, target): dtype for target, dtype in target_dtypes.items()}
+        self.renames = {source: target for source, target in column_map.items() if source != target}
+        self._source_columns = frozenset(self.dtypes)
+
+    def read_csv(self, buffer, chunksize=None):
+        """
+        Reads only the planned columns with their planned dtypes. Returns a
+        DataFrame, or an iterator of DataFrames when chunksize is given.
+        """
+        reader = pd.read_csv(
+            buffer,
+            usecols=lambda column: column in self._source_columns,
+            dtype=self.dtypes,
+            chunksize=chunksize,
+        )
+        if chunksize is None:
+            return self._finalize(reader)
+        return (self._finalize(chunk) for chunk in reader)
+
+    def read_csv_chunks(self, buffer, chunksize, skip_records=0):
+        """
+        Like read_csv(buffer, chunksize), but splits the raw bytes into records
+        before parsing, so the first skip_records records are passed over without
+        being parsed. Quoted fields may contain line breaks; blank lines are ignored.
+        """
+        header = buffer.readline()
+        if not header.endswith(b'\n'):
+            header += b'\n'
+        lines, records, skipped, in_quotes = [], 0, 0, False
+        for line in buffer:
+            if not in_quotes and not line.strip():
+                continue
+            if line.count(b'"') % 2:
+                in_quotes = not in_quotes
+            if skipped < skip_records:
+                if not in_quotes:
+                    skipped += 1
+                continue
+            lines.append(line)
+            if in_quotes:
+                continue
+            records += 1
+            if records == chunksize:
+                yield self.read_csv(BytesIO(header + b''.join(lines)))
+                lines, records = [], 0
+        if records:
+            yield self.read_csv(BytesIO(header + b''.join(lines)))
+
+    def _finalize(self, df):
+        df = df.rename(columns=self.renames)
+        if 'qualifier' not in df.columns:
+            df['qualifier'] = 'OK'
+        missing = [c for c in self.exposure_columns + self.detail_columns if c not in df.columns]
+        if missing:
+            raise KeyError(f"Missing columns for {self.detail_table}: {', '.join(missing)}")
+        return df
+
+
+class FileRouter:
+    """
+    Maps remote filenames to RoutePlans. Manifest entries take precedence over
+    manifest patterns, which take precedence over the built-in filename conventions.
+    Files that match nothing fall back to default_table, or are skipped if it is unset.
+    """
+
+    def __init__(self, manifest=None, routes=DEFAULT_ROUTES, default_table=None):
+        manifest = manifest or {}
+        self._plans = {}
+        self._files = {
+            name: self._plan(entry['table'], entry.get('columns'))
+            for name, entry in manifest.get('files', {}).items()
+        }
+        self._patterns = [
+            (entry['pattern'].lower(), self._plan(entry['table'], entry.get('columns')))
+            for entry in manifest.get('patterns', [])
+        ]
+        self._patterns.extend((pattern.lower(), self._plan(table)) for pattern, table in routes)
+        self._default = self._plan(default_table) if default_table else None
+
+    def _plan(self, table, columns=None):
+        key = (table, tuple(sorted((columns or {}).items())))
+        if key not in self._plans:
+            self._plans[key] = RoutePlan(table, columns)
+        return self._plans[key]
+
+    def route(self, filename):
+        """Returns the RoutePlan for filename, or None if the file should be skipped."""
+        if filename in self._files:
+            return self._files[filename]
+        lowered = filename.lower()
+        for pattern, plan in self._patterns:
+            if fnmatch.fnmatchcase(lowered, pattern):
+                return plan
+        return self._default
+
+
+def parse_manifest(raw):
+    """
+    Parses a JSON routing manifest of the form:
+
+        {
+          "files": {"ship42_export.csv": {"table": "noise_details", "columns": {"LAeq": "laeq"}}},
+          "patterns": [{"pattern": "rad1_*.csv", "table": "radiation_details"}]
+        }
+
+    Raises ValueError if the JSON is malformed or any entry is invalid.
+    """
+    manifest = json.loads(raw)
+    if not isinstance(manifest, dict):
+        raise ValueError("Routing manifest must be a JSON object.")
+    files = manifest.get('files', {})
+    patterns = manifest.get('patterns', [])
+    if not isinstance(files, dict) or not isinstance(patterns, list):
+        raise ValueError("'files' must be an object and 'patterns' a list.")
+    for name, entry in files.items():
+        _validate_entry(entry, f"files['{name}']")
+    for index, entry in enumerate(patterns):
+        _validate_entry(entry, f"patterns[{index}]")
+        if not isinstance(entry.get('pattern'), str):
+            raise ValueError(f"patterns[{index}] has no 'pattern'.")
+    return manifest
+
+
+def _validate_entry(entry, where):
+    if not isinstance(entry, dict) or 'table' not in entry:
+        raise ValueError(f"{where} must be an object with a 'table'.")
+    if entry['table'] not in DETAIL_TABLES:
+        raise ValueError(f"{where} names unknown detail table '{entry['table']}'.")
+    columns = entry.get('columns', {})
+    if not isinstance(columns, dict) or not all(isinstance(v, str) for v in columns.values()):
+        raise ValueError(f"{where} 'columns' must map source columns to target column names.")
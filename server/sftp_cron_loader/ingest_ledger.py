@@ -0,0 +1,144 @@
+"""
+Checkpoint ledger for the SFTP loader, stored in the sftp_ingest_ledger table
+(db/migrations/020_create_sftp_ingest_ledger.sql).
+
+A file is identified by (filename, size, mtime). Chunk progress is written with
+the same cursor as the chunk's rows, so it commits or rolls back with them.
+rows_committed counts source records, so a load resumes at that record offset
+whatever LOAD_CHUNK_ROWS is set to.
+"""
+
+IN_PROGRESS = 'IN_PROGRESS'
+COMPLETE = 'COMPLETE'
+# Content changed after chunks were committed; left for an operator to clean up
+CONTENT_CHANGED = 'CONTENT_CHANGED'
+
+
+class ContentChangedError(ValueError):
+    """A partially loaded file reappeared with different content."""
+
+
+def file_key(attr):
+    """Returns the ledger key for an SFTPAttributes entry."""
+    return (attr.filename, int(attr.st_size), int(attr.st_mtime))
+
+
+def fetch_entries(cur, filenames):
+    """Returns {(filename, size, mtime): entry} for all ledger rows matching filenames."""
+    if not filenames:
+        return {}
+    cur.execute(
+        """
+        SELECT filename, file_size, file_mtime, content_sha256, status, chunks_committed, rows_committed
+        FROM sftp_ingest_ledger
+        WHERE filename = ANY(%s)
+        """,
+        (list(filenames),)
+    )
+    entries = {}
+    for filename, size, mtime, sha256, status, chunks, rows in cur.fetchall():
+        entries[(filename, size, mtime)] = {
+            'key': (filename, size, mtime),
+            'content_sha256': sha256,
+            'status': status,
+            'chunks_committed': chunks,
+            'rows_committed': rows,
+        }
+    return entries
+
+
+def find_entry(entries, attr):
+    """
+    Returns the ledger entry for a listed file: the one under its exact key,
+    else an unfinished (IN_PROGRESS or CONTENT_CHANGED) entry with the same
+    filename. A partly loaded file that is rewritten or appended to gets a new
+    size and mtime, but the rows already committed still belong to that entry.
+    """
+    key = file_key(attr)
+    if key in entries:
+        return entries[key]
+    for entry in entries.values():
+        if entry['key'][0] == attr.filename and entry['status'] in (IN_PROGRESS, CONTENT_CHANGED):
+            return entry
+    return None
+
+
+def move_entry(cur, old_key, new_key):
+    """Moves an unfinished entry to the file's current (filename, size, mtime)."""
+    cur.execute(
+        """
+        UPDATE sftp_ingest_ledger
+        SET filename = %s, file_size = %s, file_mtime = %s, updated_at = NOW()
+        WHERE filename = %s AND file_size = %s AND file_mtime = %s
+        """,
+        (*new_key, *old_key)
+    )
+
+
+def is_duplicate_content(cur, content_sha256):
+    """True if identical content was already loaded completely under another name or mtime."""
+    cur.execute(
+        "SELECT 1 FROM sftp_ingest_ledger WHERE content_sha256 = %s AND status = %s LIMIT 1",
+        (content_sha256, COMPLETE)
+    )
+    return cur.fetchone() is not None
+
+
+def begin(cur, key, content_sha256, detail_table):
+    """
+    Records the start of a load. An existing entry is reset; callers only do
+    that when it has no committed chunks (see flag_content_changed).
+    """
+    cur.execute(
+        """
+        INSERT INTO sftp_ingest_ledger (filename, file_size, file_mtime, content_sha256, detail_table)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (filename, file_size, file_mtime) DO UPDATE
+        SET content_sha256 = EXCLUDED.content_sha256,
+            detail_table = EXCLUDED.detail_table,
+            chunks_committed = 0,
+            rows_committed = 0,
+            status = 'IN_PROGRESS',
+            updated_at = NOW()
+        """,
+        (*key, content_sha256, detail_table)
+    )
+
+
+def record_chunk(cur, key, chunks_committed, rows):
+    """
+    Advances the checkpoint by rows source records. Must run in the same
+    transaction as the chunk's inserts.
+    """
+    cur.execute(
+        """
+        UPDATE sftp_ingest_ledger
+        SET chunks_committed = %s, rows_committed = rows_committed + %s, updated_at = NOW()
+        WHERE filename = %s AND file_size = %s AND file_mtime = %s
+        """,
+        (chunks_committed, rows, *key)
+    )
+
+
+def mark_complete(cur, key):
+    """Marks a file as fully loaded."""
+    cur.execute(
+        """
+        UPDATE sftp_ingest_ledger
+        SET status = 'COMPLETE', updated_at = NOW()
+        WHERE filename = %s AND file_size = %s AND file_mtime = %s
+        """,
+        key
+    )
+
+
+def flag_content_changed(cur, key):
+    """Marks an interrupted load whose file content changed, so it is not resumed or restarted."""
+    cur.execute(
+        """
+        UPDATE sftp_ingest_ledger
+        SET status = 'CONTENT_CHANGED', updated_at = NOW()
+        WHERE filename = %s AND file_size = %s AND file_mtime = %s
+        """,
+        key
+    )
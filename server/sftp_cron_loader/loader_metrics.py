@@ -0,0 +1,53 @@
+import time
+import threading
+from collections import deque
+
+
+class LoaderMetrics:
+    """Thread-safe rolling throughput counters for the SFTP loader daemon."""
+
+    def __init__(self, window_seconds=300):
+        self.window_seconds = window_seconds
+        self._polls = deque()  # (timestamp, files, rows, busy_seconds)
+        self._lock = threading.Lock()
+        self.total_files = 0
+        self.total_rows = 0
+        self.total_polls = 0
+        self.total_errors = 0
+        self.started_at = time.time()
+
+    def record_poll(self, files, rows, busy_seconds):
+        now = time.time()
+        with self._lock:
+            self._polls.append((now, files, rows, busy_seconds))
+            self.total_files += files
+            self.total_rows += rows
+            self.total_polls += 1
+            self._trim(now)
+
+    def record_error(self):
+        with self._lock:
+            self.total_errors += 1
+
+    def _trim(self, now):
+        while self._polls and now - self._polls[0][0] > self.window_seconds:
+            self._polls.popleft()
+
+    def snapshot(self):
+        """Returns the current metrics as a dict."""
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            files = sum(p[1] for p in self._polls)
+            rows = sum(p[2] for p in self._polls)
+            busy = sum(p[3] for p in self._polls)
+            window = min(self.window_seconds, now - self.started_at) or 1.0
+            return {
+                'window_seconds': self.window_seconds,
+                'files_per_minute': round(files * 60.0 / window, 3),
+                'rows_per_second': round(rows / busy, 1) if busy else 0.0,
+                'total_files': self.total_files,
+                'total_rows': self.total_rows,
+                'total_polls': self.total_polls,
+                'total_errors': self.total_errors,
+            }
@@ -1,11 +1,26 @@
 import os
+import sys
+import time
+import random
 import logging
+import argparse
+import threading
 import pysftp
 import pandas as pd
 import psycopg2
 from dotenv import load_dotenv
-from io import StringIO
-import uuid
+from io import BytesIO
+import hashlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+from db_pool import ConnectionManager, connect
+from exposure_writer import ExposureWriter, COPY_THRESHOLD_ROWS
+from metrics_http import start_metrics_server
+from tracing import tracer_from_env
+
+import ingest_ledger
+from file_router import FileRouter, parse_manifest
+from loader_metrics import LoaderMetrics
 
 # --- Load Configuration ---
 load_dotenv()
@@ -18,6 +33,24 @@ SFTP_PASSWORD = os.getenv("SFTP_PASSWORD")
 SFTP_REMOTE_DIR = os.getenv("SFTP_REMOTE_DIR")
 PROCESSED_DIR = os.getenv("PROCESSED_DIR")
 
+# Routing Config
+ROUTING_MANIFEST = os.getenv("ROUTING_MANIFEST", "manifest.json")
+DEFAULT_DETAIL_TABLE = os.getenv("DEFAULT_DETAIL_TABLE", "water_details")
+
+# Rows per committed chunk; a crashed load resumes after the last committed chunk
+LOAD_CHUNK_ROWS = int(os.getenv("LOAD_CHUNK_ROWS", "50000"))
+# Chunks with fewer rows are written with a multi-row INSERT instead of COPY
+COPY_THRESHOLD = int(os.getenv("COPY_THRESHOLD_ROWS", str(COPY_THRESHOLD_ROWS)))
+
+# Daemon Config
+DAEMON_MODE = os.getenv("DAEMON_MODE", "false").lower() == "true"
+POLL_INTERVAL_SECONDS = float(os.getenv("POLL_INTERVAL_SECONDS", "10"))
+POLL_JITTER_SECONDS = float(os.getenv("POLL_JITTER_SECONDS", "2"))
+RECONNECT_BACKOFF_INITIAL_SECONDS = float(os.getenv("RECONNECT_BACKOFF_INITIAL_SECONDS", "1"))
+RECONNECT_BACKOFF_MAX_SECONDS = float(os.getenv("RECONNECT_BACKOFF_MAX_SECONDS", "300"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
@@ -31,112 +64,280 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+DB_SETTINGS = dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+
+writer = ExposureWriter(copy_threshold=COPY_THRESHOLD)
+
+# --- Tracing (TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH); one trace per file ---
+tracer = tracer_from_env('sftp_loader')
+
 def get_db_connection():
     """Establishes and returns a connection to the PostgreSQL database."""
+    return connect(DB_SETTINGS)
+
+
+def load_dataframe(cur, plan, df):
+    """Inserts a routed DataFrame into exposures and the plan's detail table."""
+    return writer.write_frame(cur, plan.detail_table, df, plan.exposure_columns, plan.detail_columns)
+
+
+def load_router(sftp, filenames):
+    """Builds the file router, reading the routing manifest from the remote directory if present."""
+    manifest = None
+    if ROUTING_MANIFEST and ROUTING_MANIFEST in filenames:
+        manifest_buffer = BytesIO()
+        sftp.getfo(f"{SFTP_REMOTE_DIR}/{ROUTING_MANIFEST}", manifest_buffer)
+        try:
+            manifest = parse_manifest(manifest_buffer.getvalue().decode('utf-8'))
+            logger.info(f"Loaded routing manifest {ROUTING_MANIFEST}.")
+        except ValueError as e:
+            logger.error(f"Ignoring invalid routing manifest {ROUTING_MANIFEST}: {e}")
+    return FileRouter(manifest=manifest, default_table=DEFAULT_DETAIL_TABLE or None)
+
+
+def remove_remote_file(sftp, remote_path):
+    """Removes a processed file. Failures are logged; the ledger prevents reprocessing."""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
-        )
-        logger.info("Successfully connected to the database.")
-        return conn
-    except psycopg2.OperationalError as e:
-        logger.error(f"Could not connect to the database: {e}")
-        return None
+        sftp.remove(remote_path)
+        logger.info(f"Removed processed file: {os.path.basename(remote_path)}")
+    except (IOError, OSError) as e:
+        logger.warning(f"Could not remove {remote_path}: {e}. It will be skipped via the ledger.")
+
 
-def process_files_from_sftp():
+def process_file(sftp, db_conn, plan, attr, entry):
     """
-    Connects to an SFTP server, processes all CSV files in a directory,
-    and inserts the data into the database.
+    Downloads one file and loads it chunk by chunk, committing each chunk together
+    with its ledger checkpoint. Resumes after the last committed record of an
+    interrupted load; the whole file is still downloaded to verify its checksum.
+    Raises ContentChangedError if an interrupted load's file changed. Returns the
+    number of rows inserted by this call.
     """
+    key = ingest_ledger.file_key(attr)
+    remote_path = f"{SFTP_REMOTE_DIR}/{attr.filename}"
+
+    # Download file to an in-memory buffer
+    file_buffer = BytesIO()
+    sftp.getfo(remote_path, file_buffer)
+    content_sha256 = hashlib.sha256(file_buffer.getbuffer()).hexdigest()
+    file_buffer.seek(0) # Rewind buffer to the beginning
+
+    if entry and entry['rows_committed'] and entry['content_sha256'] != content_sha256:
+        # The committed rows came from the old content; loading the new content would duplicate them.
+        with db_conn.cursor() as cur:
+            ingest_ledger.flag_content_changed(cur, entry['key'])
+        db_conn.commit()
+        raise ingest_ledger.ContentChangedError(
+            f"{attr.filename} changed after {entry['rows_committed']} of its rows were loaded. "
+            "Remove those rows and its sftp_ingest_ledger entry to load it again."
+        )
+    if entry and entry['key'] != key:
+        # Found by filename: the file was touched or rewritten since the entry was made.
+        with db_conn.cursor() as cur:
+            ingest_ledger.move_entry(cur, entry['key'], key)
+        db_conn.commit()
+
+    resume_from = 0
+    chunks_done = 0
+    if entry and entry['content_sha256'] == content_sha256:
+        resume_from = entry['rows_committed']
+        chunks_done = entry['chunks_committed']
+        logger.info(f"Resuming {attr.filename} after {resume_from} committed rows ({chunks_done} chunks).")
+    else:
+        with db_conn.cursor() as cur:
+            if ingest_ledger.is_duplicate_content(cur, content_sha256):
+                logger.warning(f"{attr.filename} has the same content as an already loaded file. Skipping insert.")
+                ingest_ledger.begin(cur, key, content_sha256, plan.detail_table)
+                ingest_ledger.mark_complete(cur, key)
+                db_conn.commit()
+                return 0
+            ingest_ledger.begin(cur, key, content_sha256, plan.detail_table)
+        db_conn.commit()
+
+    inserted = 0
+    # Committed records are split off the raw bytes without being parsed
+    chunks = plan.read_csv_chunks(file_buffer, LOAD_CHUNK_ROWS, skip_records=resume_from)
+    for index, df in enumerate(chunks, start=chunks_done):
+        with db_conn.cursor() as cur:
+            inserted += load_dataframe(cur, plan, df)
+            ingest_ledger.record_chunk(cur, key, index + 1, len(df))
+        db_conn.commit()
+
+    with db_conn.cursor() as cur:
+        ingest_ledger.mark_complete(cur, key)
+    db_conn.commit()
+    return inserted
+
+
+def open_sftp():
+    """Opens an authenticated SFTP session."""
     cnopts = pysftp.CnOpts()
     cnopts.hostkeys = None  # Disable host key checking for simplicity; use known_hosts in production
+    sftp = pysftp.Connection(
+        host=SFTP_HOST, username=SFTP_USER, password=SFTP_PASSWORD, port=SFTP_PORT, cnopts=cnopts
+    )
+    logger.info(f"Successfully connected to SFTP server at {SFTP_HOST}.")
+    return sftp
+
+
+def process_pending_files(sftp, db_conn):
+    """
+    Routes every CSV file in the remote directory to its detail table and
+    bulk-loads the data. Files already recorded as complete in the ingest
+    ledger are skipped without downloading. Returns (files_loaded, rows_loaded).
+    SFTP errors while listing the directory are raised to the caller.
+    """
+    attrs = sftp.listdir_attr(SFTP_REMOTE_DIR)
+    csv_attrs = [a for a in attrs if a.filename.lower().endswith('.csv')]
 
-    db_conn = get_db_connection()
+    if not csv_attrs:
+        logger.debug("No new CSV files found to process.")
+        return 0, 0
+
+    logger.info(f"Found {len(csv_attrs)} CSV files to process.")
+    router = load_router(sftp, [a.filename for a in attrs])
+
+    with db_conn.cursor() as cur:
+        ledger = ingest_ledger.fetch_entries(cur, [a.filename for a in csv_attrs])
+    db_conn.commit()
+
+    files_loaded = 0
+    rows_loaded = 0
+    for attr in csv_attrs:
+        filename = attr.filename
+        remote_path = f"{SFTP_REMOTE_DIR}/{filename}"
+        entry = ingest_ledger.find_entry(ledger, attr)
+
+        if entry and entry['status'] == ingest_ledger.COMPLETE:
+            logger.info(f"{filename} is already loaded according to the ledger. Skipping download.")
+            remove_remote_file(sftp, remote_path)
+            continue
+        if entry and entry['status'] == ingest_ledger.CONTENT_CHANGED:
+            logger.warning(f"{filename} changed during an earlier partial load and needs manual cleanup. Skipping.")
+            continue
+
+        plan = router.route(filename)
+        if plan is None:
+            logger.warning(f"No route matches {filename}. Leaving it on the server.")
+            continue
+
+        logger.info(f"Processing file: {filename} -> {plan.detail_table}")
+
+        try:
+            with tracer.start_span('load_file', attributes={'file': filename, 'table': plan.detail_table}) as span:
+                inserted = process_file(sftp, db_conn, plan, attr, entry)
+                span.set_attribute('rows', inserted)
+            logger.info(f"Successfully inserted {inserted} records from {filename} into {plan.detail_table}.")
+            files_loaded += 1
+            rows_loaded += inserted
+
+            # Remove the file from SFTP server after successful processing
+            remove_remote_file(sftp, remote_path)
+
+        except (pd.errors.ParserError, KeyError, ValueError) as e:
+            logger.error(f"Failed to parse or process {filename}. Error: {e}. Skipping file.")
+            db_conn.rollback()
+        except psycopg2.InterfaceError:
+            raise
+        except Exception as e:
+            logger.error(f"An unexpected error occurred while processing {filename}: {e}")
+            if not db_conn.closed:
+                db_conn.rollback()
+
+    return files_loaded, rows_loaded
+
+
+def process_files_from_sftp(conn=None):
+    """
+    Single cron-style run: connects to the SFTP server and the database,
+    processes every pending CSV file, and disconnects. A caller-supplied conn
+    (e.g. from the job scheduler's pool) is used as is and left open.
+    """
+    db_conn = conn or get_db_connection()
     if not db_conn:
         return
 
     try:
-        with pysftp.Connection(
-            host=SFTP_HOST, username=SFTP_USER, password=SFTP_PASSWORD, port=SFTP_PORT, cnopts=cnopts
-        ) as sftp:
-            logger.info(f"Successfully connected to SFTP server at {SFTP_HOST}.")
-            
-            files = sftp.listdir(SFTP_REMOTE_DIR)
-            csv_files = [f for f in files if f.lower().endswith('.csv')]
-            
-            if not csv_files:
-                logger.info("No new CSV files found to process.")
-                return
-
-            logger.info(f"Found {len(csv_files)} CSV files to process.")
-
-            for filename in csv_files:
-                remote_path = f"{SFTP_REMOTE_DIR}/{filename}"
-                logger.info(f"Processing file: {filename}")
-                
-                # Download file to an in-memory buffer
-                file_buffer = StringIO()
-                sftp.getfo(remote_path, file_buffer)
-                file_buffer.seek(0) # Rewind buffer to the beginning
-
-                try:
-                    df = pd.read_csv(file_buffer)
-                    
-                    # This is a generic loader. We'd need a way to determine which
-                    # detail table to insert into. For this example, we'll assume
-                    # the CSV is for 'Potable Water' and has the required columns.
-                    # A real implementation might use filename conventions or a manifest file.
-                    
-                    with db_conn.cursor() as cur:
-                        for index, row in df.iterrows():
-                            sample_id = str(uuid.uuid4())
-                            
-                            # Insert into generic exposures table
-                            cur.execute(
-                                """
-                                INSERT INTO exposures (sample_id, device_id, location_code, timestamp_utc, captured_by, value, unit, qualifier)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                                """,
-                                (
-                                    sample_id, row['device_id'], row['location_code'], row['timestamp_utc'],
-                                    row['captured_by'], row['value'], row['unit'], row['qualifier']
-                                )
-                            )
-                            
-                            # Insert into water-specific details table
-                            cur.execute(
-                                """
-                                INSERT INTO water_details (sample_id, sample_type, temp_c, residual_chlorine_mg_l)
-                                VALUES (%s, %s, %s, %s)
-                                """,
-                                (
-                                    sample_id, row['sample_type'], row['temp_c'], row['residual_chlorine_mg_l']
-                                )
-                            )
-                    
-                    db_conn.commit()
-                    logger.info(f"Successfully inserted {len(df)} records from {filename}.")
-                    
-                    # Remove the file from SFTP server after successful processing
-                    sftp.remove(remote_path)
-                    logger.info(f"Removed processed file: {filename}")
-
-                except (pd.errors.ParserError, KeyError) as e:
-                    logger.error(f"Failed to parse or process {filename}. Error: {e}. Skipping file.")
-                    db_conn.rollback()
-                except Exception as e:
-                    logger.error(f"An unexpected error occurred while processing {filename}: {e}")
-                    db_conn.rollback()
-
+        with open_sftp() as sftp:
+            process_pending_files(sftp, db_conn)
     except Exception as e:
         logger.critical(f"Failed to connect or interact with SFTP server: {e}")
     finally:
-        if db_conn:
+        if db_conn and conn is None:
             db_conn.close()
             logger.info("Database connection closed.")
 
 
+def run_daemon(stop_event=None):
+    """
+    Long-running mode: keeps one SFTP session and a small connection pool open
+    and polls the remote directory every POLL_INTERVAL_SECONDS (plus jitter).
+    Broken SFTP sessions or database connections are re-established with
+    exponential backoff.
+    """
+    stop_event = stop_event or threading.Event()
+    metrics = LoaderMetrics()
+    if METRICS_PORT:
+        start_metrics_server(metrics, METRICS_PORT, 'loader')
+
+    db_pool = ConnectionManager(DB_SETTINGS, max_connections=DB_POOL_SIZE)
+    sftp = None
+    backoff = RECONNECT_BACKOFF_INITIAL_SECONDS
+
+    try:
+        while not stop_event.is_set():
+            db_conn = None
+            try:
+                if sftp is None:
+                    sftp = open_sftp()
+
+                db_conn = db_pool.getconn()
+                if db_conn is None:
+                    raise psycopg2.OperationalError("Database connection unavailable.")
+                started = time.monotonic()
+                files_loaded, rows_loaded = process_pending_files(sftp, db_conn)
+                metrics.record_poll(files_loaded, rows_loaded, time.monotonic() - started)
+                if files_loaded:
+                    logger.info(f"Loader metrics: {metrics.snapshot()} Writes: {writer.metrics.snapshot()}")
+                backoff = RECONNECT_BACKOFF_INITIAL_SECONDS
+
+            except Exception as e:
+                metrics.record_error()
+                logger.error(f"Poll failed: {e}. Reconnecting in {backoff:.1f}s.")
+                if sftp is not None:
+                    try:
+                        sftp.close()
+                    except Exception:
+                        pass
+                    sftp = None
+                if isinstance(e, psycopg2.OperationalError) and db_conn is None:
+                    db_pool.close()
+                stop_event.wait(backoff)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX_SECONDS)
+                continue
+            finally:
+                db_pool.putconn(db_conn)
+
+            stop_event.wait(POLL_INTERVAL_SECONDS + random.uniform(0, POLL_JITTER_SECONDS))
+    finally:
+        if sftp is not None:
+            sftp.close()
+        db_pool.close()
+        logger.info("SFTP loader daemon stopped.")
+
+
 if __name__ == "__main__":
-    logger.info("Starting SFTP cron loader script...")
-    process_files_from_sftp()
-    logger.info("SFTP cron loader script finished.")
+    arg_parser = argparse.ArgumentParser(description="Load exposure CSV files from SFTP into the database.")
+    arg_parser.add_argument('--daemon', action='store_true', default=DAEMON_MODE,
+                            help="Keep running and poll the SFTP directory instead of exiting after one pass.")
+    args = arg_parser.parse_args()
+
+    if args.daemon:
+        logger.info("Starting SFTP loader in daemon mode...")
+        try:
+            run_daemon()
+        except KeyboardInterrupt:
+            logger.info("SFTP loader daemon stopped by user.")
+    else:
+        logger.info("Starting SFTP cron loader script...")
+        process_files_from_sftp()
+        logger.info("SFTP cron loader script finished.")
@@ -0,0 +1,74 @@
+import os
+import sys
+from io import BytesIO
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from file_router import DETAIL_TABLES, FileRouter, RoutePlan, parse_manifest
+
+MANIFEST = """{
+  "files": {"noise_special.csv": {"table": "heat_stress_details"}},
+  "patterns": [{"pattern": "NOISE_SHIP*.csv", "table": "water_details"}]
+}"""
+
+
+def test_route_prefers_manifest_files_then_patterns_then_conventions_then_default():
+    router = FileRouter(manifest=parse_manifest(MANIFEST), default_table='voc_details')
+
+    assert router.route('noise_special.csv').detail_table == 'heat_stress_details'
+    assert router.route('noise_ship42.csv').detail_table == 'water_details'
+    assert router.route('noise_other.csv').detail_table == 'noise_details'
+    assert router.route('unknown.csv').detail_table == 'voc_details'
+    assert FileRouter().route('unknown.csv') is None
+
+
+def test_routes_share_one_plan_per_table_and_columns():
+    router = FileRouter()
+
+    assert router.route('noise_a.csv') is router.route('noise_b.csv')
+
+
+def test_unknown_detail_tables_are_rejected():
+    with pytest.raises(ValueError, match="Unknown detail table 'lead_details'"):
+        RoutePlan('lead_details')
+    with pytest.raises(ValueError, match="unknown detail table 'lead_details'"):
+        parse_manifest('{"files": {"a.csv": {"table": "lead_details"}}}')
+
+
+@pytest.mark.parametrize('raw', [
+    '[]',
+    '{"files": {"a.csv": {"columns": {}}}}',
+    '{"patterns": [{"table": "noise_details"}]}',
+    '{"patterns": [{"pattern": "a*.csv", "table": "noise_details", "columns": ["laeq"]}]}',
+    'not json',
+])
+def test_parse_manifest_rejects_invalid_entries(raw):
+    with pytest.raises(ValueError):
+        parse_manifest(raw)
+
+
+def test_column_map_renames_source_columns_and_defaults_the_qualifier():
+    plan = RoutePlan('noise_details', {'LAeq': 'laeq', 'Device': 'device_id'})
+    csv = (b'Device,location_code,timestamp_utc,captured_by,value,unit,dosimeter_interval_min,LAeq,peak_db,extra\n'
+           b'dev-1,SHIP-1,2025-03-01T12:00:00Z,tester,85.5,dBA,15,85.5,101\n')
+
+    df = plan.read_csv(BytesIO(csv))
+
+    assert list(df['device_id']) == ['dev-1'] and list(df['laeq']) == [85.5]
+    assert list(df['qualifier']) == ['OK']
+    assert 'extra' not in df.columns and str(df['dosimeter_interval_min'].dtype) == 'Int64'
+
+
+def test_missing_columns_are_reported():
+    plan = RoutePlan('noise_details')
+
+    with pytest.raises(KeyError, match='laeq'):
+        plan.read_csv(BytesIO(b'device_id,location_code,timestamp_utc,captured_by,value,unit\n'))
+
+
+def test_detail_tables_match_the_shared_writer_columns():
+    from exposure_writer import DETAIL_COLUMNS
+
+    assert {table: list(columns) for table, columns in DETAIL_TABLES.items()} == DETAIL_COLUMNS
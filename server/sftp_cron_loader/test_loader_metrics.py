@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import loader_metrics
+from loader_metrics import LoaderMetrics
+
+
+@pytest.fixture
+def clock(mocker):
+    """Wall clock for LoaderMetrics, starting at 1000 and moved by setting clock.now."""
+    clock = mocker.MagicMock(now=1000.0)
+    mocker.patch.object(loader_metrics.time, 'time', side_effect=lambda: clock.now)
+    return clock
+
+
+def test_snapshot_reports_throughput_since_start(clock):
+    metrics = LoaderMetrics(window_seconds=300)
+    clock.now = 1030.0
+    metrics.record_poll(2, 100, 0.5)
+    clock.now = 1060.0
+    metrics.record_poll(1, 50, 0.5)
+    metrics.record_poll(0, 0, 0.0)
+    metrics.record_error()
+
+    assert metrics.snapshot() == {
+        'window_seconds': 300,
+        'files_per_minute': 3.0,
+        'rows_per_second': 150.0,
+        'total_files': 3,
+        'total_rows': 150,
+        'total_polls': 3,
+        'total_errors': 1,
+    }
+
+
+def test_polls_older_than_the_window_only_count_towards_totals(clock):
+    metrics = LoaderMetrics(window_seconds=300)
+    clock.now = 1030.0
+    metrics.record_poll(2, 100, 0.5)
+    clock.now = 1060.0
+    metrics.record_poll(1, 50, 0.5)
+
+    clock.now = 1340.0
+    snapshot = metrics.snapshot()
+
+    assert snapshot['files_per_minute'] == 0.2
+    assert snapshot['rows_per_second'] == 100.0
+    assert (snapshot['total_files'], snapshot['total_rows'], snapshot['total_polls']) == (3, 150, 2)
+
+    clock.now = 2000.0
+    assert metrics.snapshot()['rows_per_second'] == 0.0
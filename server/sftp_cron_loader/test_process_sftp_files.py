@@ -0,0 +1,245 @@
+import hashlib
+import os
+import sys
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import ingest_ledger
+import process_sftp_files
+from file_router import FileRouter
+
+HEADER = 'device_id,location_code,timestamp_utc,captured_by,value,unit,dosimeter_interval_min,laeq,peak_db\n'
+CONTENT = (HEADER + ''.join(
+    f'dev-{i},SHIP-1,2025-03-01T12:0{i}:00Z,tester,{80 + i},dBA,15,{80 + i},{100 + i}\n' for i in range(5)
+)).encode()
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture
+def plan():
+    return FileRouter().route('noise_ship.csv')
+
+
+@pytest.fixture
+def sftp():
+    sftp = MagicMock()
+    sftp.getfo.side_effect = lambda path, buffer: buffer.write(CONTENT)
+    return sftp
+
+
+@pytest.fixture
+def db(mocker):
+    """A connection whose cursor records the ledger statements; loads return the chunk's row count."""
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.fetchone.return_value = None
+    mocker.patch.object(process_sftp_files, 'LOAD_CHUNK_ROWS', 2)
+    loads = mocker.patch('process_sftp_files.load_dataframe', side_effect=lambda cur, plan, df: len(df))
+    return conn, cur, loads
+
+
+def attr(filename='noise_ship.csv'):
+    return SimpleNamespace(filename=filename, st_size=len(CONTENT), st_mtime=1740830400)
+
+
+def statements(cur):
+    return [' '.join(call[0][0].split()) for call in cur.execute.call_args_list]
+
+
+def test_read_csv_chunks_counts_records_not_lines(plan):
+    content = (HEADER + 'dev-0,SHIP-1,2025-03-01,"two\nlines",80,dBA,15,80,100\n\n'
+               + 'dev-1,SHIP-1,2025-03-01,x,81,dBA,15,81,101\n' + 'dev-2,SHIP-1,2025-03-01,y,82,dBA,15,82,102').encode()
+
+    chunks = list(plan.read_csv_chunks(process_sftp_files.BytesIO(content), 2))
+
+    assert [list(df['device_id']) for df in chunks] == [['dev-0', 'dev-1'], ['dev-2']]
+    assert chunks[0]['captured_by'][0] == 'two\nlines'
+    skipped = list(plan.read_csv_chunks(process_sftp_files.BytesIO(content), 2, skip_records=1))
+    assert [list(df['device_id']) for df in skipped] == [['dev-1', 'dev-2']]
+
+
+def ledger_entry(sha256=SHA256, chunks=1, rows=2, key=None, status=ingest_ledger.IN_PROGRESS):
+    return {'key': key or ingest_ledger.file_key(attr()), 'content_sha256': sha256, 'status': status,
+            'chunks_committed': chunks, 'rows_committed': rows}
+
+
+def test_process_file_resumes_after_committed_chunks_without_parsing_them(sftp, db, plan, mocker):
+    conn, cur, loads = db
+    parse = mocker.spy(plan, 'read_csv')
+    entry = ledger_entry()
+
+    inserted = process_sftp_files.process_file(sftp, conn, plan, attr(), entry)
+
+    assert inserted == 3
+    assert [list(call[0][2]['device_id']) for call in loads.call_args_list] == [['dev-2', 'dev-3'], ['dev-4']]
+    assert parse.call_count == 2
+    checkpoints = [call[0][1][:2] for call in cur.execute.call_args_list if 'chunks_committed =' in call[0][0]]
+    assert checkpoints == [(2, 2), (3, 1)]
+    assert not any('INSERT INTO sftp_ingest_ledger' in sql for sql in statements(cur))
+    assert "SET status = 'COMPLETE'" in statements(cur)[-1]
+
+
+def test_process_file_skips_content_already_loaded_under_another_name(sftp, db, plan):
+    conn, cur, loads = db
+    cur.fetchone.return_value = (1,)
+
+    assert process_sftp_files.process_file(sftp, conn, plan, attr('noise_copy.csv'), None) == 0
+
+    loads.assert_not_called()
+    executed = statements(cur)
+    assert executed[0].startswith('SELECT 1 FROM sftp_ingest_ledger WHERE content_sha256')
+    assert executed[1].startswith('INSERT INTO sftp_ingest_ledger') and "SET status = 'COMPLETE'" in executed[2]
+
+
+def test_process_file_resumes_at_the_committed_record_when_the_chunk_size_changed(sftp, db, plan, mocker):
+    conn, cur, loads = db
+    # Three rows were committed in one chunk before LOAD_CHUNK_ROWS was lowered to 2.
+    entry = ledger_entry(chunks=1, rows=3)
+
+    assert process_sftp_files.process_file(sftp, conn, plan, attr(), entry) == 2
+
+    assert [list(call[0][2]['device_id']) for call in loads.call_args_list] == [['dev-3', 'dev-4']]
+
+
+def test_process_file_refuses_to_restart_a_partial_load_whose_content_changed(sftp, db, plan):
+    conn, cur, loads = db
+    entry = ledger_entry(sha256='0' * 64)
+
+    with pytest.raises(ingest_ledger.ContentChangedError, match='2 of its rows'):
+        process_sftp_files.process_file(sftp, conn, plan, attr(), entry)
+
+    loads.assert_not_called()
+    assert statements(cur) == [
+        "UPDATE sftp_ingest_ledger SET status = 'CONTENT_CHANGED', updated_at = NOW() "
+        "WHERE filename = %s AND file_size = %s AND file_mtime = %s"
+    ]
+    conn.commit.assert_called_once()
+
+
+def test_a_partly_loaded_file_that_grew_is_found_by_filename_and_flagged(sftp, db):
+    conn, cur, loads = db
+    sftp.listdir_attr.return_value = [attr()]
+    old_key = ('noise_ship.csv', len(CONTENT) - 40, 1740820000)  # before the file was appended to
+    cur.fetchall.return_value = [
+        ('noise_ship.csv', 100, 1730000000, 'f' * 64, ingest_ledger.COMPLETE, 1, 5),  # an older file of that name
+        (*old_key, '0' * 64, ingest_ledger.IN_PROGRESS, 1, 2),
+    ]
+
+    assert process_sftp_files.process_pending_files(sftp, conn) == (0, 0)
+
+    loads.assert_not_called()
+    sftp.remove.assert_not_called()
+    flagged = [call[0][1] for call in cur.execute.call_args_list if "'CONTENT_CHANGED'" in call[0][0]]
+    assert flagged == [old_key]
+
+
+def test_process_file_moves_an_entry_found_by_filename_to_the_current_key(sftp, db, plan):
+    conn, cur, loads = db
+    old_key = ('noise_ship.csv', len(CONTENT), 1740820000)  # the file was only touched
+    entry = ledger_entry(key=old_key)
+
+    assert process_sftp_files.process_file(sftp, conn, plan, attr(), entry) == 3
+
+    moved = [call[0][1] for call in cur.execute.call_args_list if 'SET filename = %s' in call[0][0]]
+    assert moved == [(*ingest_ledger.file_key(attr()), *old_key)]
+    checkpoint_keys = [call[0][1][2:] for call in cur.execute.call_args_list if 'chunks_committed =' in call[0][0]]
+    assert set(checkpoint_keys) == {ingest_ledger.file_key(attr())}
+
+
+def test_process_pending_files_leaves_flagged_files_alone(sftp, db):
+    conn, cur, loads = db
+    sftp.listdir_attr.return_value = [attr()]
+    key = ingest_ledger.file_key(attr())
+    cur.fetchall.return_value = [(*key, '0' * 64, ingest_ledger.CONTENT_CHANGED, 1, 2)]
+
+    assert process_sftp_files.process_pending_files(sftp, conn) == (0, 0)
+
+    sftp.getfo.assert_not_called()
+    sftp.remove.assert_not_called()
+
+
+def test_load_router_falls_back_to_conventions_for_an_invalid_manifest(sftp, mocker):
+    mocker.patch.object(process_sftp_files, 'ROUTING_MANIFEST', 'manifest.json')
+    sftp.getfo.side_effect = lambda path, buffer: buffer.write(b'{"files": {"noise_a.csv": {"columns": {}}}}')
+
+    router = process_sftp_files.load_router(sftp, ['manifest.json', 'noise_a.csv'])
+
+    assert router.route('noise_a.csv').detail_table == 'noise_details'
+
+
+class StopAfter:
+    """A stop_event that records every wait and is set after the given number of waits."""
+
+    def __init__(self, waits):
+        self.remaining = waits
+        self.waits = []
+
+    def is_set(self):
+        return self.remaining <= 0
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.remaining -= 1
+        return self.is_set()
+
+
+@pytest.fixture
+def daemon(mocker):
+    """run_daemon with a stubbed SFTP session and pool, fixed jitter and a 1s-3s reconnect backoff."""
+    mocker.patch.object(process_sftp_files, 'METRICS_PORT', 0)
+    mocker.patch.object(process_sftp_files, 'POLL_INTERVAL_SECONDS', 10)
+    mocker.patch.object(process_sftp_files, 'POLL_JITTER_SECONDS', 2)
+    mocker.patch.object(process_sftp_files, 'RECONNECT_BACKOFF_INITIAL_SECONDS', 1)
+    mocker.patch.object(process_sftp_files, 'RECONNECT_BACKOFF_MAX_SECONDS', 3)
+    jitter = mocker.patch.object(process_sftp_files.random, 'uniform', return_value=0.5)
+    pool = mocker.patch.object(process_sftp_files, 'ConnectionManager').return_value
+    open_sftp = mocker.patch.object(process_sftp_files, 'open_sftp')
+    poll = mocker.patch.object(process_sftp_files, 'process_pending_files', return_value=(0, 0))
+    metrics = mocker.patch.object(process_sftp_files, 'LoaderMetrics').return_value
+    return SimpleNamespace(pool=pool, open_sftp=open_sftp, poll=poll, jitter=jitter, metrics=metrics)
+
+
+def test_run_daemon_polls_on_the_interval_plus_jitter_with_one_session(daemon):
+    stop_event = StopAfter(3)
+
+    process_sftp_files.run_daemon(stop_event)
+
+    assert stop_event.waits == [10.5, 10.5, 10.5]
+    daemon.jitter.assert_called_with(0, 2)
+    daemon.open_sftp.assert_called_once()
+    assert daemon.poll.call_count == 3
+    assert daemon.metrics.record_poll.call_count == 3
+    assert daemon.pool.putconn.call_count == 3
+    daemon.open_sftp.return_value.close.assert_called_once()
+    daemon.pool.close.assert_called_once()
+
+
+def test_run_daemon_backs_off_exponentially_and_resets_after_a_good_poll(daemon):
+    daemon.open_sftp.side_effect = [OSError('refused')] * 3 + [MagicMock(), MagicMock()]
+    daemon.poll.side_effect = [(1, 10), OSError('connection reset'), (0, 0)]
+    stop_event = StopAfter(6)
+
+    process_sftp_files.run_daemon(stop_event)
+
+    # Three failed connects (1s, 2s, capped at 3s), a good poll, a failed poll back at 1s, a good poll.
+    assert stop_event.waits == [1, 2, 3, 10.5, 1, 10.5]
+    assert daemon.open_sftp.call_count == 5
+    assert daemon.metrics.record_error.call_count == 4
+    daemon.metrics.record_poll.assert_any_call(1, 10, pytest.approx(0, abs=1))
+
+
+def test_run_daemon_resets_the_pool_when_no_connection_is_available(daemon):
+    daemon.pool.getconn.side_effect = [None, MagicMock()]
+    stop_event = StopAfter(2)
+
+    process_sftp_files.run_daemon(stop_event)
+
+    assert stop_event.waits == [1, 10.5]
+    # Once for the unavailable connection and once on shutdown.
+    assert daemon.pool.close.call_count == 2
+    assert daemon.poll.call_count == 1
+    daemon.metrics.record_error.assert_called_once()
@@ -0,0 +1,10 @@
+import hashlib
+
+
+def file_sha256(path, block_size=1024 * 1024):
+    """Returns the hex SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
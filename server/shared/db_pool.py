@@ -0,0 +1,87 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+
+logger = logging.getLogger(__name__)
+
+
+def connect(settings):
+    """Opens a single connection with the given psycopg2 settings. Returns None if the database is unreachable."""
+    try:
+        conn = psycopg2.connect(**settings)
+        logger.info("Successfully connected to the database.")
+        return conn
+    except psycopg2.OperationalError as e:
+        logger.error(f"Could not connect to the database: {e}")
+        return None
+
+
+class ConnectionManager:
+    """
+    Thread-safe connection pool that is opened on first use. getconn() returns
+    None instead of raising when the database is unreachable, so services keep
+    their existing "no connection" handling; putconn() also accepts
+    connections that did not come from the pool and simply closes them.
+    """
+
+    def __init__(self, settings, max_connections=4, min_connections=1):
+        self.settings = settings
+        self.max_connections = max_connections
+        self.min_connections = min(min_connections, max_connections)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def getconn(self):
+        try:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.min_connections, self.max_connections, **self.settings
+                    )
+                    logger.info(f"Database connection pool ready (max {self.max_connections} connections).")
+                pool = self._pool
+            return pool.getconn()
+        except psycopg2.OperationalError as e:
+            logger.error(f"Could not connect to the database: {e}")
+            return None
+        except psycopg2.pool.PoolError as e:
+            logger.error(f"No database connection available: {e}")
+            return None
+
+    def putconn(self, conn):
+        """Returns conn to the pool; an open transaction is rolled back and a broken connection discarded."""
+        if conn is None:
+            return
+        pool = self._pool
+        if pool is None:
+            conn.close()
+            return
+        try:
+            pool.putconn(conn, close=bool(conn.closed))
+        except psycopg2.pool.PoolError:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Yields a pooled connection, rolling back on error. Raises OperationalError if none is available."""
+        conn = self.getconn()
+        if conn is None:
+            raise psycopg2.OperationalError("Database connection unavailable.")
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.putconn(conn)
+
+    def close(self):
+        """Closes every pooled connection. The next getconn() opens a new pool."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.closeall()
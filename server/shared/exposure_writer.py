@@ -0,0 +1,168 @@
+import csv
+import uuid
+import time
+import logging
+import threading
+from datetime import date
+from io import StringIO
+
+logger = logging.getLogger(__name__)
+
+EXPOSURE_COLUMNS = [
+    'sample_id', 'device_id', 'location_code', 'timestamp_utc', 'captured_by',
+    'method_code', 'value', 'unit', 'qualifier'
+]
+
+# Detail tables from migration 009, in column order (sample_id excluded).
+DETAIL_COLUMNS = {
+    'air_quality_details': ['duration_sec', 'flow_rate_lpm', 'filter_type'],
+    'voc_details': ['compound_name', 'media_type', 'humidity_pct'],
+    'noise_details': ['dosimeter_interval_min', 'laeq', 'peak_db'],
+    'radiation_details': ['detector_type', 'shielding_cm', 'calibration_date'],
+    'water_details': ['sample_type', 'temp_c', 'residual_chlorine_mg_l'],
+    'heat_stress_details': ['db_c', 'wb_c', 'globe_c', 'flag_color'],
+}
+
+# Filename conventions (lowercase fnmatch pattern -> detail table) shared by the
+# SFTP loader and the CSV poller.
+DEFAULT_ROUTES = [
+    ('noise_*.csv', 'noise_details'),
+    ('rad_*.csv', 'radiation_details'),
+    ('air_*.csv', 'air_quality_details'),
+    ('voc_*.csv', 'voc_details'),
+    ('heat_*.csv', 'heat_stress_details'),
+    ('water_*.csv', 'water_details'),
+]
+
+# Batches with at least this many rows are loaded with COPY; smaller ones with a multi-row INSERT.
+COPY_THRESHOLD_ROWS = 500
+# Rows per INSERT statement, which keeps the bind parameter count well below the protocol limit.
+INSERT_PAGE_ROWS = 1000
+
+
+class ExposureRecord:
+    """One reading for exposures plus its detail row, stored in slots to keep large batches compact."""
+
+    __slots__ = EXPOSURE_COLUMNS + ['detail']
+
+    def __init__(self, device_id, timestamp_utc, value, unit, location_code=None, captured_by=None,
+                 method_code=None, qualifier='OK', sample_id=None, detail=()):
+        self.sample_id = sample_id or str(uuid.uuid4())
+        self.device_id = device_id
+        self.location_code = location_code
+        self.timestamp_utc = timestamp_utc
+        self.captured_by = captured_by
+        self.method_code = method_code
+        self.value = value
+        self.unit = unit
+        self.qualifier = qualifier
+        # Values in DETAIL_COLUMNS order for the detail table the record is written to.
+        self.detail = tuple(detail)
+
+    def exposure_row(self):
+        return tuple(getattr(self, column) for column in EXPOSURE_COLUMNS)
+
+    def detail_row(self):
+        return (self.sample_id,) + self.detail
+
+
+class WriterMetrics:
+    """Thread-safe batch, row and time totals per write method (insert or copy)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def record(self, method, rows, seconds):
+        with self._lock:
+            totals = self._methods.setdefault(method, {'batches': 0, 'rows': 0, 'seconds': 0.0})
+            totals['batches'] += 1
+            totals['rows'] += rows
+            totals['seconds'] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                method: {**totals, 'seconds': round(totals['seconds'], 3),
+                         'rows_per_second': round(totals['rows'] / totals['seconds'], 1) if totals['seconds'] else None}
+                for method, totals in self._methods.items()
+            }
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    return value.isoformat() if isinstance(value, date) else value
+
+
+class ExposureWriter:
+    """
+    Bulk writer for exposures and their detail tables. Each batch is written
+    with a multi-row INSERT or, from copy_threshold rows up, with COPY. The
+    writer only uses the cursor it is given; the caller owns the transaction,
+    so the exposures and detail rows commit (or roll back) together.
+    """
+
+    def __init__(self, copy_threshold=COPY_THRESHOLD_ROWS, metrics=None):
+        self.copy_threshold = copy_threshold
+        self.metrics = metrics or WriterMetrics()
+
+    def write_rows(self, cur, table, columns, rows):
+        """Writes a list of row tuples to table. Returns the number of rows written."""
+        if not rows:
+            return 0
+        started = time.monotonic()
+        if len(rows) >= self.copy_threshold:
+            method = 'copy'
+            buffer = StringIO()
+            writer = csv.writer(buffer)
+            for row in rows:
+                writer.writerow([_csv_value(v) for v in row])
+            buffer.seek(0)
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        else:
+            method = 'insert'
+            placeholders = '(' + ', '.join(['%s'] * len(columns)) + ')'
+            for start in range(0, len(rows), INSERT_PAGE_ROWS):
+                page = rows[start:start + INSERT_PAGE_ROWS]
+                cur.execute(
+                    f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([placeholders] * len(page))}",
+                    [value for row in page for value in row]
+                )
+        elapsed = time.monotonic() - started
+        self.metrics.record(method, len(rows), elapsed)
+        logger.debug(f"Wrote {len(rows)} rows to {table} via {method} in {elapsed * 1000:.1f} ms.")
+        return len(rows)
+
+    def write_records(self, cur, detail_table, records):
+        """Writes ExposureRecords to exposures and detail_table. Returns the number of readings written."""
+        records = list(records)
+        written = self.write_rows(cur, 'exposures', EXPOSURE_COLUMNS, [r.exposure_row() for r in records])
+        if detail_table:
+            self.write_rows(cur, detail_table, ['sample_id'] + DETAIL_COLUMNS[detail_table],
+                            [r.detail_row() for r in records])
+        return written
+
+    def write_frame(self, cur, detail_table, df, exposure_columns, detail_columns):
+        """
+        Writes a DataFrame holding both exposure and detail columns. A sample_id
+        column is generated when missing. Returns the number of readings written.
+        """
+        if 'sample_id' not in df.columns:
+            df = df.assign(sample_id=[str(uuid.uuid4()) for _ in range(len(df))])
+        if len(df) >= self.copy_threshold:
+            # Large frames go straight to CSV without building Python tuples.
+            for table, columns in (('exposures', exposure_columns), (detail_table, detail_columns)):
+                started = time.monotonic()
+                buffer = StringIO()
+                df.to_csv(buffer, columns=['sample_id'] + columns, header=False, index=False)
+                buffer.seek(0)
+                cur.copy_expert(f"COPY {table} (sample_id, {', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+                self.metrics.record('copy', len(df), time.monotonic() - started)
+            return len(df)
+
+        for table, columns in (('exposures', exposure_columns), (detail_table, detail_columns)):
+            subset = df[['sample_id'] + columns].astype(object)
+            rows = list(subset.where(subset.notna(), None).itertuples(index=False, name=None))
+            self.write_rows(cur, table, ['sample_id'] + columns, rows)
+        return len(df)
@@ -0,0 +1,14 @@
+import hashlib
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from checksums import file_sha256
+
+def test_file_sha256_reads_the_file_in_blocks(tmp_path):
+    path = tmp_path / 'data.bin'
+    content = os.urandom(10000)
+    path.write_bytes(content)
+
+    assert file_sha256(str(path), block_size=1024) == hashlib.sha256(content).hexdigest()
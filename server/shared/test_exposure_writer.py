@@ -0,0 +1,84 @@
+import pytest
+import pandas as pd
+from unittest.mock import MagicMock
+from datetime import datetime, timezone
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import psycopg2.pool
+from db_pool import ConnectionManager
+from exposure_writer import ExposureRecord, ExposureWriter, EXPOSURE_COLUMNS
+
+TS = datetime(2024, 6, 1, 12, tzinfo=timezone.utc)
+
+@pytest.fixture
+def mock_cur():
+    """Fixture to mock a database cursor."""
+    return MagicMock()
+
+def make_records(count):
+    return [
+        ExposureRecord('aerps-7', TS, 85.0 + i, 'dBA', location_code='DDG-51-ER', detail=(15, 85.0 + i, 110.0))
+        for i in range(count)
+    ]
+
+def test_exposure_record_uses_slots():
+    record = make_records(1)[0]
+
+    assert not hasattr(record, '__dict__')
+    assert record.exposure_row() == (record.sample_id, 'aerps-7', 'DDG-51-ER', TS, None, None, 85.0, 'dBA', 'OK')
+    assert record.detail_row() == (record.sample_id, 15, 85.0, 110.0)
+
+def test_small_batches_use_one_multi_row_insert_per_table(mock_cur):
+    writer = ExposureWriter(copy_threshold=10)
+
+    assert writer.write_records(mock_cur, 'noise_details', make_records(3)) == 3
+
+    assert mock_cur.execute.call_count == 2
+    mock_cur.copy_expert.assert_not_called()
+    sql, params = mock_cur.execute.call_args_list[0][0]
+    assert sql.startswith(f"INSERT INTO exposures ({', '.join(EXPOSURE_COLUMNS)}) VALUES")
+    assert sql.count('(%s') == 3 and len(params) == 3 * len(EXPOSURE_COLUMNS)
+    assert 'noise_details (sample_id, dosimeter_interval_min, laeq, peak_db)' in mock_cur.execute.call_args_list[1][0][0]
+    assert writer.metrics.snapshot()['insert']['rows'] == 6
+
+def test_large_batches_use_copy(mock_cur):
+    writer = ExposureWriter(copy_threshold=2)
+
+    writer.write_records(mock_cur, 'noise_details', make_records(2))
+
+    mock_cur.execute.assert_not_called()
+    sql, buffer = mock_cur.copy_expert.call_args_list[0][0]
+    assert sql.startswith('COPY exposures (sample_id,')
+    first_line = buffer.getvalue().splitlines()[0]
+    assert ',aerps-7,DDG-51-ER,2024-06-01T12:00:00+00:00,,,85.0,dBA,OK' in first_line
+
+def test_write_frame_converts_missing_values_to_null(mock_cur):
+    df = pd.DataFrame({
+        'device_id': ['d1', 'd2'], 'value': [1.5, None], 'unit': ['dBA', 'dBA'],
+        'laeq': pd.array([80, None], dtype='Int64'),
+    })
+
+    assert ExposureWriter(copy_threshold=100).write_frame(mock_cur, 'noise_details', df, ['device_id', 'value', 'unit'], ['laeq']) == 2
+
+    params = mock_cur.execute.call_args_list[0][0][1]
+    assert params[1:4] == ['d1', 1.5, 'dBA'] and params[5:] == ['d2', None, 'dBA']
+    detail_params = mock_cur.execute.call_args_list[1][0][1]
+    assert detail_params[0] == params[0] and detail_params[1::2] == [80, None]
+
+def test_connection_manager_closes_connections_it_did_not_hand_out(mocker):
+    pool = MagicMock()
+    pool.putconn.side_effect = psycopg2.pool.PoolError("trying to put unkeyed connection")
+    mocker.patch('db_pool.psycopg2.pool.ThreadedConnectionPool', return_value=pool)
+    manager = ConnectionManager({'dbname': 'ehr-eng2'}, max_connections=2)
+    pooled = manager.getconn()
+    stray = MagicMock(closed=0)
+
+    manager.putconn(stray)
+
+    assert pooled is pool.getconn.return_value
+    stray.close.assert_called_once()
+    manager.close()
+    pool.closeall.assert_called_once()
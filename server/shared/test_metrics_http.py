@@ -0,0 +1,27 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics_http import start_metrics_server
+
+
+class StaticMetrics:
+    def snapshot(self):
+        return {'runs': 3, 'errors': 0}
+
+
+def test_metrics_server_serves_the_snapshot_as_json():
+    server = start_metrics_server(StaticMetrics(), 0, 'test')
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{base}/metrics/") as response:
+            assert response.headers['Content-Type'] == 'application/json'
+            assert json.loads(response.read()) == {'runs': 3, 'errors': 0}
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{base}/other")
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
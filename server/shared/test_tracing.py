@@ -0,0 +1,79 @@
+import json
+import pytest
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from tracing import (
+    JsonLinesExporter, Tracer, current_span, inject_headers, parse_traceparent, summarize_traces,
+    traceparent_from_headers,
+)
+
+PARENT = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span_dict):
+        self.spans.append(span_dict)
+
+@pytest.mark.parametrize('value', [
+    None, '', 'garbage', '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7',
+    '00-00000000000000000000000000000000-00f067aa0ba902b7-01', 'ff-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01',
+    '00-4bf92f3577b34da6a3ce929d0e0e4736-zzf067aa0ba902b7-01',
+])
+def test_parse_traceparent_rejects_malformed_values(value):
+    assert parse_traceparent(value) is None
+
+def test_child_spans_continue_the_trace_and_keep_the_sampled_flag():
+    exporter = ListExporter()
+    tracer = Tracer('grpc_service', sample_rate=0.0, exporter=exporter)
+
+    with tracer.start_span('UploadNoiseData', parent=PARENT) as span:
+        assert current_span() is span
+        with tracer.start_span('write') as child:
+            headers = inject_headers({})
+    assert current_span() is None
+
+    assert span.context.trace_id == '4bf92f3577b34da6a3ce929d0e0e4736'
+    assert span.parent_id == '00f067aa0ba902b7'
+    assert child.parent_id == span.context.span_id
+    assert headers == {'traceparent': child.traceparent}
+    # Sampled upstream, so exported even though this service samples 0% of new traces.
+    assert [s['name'] for s in exporter.spans] == ['write', 'UploadNoiseData']
+
+def test_unsampled_traces_propagate_but_are_not_exported():
+    exporter = ListExporter()
+    tracer = Tracer('mqtt_bridge', sample_rate=1.0, exporter=exporter)
+
+    with tracer.start_span('forward', parent=PARENT[:-2] + '00') as span:
+        pass
+
+    assert span.traceparent.endswith('-00')
+    assert exporter.spans == []
+
+def test_traceparent_from_headers_reads_http_grpc_and_kafka_headers():
+    assert traceparent_from_headers({'Traceparent': PARENT}) == PARENT
+    assert traceparent_from_headers((('user-agent', 'grpc'), ('traceparent', PARENT))) == PARENT
+    assert traceparent_from_headers([('traceparent', PARENT.encode('ascii'))]) == PARENT
+    assert traceparent_from_headers([('error', b'bad')]) is None
+
+def test_summarize_traces_orders_hops_and_traces_by_latency(tmp_path):
+    path = str(tmp_path / 'spans.jsonl')
+    tracer = Tracer('mqtt_bridge', sample_rate=1.0, exporter=JsonLinesExporter(path))
+    with tracer.start_span('forward') as span:
+        pass
+    tracer.record_span('load_batch', span.context, span.start_time + 0.5, span.start_time + 2.0)
+    with tracer.start_span('forward'):
+        pass
+
+    summaries = summarize_traces(path)
+
+    total_ms, trace_id, spans = summaries[0]
+    assert trace_id == span.context.trace_id and len(summaries) == 2
+    assert total_ms == pytest.approx(2000, abs=1)
+    assert [s['name'] for s in spans] == ['forward', 'load_batch']
+    assert spans[1]['parent_id'] == span.context.span_id
+    assert all(json.loads(line) for line in open(path))
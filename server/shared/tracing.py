@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# W3C Trace Context header / field name: 00-<32 hex trace id>-<16 hex span id>-<2 hex flags>
+TRACEPARENT = 'traceparent'
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class SpanContext:
+    """The propagated part of a span: trace id, span id and the sampled flag."""
+
+    __slots__ = ('trace_id', 'span_id', 'sampled')
+
+    def __init__(self, trace_id, span_id, sampled):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value):
+    """Returns the SpanContext in a traceparent value, or None if it is missing or malformed."""
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'replace')
+    parts = value.strip().split('-') if isinstance(value, str) else []
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[0] == 'ff' or parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None
+    return SpanContext(parts[1].lower(), parts[2].lower(), bool(flags & 1))
+
+
+def traceparent_from_headers(headers):
+    """
+    Finds the traceparent in HTTP headers (a dict), gRPC invocation metadata or
+    Kafka record headers (sequences of (key, value) pairs). Returns the value or None.
+    """
+    if not headers:
+        return None
+    items = headers.items() if isinstance(headers, dict) else headers
+    try:
+        for key, value in items:
+            if str(key).lower() == TRACEPARENT:
+                return value.decode('ascii', 'replace') if isinstance(value, bytes) else value
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class Span:
+    """One timed hop. Use as a context manager; it becomes the current span while open."""
+
+    __slots__ = ('tracer', 'name', 'context', 'parent_id', 'attributes', 'start_time', '_started', 'duration_ms',
+                 'error', '_token')
+
+    def __init__(self, tracer, name, context, parent_id=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+        self._token = None
+
+    @property
+    def traceparent(self):
+        return self.context.traceparent
+
+    @property
+    def sampled(self):
+        return self.context.sampled
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        if self.duration_ms is None:
+            self.duration_ms = (time.perf_counter() - self._started) * 1000
+            self.tracer.export(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        self.end()
+        return False
+
+    def as_dict(self):
+        return {
+            'trace_id': self.context.trace_id, 'span_id': self.context.span_id, 'parent_id': self.parent_id,
+            'service': self.tracer.service, 'name': self.name, 'start_time': self.start_time,
+            'duration_ms': round(self.duration_ms, 3), 'error': self.error, 'attributes': self.attributes,
+        }
+
+
+class JsonLinesExporter:
+    """Appends finished spans as JSON lines to a local file, shared safely between threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span_dict):
+        line = json.dumps(span_dict, default=str) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+
+class LoggingExporter:
+    """Logs finished spans at DEBUG; the fallback when no export path is configured."""
+
+    def export(self, span_dict):
+        logger.debug(f"span {json.dumps(span_dict, default=str)}")
+
+
+class Tracer:
+    """
+    Starts spans for one service. A new trace is sampled with probability
+    sample_rate; a continued trace keeps its parent's sampled flag, so a
+    reading is traced on every hop or on none. Unsampled spans still
+    propagate their context but are never exported.
+    """
+
+    def __init__(self, service, sample_rate=0.01, exporter=None):
+        self.service = service
+        self.sample_rate = sample_rate
+        self.exporter = exporter or LoggingExporter()
+
+    def start_span(self, name, parent=None, attributes=None):
+        """
+        Starts a span. parent may be a traceparent string, a SpanContext or a
+        Span; without one the current span is the parent, and without that a
+        new trace starts.
+        """
+        if isinstance(parent, (str, bytes)):
+            parent = parse_traceparent(parent)
+        elif isinstance(parent, Span):
+            parent = parent.context
+        if parent is None and _current_span.get() is not None:
+            parent = _current_span.get().context
+
+        span_id = os.urandom(8).hex()
+        if parent is None:
+            context = SpanContext(os.urandom(16).hex(), span_id, random.random() < self.sample_rate)
+            return Span(self, name, context, None, attributes)
+        return Span(self, name, SpanContext(parent.trace_id, span_id, parent.sampled), parent.span_id, attributes)
+
+    def record_span(self, name, parent, start_time, end_time, attributes=None):
+        """Exports a finished span with explicit wall-clock times, e.g. one batch shared by many traces."""
+        context = parent if isinstance(parent, SpanContext) else parse_traceparent(parent)
+        if context is None or not context.sampled:
+            return
+        span = Span(self, name, SpanContext(context.trace_id, os.urandom(8).hex(), True), context.span_id, attributes)
+        span.start_time = start_time
+        span.duration_ms = (end_time - start_time) * 1000
+        self.export(span)
+
+    def export(self, span):
+        if not span.sampled:
+            return
+        try:
+            self.exporter.export(span.as_dict())
+        except Exception as e:
+            logger.warning(f"Failed to export span {span.name}: {e}")
+
+
+def current_span():
+    """Returns the span currently open in this thread or task, or None."""
+    return _current_span.get()
+
+
+def inject_headers(headers, span=None):
+    """Adds the traceparent of span (default: the current span) to a headers dict. Returns headers."""
+    span = span or _current_span.get()
+    if span is not None:
+        headers[TRACEPARENT] = span.traceparent
+    return headers
+
+
+def kafka_headers(span):
+    """Kafka record headers carrying span's trace context."""
+    return [(TRACEPARENT, span.traceparent.encode('ascii'))]
+
+
+def tracer_from_env(service):
+    """
+    Builds a Tracer from TRACE_SAMPLE_RATE (default 0.01) and TRACE_EXPORT_PATH
+    (JSON lines file; spans are logged at DEBUG when empty). Call after load_dotenv().
+    """
+    sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+    export_path = os.getenv("TRACE_EXPORT_PATH", "")
+    exporter = JsonLinesExporter(export_path) if export_path else LoggingExporter()
+    return Tracer(service, sample_rate, exporter)
+
+
+def summarize_traces(path, slowest=10):
+    """Reads an exported spans file and returns the slowest traces with their hops in start order."""
+    traces = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                span = json.loads(line)
+                traces.setdefault(span['trace_id'], []).append(span)
+
+    summaries = []
+    for trace_id, spans in traces.items():
+        spans.sort(key=lambda s: s['start_time'])
+        end = max(s['start_time'] + s['duration_ms'] / 1000 for s in spans)
+        summaries.append((round((end - spans[0]['start_time']) * 1000, 3), trace_id, spans))
+    summaries.sort(key=lambda t: t[0], reverse=True)
+    return summaries[:slowest]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Shows the slowest traces in a TRACE_EXPORT_PATH file, hop by hop.")
+    parser.add_argument('path')
+    parser.add_argument('--slowest', type=int, default=10)
+    args = parser.parse_args()
+    for total_ms, trace_id, spans in summarize_traces(args.path, args.slowest):
+        print(f"{trace_id}  {total_ms:.1f} ms end to end")
+        first = spans[0]['start_time']
+        for span in spans:
+            offset_ms = (span['start_time'] - first) * 1000
+            error = f"  ERROR {span['error']}" if span['error'] else ''
+            print(f"  +{offset_ms:>9.1f} ms  {span['duration_ms']:>9.1f} ms  {span['service']}/{span['name']}{error}")